@@ -0,0 +1,158 @@
+# dmkod-integration-app/app/api_cache.py
+"""
+Общий для всех воркеров кэш в Redis для данных внешнего API ДМкод:
+- токен доступа: обновляется заранее, до истечения срока, и только одним процессом одновременно;
+- справочник участников (клиентов): меняется редко, хранится до истечения TTL или явного сброса.
+
+Если Redis недоступен, данные запрашиваются у API напрямую, как раньше.
+"""
+import base64
+import json
+import logging
+import os
+import time
+
+import redis
+import requests
+
+from .api_client import get_api_base_url, request_api_tokens
+
+TOKEN_KEY = 'dmkod:api_token'
+TOKEN_LOCK_KEY = 'dmkod:api_token:lock'
+PARTICIPANTS_KEY = 'dmkod:participants'
+
+# Срок жизни токена, если его не удалось прочитать из самого токена (JWT exp)
+TOKEN_DEFAULT_TTL = int(os.getenv('DMKOD_API_TOKEN_TTL', '3600'))
+# За сколько секунд до истечения токен считается устаревшим и обновляется
+TOKEN_REFRESH_MARGIN = int(os.getenv('DMKOD_API_TOKEN_REFRESH_MARGIN', '300'))
+# Сколько ждать, пока токен обновляет другой процесс
+TOKEN_LOCK_TIMEOUT = 30
+PARTICIPANTS_TTL = int(os.getenv('DMKOD_PARTICIPANTS_CACHE_TTL', '600'))
+
+
+def _token_expires_at(access_token: str) -> float:
+    """Время истечения токена из поля exp (JWT), без проверки подписи."""
+    try:
+        payload = access_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        if exp:
+            return float(exp)
+    except (IndexError, ValueError, AttributeError):
+        pass
+    return time.time() + TOKEN_DEFAULT_TTL
+
+
+class ApiCache:
+    """Кэш токена и справочников API ДМкод в Redis."""
+
+    def __init__(self):
+        self.redis_client = redis.Redis(
+            host=os.getenv('REDIS_HOST', 'localhost'),
+            port=int(os.getenv('REDIS_PORT', 6379)),
+            db=int(os.getenv('DMKOD_REDIS_DB', 0)),
+            decode_responses=True,
+            socket_timeout=5
+        )
+
+    # --- Токен доступа ---
+
+    def _read_token(self):
+        tokens_json = self.redis_client.get(TOKEN_KEY)
+        if not tokens_json:
+            return None
+        tokens = json.loads(tokens_json)
+        if tokens.get('expires_at', 0) - TOKEN_REFRESH_MARGIN <= time.time():
+            return None
+        return tokens
+
+    def _fetch_and_store_token(self):
+        tokens = request_api_tokens()
+        expires_at = _token_expires_at(tokens.get('access'))
+        tokens['expires_at'] = expires_at
+        ttl = max(int(expires_at - time.time()), 1)
+        self.redis_client.set(TOKEN_KEY, json.dumps(tokens), ex=ttl)
+        logging.info(f"Получен новый токен API ДМкод, действует {ttl} с.")
+        return tokens
+
+    def get_tokens(self) -> dict:
+        """
+        Возвращает {'access': ..., 'refresh': ..., 'expires_at': ...}.
+        Если токен устарел, обновляет его под блокировкой: остальные процессы ждут
+        и получают уже обновленный токен, а не запрашивают свой.
+        """
+        try:
+            tokens = self._read_token()
+            if tokens:
+                return tokens
+            with self.redis_client.lock(TOKEN_LOCK_KEY, timeout=TOKEN_LOCK_TIMEOUT, blocking_timeout=TOKEN_LOCK_TIMEOUT):
+                # Пока ждали блокировку, токен мог обновить другой процесс
+                tokens = self._read_token()
+                if tokens:
+                    return tokens
+                return self._fetch_and_store_token()
+        except redis.exceptions.RedisError as e:  # в т.ч. LockError - не дождались обновления токена
+            logging.warning(f"Кэш токена API в Redis недоступен ({e}), запрашиваю токен напрямую.")
+            tokens = request_api_tokens()
+            tokens['expires_at'] = _token_expires_at(tokens.get('access'))
+            return tokens
+
+    def get_access_token(self) -> str:
+        return self.get_tokens().get('access')
+
+    def invalidate_token(self, access_token: str = None):
+        """
+        Сбрасывает токен (например, после ответа 401).
+        Если передан `access_token`, сбрасывает только его, чтобы не выбросить токен, уже обновленный другим процессом.
+        """
+        try:
+            if access_token:
+                tokens = self.redis_client.get(TOKEN_KEY)
+                if not tokens or json.loads(tokens).get('access') != access_token:
+                    return
+            self.redis_client.delete(TOKEN_KEY)
+        except redis.exceptions.RedisError as e:
+            logging.warning(f"Не удалось сбросить токен API в Redis: {e}")
+
+    # --- Справочник участников ---
+
+    def _request_participants(self):
+        """Запрашивает список участников у API; при 401 один раз обновляет токен."""
+        url = f"{get_api_base_url()}/psp/participants"
+        access_token = self.get_access_token()
+        response = requests.get(url, headers={'Authorization': f'Bearer {access_token}'}, timeout=30)
+        if response.status_code == 401:
+            self.invalidate_token(access_token)
+            access_token = self.get_access_token()
+            response = requests.get(url, headers={'Authorization': f'Bearer {access_token}'}, timeout=30)
+        response.raise_for_status()
+        # Проверяем, есть ли что-то в ответе перед декодированием
+        return response.json().get('participants', []) if response.text else []
+
+    def get_participants(self, force_refresh: bool = False) -> list:
+        """Список участников из кэша; запрос к API - только при отсутствии в кэше или force_refresh."""
+        try:
+            if not force_refresh:
+                participants_json = self.redis_client.get(PARTICIPANTS_KEY)
+                if participants_json is not None:
+                    return json.loads(participants_json)
+        except redis.exceptions.RedisError as e:
+            logging.warning(f"Кэш участников в Redis недоступен ({e}), запрашиваю список напрямую.")
+            return self._request_participants()
+
+        participants = self._request_participants()
+        try:
+            self.redis_client.set(PARTICIPANTS_KEY, json.dumps(participants, ensure_ascii=False), ex=PARTICIPANTS_TTL)
+        except redis.exceptions.RedisError as e:
+            logging.warning(f"Не удалось сохранить список участников в Redis: {e}")
+        return participants
+
+    def invalidate_participants(self):
+        try:
+            self.redis_client.delete(PARTICIPANTS_KEY)
+        except redis.exceptions.RedisError as e:
+            logging.warning(f"Не удалось сбросить кэш участников в Redis: {e}")
+
+
+# Создаем единственный экземпляр, который будет использоваться во всем приложении
+api_cache = ApiCache()
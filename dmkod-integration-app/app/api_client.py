@@ -0,0 +1,28 @@
+# dmkod-integration-app/app/api_client.py
+"""
+Общие функции для обращения к API ДМкод.
+"""
+import os
+
+import requests
+
+
+def get_api_base_url() -> str:
+    return os.getenv('API_BASE_URL', '').rstrip('/')
+
+
+def request_api_tokens() -> dict:
+    """
+    Получает пару токенов API ({'access': ..., 'refresh': ...}) по учетным данным из окружения.
+    Учетная запись API одна на приложение, поэтому токен может получить и веб-процесс, и фоновый обработчик.
+    """
+    token_url = f"{get_api_base_url()}/user/token"
+    api_credentials = {
+        "email": os.getenv('API_EMAIL'),
+        "password": os.getenv('API_PASSWORD')
+    }
+    # Используем GET и передаем данные в теле запроса как JSON.
+    # Это нестандартный способ, но требуется для данного API.
+    response = requests.get(token_url, json=api_credentials, timeout=30)
+    response.raise_for_status()  # Вызовет ошибку, если статус ответа не 2xx
+    return response.json()
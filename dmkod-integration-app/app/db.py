@@ -1,13 +1,27 @@
 # dmkod-integration-app/app/db.py
 
 import os
+import logging
+import threading
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 from dotenv import load_dotenv
+from flask import g, has_request_context
 
 load_dotenv()
 
-def get_db_connection():
-    """Устанавливает соединение с базой данных PostgreSQL."""
+# Размер пула соединений на процесс (воркер gunicorn)
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+
+_pool = None
+_pool_lock = threading.Lock()
+# Счетчик физических подключений, открытых в текущем потоке (для статистики запроса)
+_thread_stats = threading.local()
+
+
+def _get_conn_params():
+    """Параметры подключения к PostgreSQL из переменных окружения."""
     # --- ИЗМЕНЕНО: Гибкая настройка подключения с поддержкой SSL ---
     conn_params = {
         'host': os.getenv('DB_HOST'),
@@ -26,6 +40,103 @@ def get_db_connection():
         ssl_rootcert = os.getenv("DB_SSL_ROOTCERT")
         if ssl_rootcert:
             conn_params['sslrootcert'] = ssl_rootcert
+    return conn_params
+
+
+class _CountingConnectionPool(ThreadedConnectionPool):
+    """Пул, который учитывает новые физические подключения (TLS и аутентификация) в статистике запроса."""
+
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        _thread_stats.opened = getattr(_thread_stats, 'opened', 0) + 1
+        return conn
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # keepalives - чтобы простаивающие в пуле SSL-соединения не обрывались сетевым оборудованием
+                _pool = _CountingConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX,
+                    keepalives=1, keepalives_idle=60, keepalives_interval=10, keepalives_count=3,
+                    **_get_conn_params()
+                )
+                logging.info(f"Создан пул соединений с БД (min={DB_POOL_MIN}, max={DB_POOL_MAX}), pid {os.getpid()}.")
+    return _pool
+
+
+class _RequestConnection:
+    """
+    Соединение запроса, выданное get_db_connection().
+    Все вызовы в рамках одного HTTP-запроса работают через одно соединение из пула.
+    close() ничего не закрывает: соединение возвращается в пул при завершении запроса (см. init_app).
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._conn.__exit__(exc_type, exc_value, traceback)
+
+
+def get_db_connection():
+    """
+    Соединение с базой данных PostgreSQL.
+    В HTTP-запросе - соединение из пула, общее для всего запроса; вне запроса (обработчик заданий,
+    скрипты обслуживания) - отдельное новое соединение, которое закрывает вызывающий.
+    """
+    if not has_request_context():
+        return psycopg2.connect(**_get_conn_params())
+
+    g.db_checkouts = g.get('db_checkouts', 0) + 1
+    if 'db_conn' not in g:
+        _thread_stats.opened = 0
+        try:
+            conn = _get_pool().getconn()
+        except PoolError:
+            logging.error(f"Пул соединений с БД исчерпан (max={DB_POOL_MAX}).")
+            raise
+        if conn.closed:
+            # Соединение было разорвано, пока лежало в пуле
+            _get_pool().putconn(conn, close=True)
+            conn = _get_pool().getconn()
+        g.db_conn = conn
+        g.db_connections_opened = _thread_stats.opened
+    return _RequestConnection(g.db_conn)
+
+
+def _report_request_connections(response):
+    """Статистика соединений запроса: сколько раз запрашивалось соединение и сколько новых подключений открыто."""
+    checkouts = g.get('db_checkouts', 0)
+    if checkouts:
+        opened = g.get('db_connections_opened', 0)
+        response.headers['X-DB-Checkouts'] = str(checkouts)
+        response.headers['X-DB-Connections-Opened'] = str(opened)
+        logging.debug(f"DB: {checkouts} обращений к соединению, новых подключений: {opened}.")
+    return response
+
+
+def _return_request_connection(exc):
+    conn = g.pop('db_conn', None)
+    if conn is None:
+        return
+    # Незавершенная транзакция откатывается, разорванное соединение закрывается (см. ThreadedConnectionPool.putconn)
+    _get_pool().putconn(conn, close=bool(conn.closed))
+
 
-    conn = psycopg2.connect(**conn_params)
-    return conn
\ No newline at end of file
+def init_app(app):
+    """Подключает возврат соединений в пул по завершении запроса и статистику соединений запроса."""
+    app.after_request(_report_request_connections)
+    app.teardown_appcontext(_return_request_connection)
@@ -0,0 +1,115 @@
+# dmkod-integration-app/app/delta_import.py
+"""
+Преобразование CSV-файла "Дельта" в данные для таблиц 'packages', 'items' и 'delta_result'.
+
+Все функции работают над столбцами pandas целиком (векторные строковые операции и group-by),
+без построчных вызовов Python, чтобы импорт больших файлов упирался в ввод-вывод, а не в интерпретатор.
+"""
+import json
+
+import pandas as pd
+
+# Символ-разделитель групп в коде DataMatrix, непечатаемый (ASCII 29)
+GS_SEPARATOR = '\x1d'
+
+DATAMATRIX_COLUMNS = ['datamatrix', 'gtin', 'serial', 'crypto_part_91', 'crypto_part_92', 'crypto_part_93']
+
+
+def parse_datamatrix(dm_string: str) -> dict:
+    """Разбирает (парсит) строку DataMatrix на составные части."""
+    result = {
+        'datamatrix': dm_string, 'gtin': '', 'serial': '',
+        'crypto_part_91': '', 'crypto_part_92': '', 'crypto_part_93': ''
+    }
+    cleaned_dm = dm_string.replace(' ', '\x1d').strip()
+    parts = cleaned_dm.split(GS_SEPARATOR)
+    if len(parts) > 0:
+        main_part = parts.pop(0)
+        if main_part.startswith('01'):
+            result['gtin'] = main_part[2:16]
+            serial_part = main_part[16:]
+            if serial_part.startswith('21'):
+                # Убираем возможный GS в конце серийного номера
+                result['serial'] = serial_part[2:].split(GS_SEPARATOR)[0]
+
+    for part in parts:
+        if not part: continue
+        if part.startswith('91'): result['crypto_part_91'] = part[2:]
+        elif part.startswith('92'): result['crypto_part_92'] = part[2:]
+        elif part.startswith('93'): result['crypto_part_93'] = part[2:]
+    return result
+
+
+def parse_datamatrix_series(codes: pd.Series) -> pd.DataFrame:
+    """
+    Векторная версия parse_datamatrix: разбирает целый столбец кодов строковыми операциями pandas.
+    Возвращает DataFrame с колонками DATAMATRIX_COLUMNS и тем же индексом, что у `codes`.
+    """
+    codes = codes.fillna('').astype(str)
+    cleaned = codes.str.replace(' ', GS_SEPARATOR, regex=False).str.strip()
+    # Колонка 0 - основная часть (GTIN и серийный номер), остальные - группы после GS
+    parts = cleaned.str.split(GS_SEPARATOR, expand=True)
+    main_part = parts[0]
+
+    has_gtin = main_part.str.startswith('01')
+    serial_part = main_part.str[16:]
+    has_serial = has_gtin & serial_part.str.startswith('21')
+
+    result = pd.DataFrame({
+        'datamatrix': codes,
+        'gtin': main_part.str[2:16].where(has_gtin, ''),
+        'serial': serial_part.str[2:].where(has_serial, ''),
+        'crypto_part_91': '', 'crypto_part_92': '', 'crypto_part_93': '',
+    }, index=codes.index)
+
+    # Как и в построчной версии, проходим группы слева направо: при повторе идентификатора
+    # остается последнее вхождение.
+    for column in parts.columns[1:]:
+        part = parts[column].fillna('')
+        for ai in ('91', '92', '93'):
+            target = f'crypto_part_{ai}'
+            result[target] = part.str[2:].where(part.str.startswith(ai), result[target])
+    return result
+
+
+def map_parent_sscc(packages_df: pd.DataFrame, box_pallet_map: pd.DataFrame) -> pd.Series:
+    """
+    Возвращает SSCC паллеты для каждого короба (level == 1) и None для остальных упаковок.
+    `box_pallet_map` - пары BoxSSCC/PaletSSCC из файла.
+    """
+    box_to_pallet_sscc_map = pd.Series(box_pallet_map['PaletSSCC'].values, index=box_pallet_map['BoxSSCC']).to_dict()
+    parent_sscc = packages_df['sscc'].map(box_to_pallet_sscc_map).where(packages_df['level'] == 1)
+    # None вместо NaN, чтобы в БД попал NULL
+    return parent_sscc.astype('object').where(parent_sscc.notna(), None)
+
+
+def _json_string(values: pd.Series) -> pd.Series:
+    """Строковые литералы JSON для значений столбца (json.dumps экранирует и управляющие символы)."""
+    return values.map(json.dumps)
+
+
+def build_delta_payloads(df: pd.DataFrame, gtin_to_printrun_map: dict) -> pd.DataFrame:
+    """
+    Группирует коды по тиражу, дате производства и сроку годности и собирает для каждой группы
+    тело запроса /psp/utilisation/upload в колонке 'codes_json'.
+
+    `df` - исходный DataFrame файла "Дельта" с колонками DataMatrix, Barcode, StartDate, EndDate.
+    Возвращает DataFrame с колонками printrun_id, production_date, codes_json.
+    """
+    printrun_id = df['Barcode'].map(gtin_to_printrun_map)
+    code_objects = '{"code": ' + _json_string(df['DataMatrix'].str.replace(GS_SEPARATOR, '', regex=False)) + '}'
+
+    grouped = code_objects.groupby(
+        [printrun_id.rename('printrun_id'),
+         df['StartDate'].rename('production_date'),
+         df['EndDate'].rename('expiration_date')]
+    ).agg(', '.join).rename('include').reset_index()
+
+    grouped['codes_json'] = (
+        '{"include": [' + grouped['include'] + '], "attributes": {"production_date": '
+        + _json_string(grouped['production_date'].astype(str)) + ', "expiration_date": '
+        + _json_string(grouped['expiration_date'].astype(str)) + '}}'
+    )
+    grouped['printrun_id'] = grouped['printrun_id'].astype(int)
+    grouped['production_date'] = pd.to_datetime(grouped['production_date']).dt.date
+    return grouped[['printrun_id', 'production_date', 'codes_json']]
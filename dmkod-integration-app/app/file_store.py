@@ -0,0 +1,105 @@
+# dmkod-integration-app/app/file_store.py
+"""
+Локальное хранилище оригинальных файлов заказов, адресуемое по содержимому.
+
+Файл лежит на диске под именем своего SHA-256 (<каталог>/<первые 2 символа>/<хеш>),
+а в таблице dmkod_order_files хранятся только имя, размер и контрольная сумма.
+Одинаковые файлы хранятся в одном экземпляре.
+
+Запись и удаление файла выполняются под транзакционной advisory-блокировкой по хешу,
+чтобы удаление "осиротевшего" файла не пересеклось с новой загрузкой того же содержимого.
+Файлы удаляются только после фиксации транзакции, удалившей (или так и не создавшей) строки:
+при откате строки не остаются без файлов, а при сбое очистки на диске остается лишь лишний файл.
+"""
+import hashlib
+import os
+import tempfile
+
+# Каталог хранилища; в docker-compose смонтирован как том
+FILE_STORE_DIR = os.getenv('DMKOD_FILE_STORE_DIR', '/app/data/order_files')
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_file_path(checksum: str) -> str:
+    """Путь к файлу в хранилище по его SHA-256."""
+    return os.path.join(FILE_STORE_DIR, checksum[:2], checksum)
+
+
+def _lock_checksum(cur, checksum: str):
+    """Блокировка на содержимое до конца текущей транзакции."""
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (checksum,))
+
+
+def store_stream(cur, stream):
+    """
+    Потоково пишет содержимое `stream` во временный файл, считая SHA-256, и переносит его в хранилище.
+    Берет блокировку по хешу до конца транзакции `cur`. Возвращает (checksum, file_size).
+    """
+    os.makedirs(FILE_STORE_DIR, exist_ok=True)
+    sha256 = hashlib.sha256()
+    file_size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=FILE_STORE_DIR, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                tmp.write(chunk)
+                file_size += len(chunk)
+        checksum = sha256.hexdigest()
+
+        _lock_checksum(cur, checksum)
+        target_path = get_file_path(checksum)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        # Содержимое по этому пути всегда одно и то же, поэтому перезапись безопасна
+        os.replace(tmp_path, target_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return checksum, file_size
+
+
+def save_order_file(cur, order_id: int, filename: str, stream, stored_checksums: list | None = None) -> int:
+    """
+    Сохраняет файл заказа в хранилище и добавляет строку в dmkod_order_files.
+    Возвращает id строки. Коммит транзакции - на стороне вызывающего кода; хеш записанного
+    файла добавляется в stored_checksums, чтобы при откате убрать файл через delete_unreferenced_files.
+    """
+    checksum, file_size = store_stream(cur, stream)
+    if stored_checksums is not None:
+        stored_checksums.append(checksum)
+    cur.execute(
+        """
+        INSERT INTO dmkod_order_files (order_id, filename, file_size, checksum_sha256)
+        VALUES (%s, %s, %s, %s)
+        RETURNING id
+        """,
+        (order_id, filename, file_size, checksum)
+    )
+    row = cur.fetchone()
+    return row['id'] if isinstance(row, dict) else row[0]
+
+
+def delete_unreferenced_files(conn, checksums) -> int:
+    """
+    Удаляет из хранилища файлы, на которые больше не ссылается ни одна строка dmkod_order_files.
+    Вызывается после commit (или rollback) транзакции, изменившей строки: каждый файл проверяется
+    и удаляется в собственной короткой транзакции `conn` под блокировкой по хешу.
+    Возвращает количество удаленных файлов.
+    """
+    removed = 0
+    for checksum in set(filter(None, checksums)):
+        try:
+            with conn.cursor() as cur:
+                _lock_checksum(cur, checksum)
+                cur.execute("SELECT EXISTS (SELECT 1 FROM dmkod_order_files WHERE checksum_sha256 = %s)", (checksum,))
+                still_referenced = cur.fetchone()[0]
+                if not still_referenced:
+                    try:
+                        os.remove(get_file_path(checksum))
+                        removed += 1
+                    except FileNotFoundError:
+                        pass
+        finally:
+            # Снимаем блокировку по хешу сразу после проверки файла
+            conn.commit()
+    return removed
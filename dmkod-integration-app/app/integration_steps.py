@@ -0,0 +1,534 @@
+# dmkod-integration-app/app/integration_steps.py
+"""
+Шаги интеграции заказа с API ДМкод, выполняемые фоновым обработчиком (см. app/workflow.py).
+
+Каждый шаг можно безопасно повторить: уже выполненная работа фиксируется построчно и при повторе
+пропускается. Созданные тиражи, скачанные коды и отправленные сведения хранятся в БД; запросы JSON
+и отчетов по тиражам отмечаются в результате задания (ctx.save_progress) и не повторяются в рамках
+этого задания, а новый запуск шага отправляет их заново.
+"""
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+import requests
+from psycopg2.extras import RealDictCursor, execute_values
+
+from .json_stream import iter_json_array
+from .utils import upsert_data_to_db
+from .workflow import workflow_step, TransientStepError
+
+# Сколько тиражей создается одновременно; ограничение защищает API от всплеска запросов
+TIRAGE_CREATE_CONCURRENCY = int(os.getenv('DMKOD_TIRAGE_CONCURRENCY', '8'))
+# Размер пакета кодов, записываемого в БД по мере скачивания тиража
+CODES_WRITE_BATCH_SIZE = int(os.getenv('DMKOD_CODES_BATCH_SIZE', '5000'))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def _raise_for_status(ctx, response):
+    if not response.ok:
+        ctx.log(f"  Ответ сервера: {response.text}")
+    response.raise_for_status()
+
+
+def _require_api_order_id(conn, order_id):
+    with conn.cursor() as cur:
+        cur.execute("SELECT api_order_id FROM orders WHERE id = %s", (order_id,))
+        row = cur.fetchone()
+    if not row or not row[0]:
+        raise Exception("Сначала необходимо создать заказ в API.")
+    return row[0]
+
+
+@workflow_step('create_order', 'Создать заказ')
+def create_order(ctx, conn):
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        # 1. Получаем основную информацию о заказе и товарной группе
+        cur.execute("""
+            SELECT o.participant_id, o.notes, o.api_order_id, pg.dm_template
+            FROM orders o
+            JOIN dmkod_product_groups pg ON o.product_group_id = pg.id
+            WHERE o.id = %s
+        """, (ctx.order_id,))
+        order_info = cur.fetchone()
+
+        if not order_info:
+            raise Exception("Не найдена информация о заказе или товарной группе.")
+
+        if order_info['api_order_id']:
+            ctx.log(f"Заказ в API уже создан (ID: {order_info['api_order_id']}), повторный запрос не нужен.")
+            return
+
+        # 2. Получаем детализацию для формирования продуктов с учетом дат
+        cur.execute("""
+            SELECT gtin, dm_quantity, production_date
+            FROM dmkod_aggregation_details
+            WHERE order_id = %s AND gtin IS NOT NULL AND gtin != ''
+        """, (ctx.order_id,))
+        products_data = cur.fetchall()
+
+        if not products_data:
+            raise Exception("В заказе нет детализации по продуктам (GTIN) для отправки.")
+
+    # 3. Группируем по GTIN, суммируем количество и берем самую раннюю дату производства
+    products_df = pd.DataFrame(products_data)
+    aggregated_products_df = products_df.groupby('gtin').agg(
+        dm_quantity=('dm_quantity', 'sum'),
+        production_date=('production_date', 'min')
+    ).reset_index()
+
+    # 4. Формируем тело запроса к API на основе сгруппированных данных
+    products_payload = []
+    for _, p in aggregated_products_df.iterrows():
+        product = {
+            "gtin": p['gtin'],
+            "code_template": order_info['dm_template'],
+            "qty": int(p['dm_quantity']),
+            "unit_type": "UNIT",
+            "release_method": "IMPORT",
+            "payment_type": 2,
+        }
+        # Атрибуты передаем, только если дата производства указана
+        if p.get('production_date'):
+            product["attributes"] = {"production_date": p['production_date'].strftime('%Y-%m-%d')}
+        products_payload.append(product)
+
+    api_payload = {
+        "participant_id": order_info['participant_id'],
+        "production_order_id": order_info['notes'] or "",
+        "contact_person": ctx.params.get('contact_person'),
+        "products": products_payload
+    }
+
+    # 5. Отправляем запрос к API
+    ctx.log(f"Отправка заказа в API: {len(products_payload)} продуктов.")
+    response = ctx.api('POST', '/psp/order/create', json=api_payload, timeout=30)
+    ctx.log(f"  Статус ответа: {response.status_code}")
+    _raise_for_status(ctx, response)
+
+    response_data = response.json()
+    api_order_id = response_data.get('order_id')
+    if not api_order_id:
+        raise Exception(f"API не вернуло 'order_id'. Ответ: {json.dumps(response_data, ensure_ascii=False)}")
+
+    # 6. Обновляем наш заказ, записывая ID из API
+    with conn.cursor() as cur:
+        cur.execute("UPDATE orders SET api_order_id = %s WHERE id = %s", (api_order_id, ctx.order_id))
+    conn.commit()
+    ctx.log(f"Заказ в API успешно создан с ID: {api_order_id}.")
+
+
+@workflow_step('create_suborder_request', 'Создать запрос')
+def create_suborder_request(ctx, conn):
+    api_order_id = _require_api_order_id(conn, ctx.order_id)
+
+    api_payload = {"order_id": int(api_order_id)}
+    response = ctx.api('POST', '/psp/suborders/create', json=api_payload, timeout=30)
+    ctx.log(f"Запрос на получение кодов: статус ответа {response.status_code}")
+    _raise_for_status(ctx, response)
+
+    # Обновляем статус заказа в любом случае, если запрос прошел успешно (статус 2xx)
+    with conn.cursor() as cur:
+        cur.execute("UPDATE orders SET api_status = 'Запрос создан' WHERE id = %s", (ctx.order_id,))
+    conn.commit()
+    ctx.log('Запрос на получение кодов успешно отправлен. Статус заказа обновлен на "Запрос создан".')
+
+
+@workflow_step('split_runs', 'Разбить на тиражи')
+def split_runs(ctx, conn):
+    api_order_id = _require_api_order_id(conn, ctx.order_id)
+
+    # --- Шаг 1: Собираем данные из нашей БД в DataFrame ---
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(
+            "SELECT id, gtin, dm_quantity, production_date, api_id FROM dmkod_aggregation_details WHERE order_id = %s ORDER BY id",
+            (ctx.order_id,)
+        )
+        details_data = cur.fetchall()
+    if not details_data:
+        raise Exception("В заказе нет детализации для создания тиражей.")
+    details_df = pd.DataFrame(details_data)
+
+    # --- Шаг 2: Получение деталей заказа из API и обогащение DataFrame ---
+    response_get = ctx.api('GET', '/psp/orders', json={"order_id": api_order_id}, timeout=30)
+    _raise_for_status(ctx, response_get)
+    order_details_from_api = response_get.json()
+
+    if not order_details_from_api.get('orders'):
+        raise Exception("API не вернуло информацию о заказе.")
+
+    api_products = order_details_from_api['orders'][0].get('products', [])
+    if not api_products:
+        raise Exception("API не вернуло список продуктов в заказе.")
+
+    # Словарь для поиска api_product_id по gtin с учетом условий: state=ACTIVE и qty=qty_received
+    gtin_to_api_product_id = {}
+    for p in api_products:
+        if p.get('state') == 'ACTIVE' and p.get('qty') == p.get('qty_received'):
+            gtin_to_api_product_id[p['gtin']] = p['id']
+    details_df['api_product_id'] = details_df['gtin'].map(gtin_to_api_product_id)
+    logging.debug(f"[workflow job {ctx.job_id}] details_df:\n{details_df.to_string()}")
+
+    # --- Шаг 3: Обновление/добавление названий товаров ---
+    products_to_upsert = [{'gtin': p['gtin'], 'name': p['name']} for p in api_products if p.get('name')]
+    if products_to_upsert:
+        with conn.cursor() as cur:
+            upsert_data_to_db(cur, 'TABLE_PRODUCTS', pd.DataFrame(products_to_upsert), 'gtin')
+        conn.commit()
+
+    # --- Шаг 4: Параллельное создание тиражей и обновление api_id ---
+    ctx.log(f"Начинаю создание тиражей для {len(details_df)} позиций заказа.")
+    rows_to_create = []
+    for i, row in details_df.iterrows():
+        if pd.isna(row.get('api_product_id')):
+            log_msg = f"Пропуск строки {i+1}/{len(details_df)} (gtin: {row['gtin']}), т.к. не найден api_product_id."
+            logging.warning(log_msg)
+            ctx.log(log_msg)
+            continue
+        # Пропускаем строки, для которых тираж уже был создан ранее (в том числе в прошлой попытке)
+        if pd.notna(row.get('api_id')):
+            ctx.log(f"Пропуск строки {i+1}/{len(details_df)} (gtin: {row['gtin']}), так как тираж (api_id: {row['api_id']}) уже существует.")
+            continue
+        rows_to_create.append((i, row))
+
+    if rows_to_create:
+        # Ключ идемпотентности сохраняется до отправки запроса и не меняется между попытками:
+        # повтор после таймаута вернет уже созданный тираж, а не создаст второй.
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE dmkod_aggregation_details SET tirage_request_key = gen_random_uuid()::text
+                WHERE id = ANY(%s) AND tirage_request_key IS NULL
+                """,
+                ([int(row['id']) for _, row in rows_to_create],)
+            )
+            cur.execute(
+                "SELECT id, tirage_request_key FROM dmkod_aggregation_details WHERE id = ANY(%s)",
+                ([int(row['id']) for _, row in rows_to_create],)
+            )
+            request_keys = dict(cur.fetchall())
+        conn.commit()
+
+        def create_tirage(i, row):
+            tirage_payload = {
+                "order_product_id": int(row['api_product_id']),
+                "qty": int(row['dm_quantity'])
+            }
+            response_post = ctx.api('POST', '/psp/printrun/create', json=tirage_payload, timeout=30,
+                                    headers={'Idempotency-Key': request_keys[int(row['id'])]}, idempotent=True)
+            _raise_for_status(ctx, response_post)
+            response_data = response_post.json()
+            ctx.log(f"--- Тираж {i+1}/{len(details_df)} (GTIN: {row['gtin']}, Кол-во: {row['dm_quantity']}): "
+                    f"ответ {response_post.status_code}, тело: {json.dumps(response_data)}")
+            new_printrun_id = response_data.get('printrun_id')
+            if not new_printrun_id:
+                raise Exception(f"API не вернуло 'printrun_id' в ответе на создание тиража. Ответ: {json.dumps(response_data)}")
+            return new_printrun_id
+
+        first_error = None
+        concurrency = min(TIRAGE_CREATE_CONCURRENCY, len(rows_to_create))
+        ctx.log(f"Создание {len(rows_to_create)} тиражей, одновременно до {concurrency} запросов.")
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f'tirage-{ctx.job_id}') as executor:
+            futures = {executor.submit(create_tirage, i, row): row for i, row in rows_to_create}
+            for future in as_completed(futures):
+                row = futures[future]
+                try:
+                    new_printrun_id = future.result()
+                except Exception as e:
+                    # Остальные запросы дорабатывают, их результаты сохраняются; шаг завершится первой ошибкой
+                    ctx.log(f"  Ошибка создания тиража для позиции ID {row['id']} (gtin: {row['gtin']}): {e}")
+                    first_error = first_error or e
+                    continue
+                # Фиксируем api_id сразу, чтобы при повторе шага этот тираж не создавался снова.
+                # Коды прежнего тиража строки (если были) к новому не относятся.
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "UPDATE dmkod_aggregation_details SET api_id = %s, api_codes_json = NULL WHERE id = %s",
+                        (new_printrun_id, int(row['id']))
+                    )
+                conn.commit()
+                ctx.log(f"  ID тиража {new_printrun_id} присвоен позиции заказа (ID: {row['id']}) в базе данных.")
+        if first_error is not None:
+            raise first_error
+
+    # --- Шаг 5: Обновление статуса заказа ---
+    with conn.cursor() as cur:
+        cur.execute("UPDATE orders SET api_status = 'Тиражи созданы' WHERE id = %s", (ctx.order_id,))
+    conn.commit()
+    ctx.log('Тиражи успешно созданы в API.')
+
+
+def _done_printruns(ctx, key):
+    """Тиражи, по которым запрос уже выполнен предыдущими попытками задания (список в ctx.result[key])."""
+    return set(ctx.result.setdefault(key, []))
+
+
+def _mark_printrun_done(ctx, key, printrun_id):
+    ctx.result[key].append(printrun_id)
+    ctx.save_progress()
+
+
+def _details_with_printrun(conn, order_id, purpose):
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(
+            "SELECT id, api_id, gtin FROM dmkod_aggregation_details WHERE order_id = %s AND api_id IS NOT NULL ORDER BY id",
+            (order_id,)
+        )
+        details = cur.fetchall()
+    if not details:
+        raise Exception(f"Не найдено позиций с ID тиража (api_id) для {purpose}.")
+    return details
+
+
+@workflow_step('prepare_json', 'Подготовить JSON')
+def prepare_json(ctx, conn):
+    _require_api_order_id(conn, ctx.order_id)
+    details_to_process = _details_with_printrun(conn, ctx.order_id, 'обработки')
+    ctx.log(f"Найдено {len(details_to_process)} позиций для обработки.")
+    done = _done_printruns(ctx, 'json_requested')
+
+    for i, detail in enumerate(details_to_process):
+        if detail['api_id'] in done:
+            ctx.log(f"--- {i+1}/{len(details_to_process)}: JSON для тиража {detail['api_id']} уже запрошен предыдущей попыткой, пропуск ---")
+            continue
+        payload = {"printrun_id": detail['api_id']}
+        ctx.log(f"--- {i+1}/{len(details_to_process)}: Отправка запроса для GTIN {detail['gtin']} (ID тиража: {detail['api_id']}) ---")
+        response = ctx.api('POST', '/psp/printrun/json/create', json=payload, timeout=30)
+        ctx.log(f"  Статус ответа: {response.status_code}")
+        _raise_for_status(ctx, response)
+        _mark_printrun_done(ctx, 'json_requested', detail['api_id'])
+        # Небольшая пауза, чтобы API успело обработать запрос
+        time.sleep(0.5)
+
+    with conn.cursor() as cur:
+        cur.execute("UPDATE orders SET api_status = 'JSON заказан' WHERE id = %s", (ctx.order_id,))
+    conn.commit()
+    ctx.log('Статус заказа обновлен на "JSON заказан".')
+
+
+@workflow_step('download_codes', 'Скачать коды')
+def download_codes(ctx, conn):
+    _require_api_order_id(conn, ctx.order_id)
+    details_to_process = _details_with_printrun(conn, ctx.order_id, 'скачивания кодов')
+    # Коды тиража не меняются, а строка сохраняется целиком в одной транзакции - скачанные строки пропускаем
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT id FROM dmkod_aggregation_details WHERE order_id = %s AND api_codes_json IS NOT NULL",
+            (ctx.order_id,)
+        )
+        downloaded_ids = {row[0] for row in cur.fetchall()}
+    ctx.log(f"Найдено {len(details_to_process)} позиций для скачивания кодов, уже скачано: {len(downloaded_ids)}.")
+
+    total_codes = 0
+    for i, detail in enumerate(details_to_process):
+        if detail['id'] in downloaded_ids:
+            ctx.log(f"--- {i+1}/{len(details_to_process)}: Коды тиража {detail['api_id']} уже скачаны, пропуск ---")
+            continue
+        payload = {"printrun_id": detail['api_id']}
+        ctx.log(f"--- {i+1}/{len(details_to_process)}: Запрос кодов для GTIN {detail['gtin']} (ID тиража: {detail['api_id']}) ---")
+        response = ctx.api('GET', '/psp/printrun/json/download', json=payload, timeout=60, stream=True)
+        with response:
+            ctx.log(f"  Статус ответа: {response.status_code}")
+            _raise_for_status(ctx, response)
+            try:
+                codes_count = _store_codes_stream(conn, detail['id'], response.iter_content(DOWNLOAD_CHUNK_SIZE))
+            except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError) as e:
+                conn.rollback()
+                raise TransientStepError(f"Обрыв соединения при скачивании кодов тиража {detail['api_id']}: {e}") from e
+
+        if not codes_count:
+            conn.rollback()
+            ctx.log(f"  В ответе для тиража {detail['api_id']} не найдено кодов.")
+            continue
+        conn.commit()
+        total_codes += codes_count
+        ctx.log(f"  Сохранено {codes_count} кодов в базу данных для строки ID {detail['id']}.")
+
+    with conn.cursor() as cur:
+        cur.execute("UPDATE orders SET api_status = 'Коды скачаны' WHERE id = %s", (ctx.order_id,))
+    conn.commit()
+    ctx.result['codes_archive'] = True
+    ctx.log(f"Коды успешно скачаны: в этом запуске {total_codes}. Архив доступен для скачивания на странице интеграции.")
+
+
+def _store_codes_stream(conn, detail_id, chunks):
+    """
+    Разбирает ответ с кодами тиража по мере поступления и пакетами пишет коды во временную таблицу,
+    затем собирает из нее api_codes_json строки детализации одним запросом на стороне БД.
+    Весь ответ в памяти не держится. Транзакцию фиксирует вызывающий. Возвращает число кодов.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS download_codes_batch (
+                position INTEGER NOT NULL,
+                code JSONB NOT NULL
+            ) ON COMMIT DELETE ROWS;
+        """)
+        cur.execute("TRUNCATE download_codes_batch")
+
+        codes_count = 0
+        batch = []
+        for code in iter_json_array(chunks, 'codes'):
+            batch.append((codes_count, json.dumps(code)))
+            codes_count += 1
+            if len(batch) >= CODES_WRITE_BATCH_SIZE:
+                execute_values(cur, "INSERT INTO download_codes_batch (position, code) VALUES %s", batch, page_size=len(batch))
+                batch = []
+        if batch:
+            execute_values(cur, "INSERT INTO download_codes_batch (position, code) VALUES %s", batch, page_size=len(batch))
+
+        if codes_count:
+            cur.execute(
+                """
+                UPDATE dmkod_aggregation_details
+                SET api_codes_json = jsonb_build_object(
+                    'codes', (SELECT jsonb_agg(code ORDER BY position) FROM download_codes_batch)
+                )
+                WHERE id = %s
+                """,
+                (detail_id,)
+            )
+    return codes_count
+
+
+def _prepare_delta_report_data(ctx, conn):
+    """Отправка сведений о нанесении по данным, загруженным из файла "Дельта"."""
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        # Порядковый номер записи среди всех записей заказа дает стабильный сгенерированный ID загрузки
+        cur.execute(
+            """
+            SELECT id, printrun_id, codes_json, utilisation_upload_id, ROW_NUMBER() OVER (ORDER BY id) AS position
+            FROM delta_result WHERE order_id = %s
+            ORDER BY id
+            """,
+            (ctx.order_id,)
+        )
+        all_results = cur.fetchall()
+    results_to_process = [r for r in all_results if r['utilisation_upload_id'] is None]
+
+    if not results_to_process:
+        ctx.log("Все ранее загруженные сведения от 'Дельта' уже подготовлены и отправлены в API."
+                if all_results else "Нет данных от 'Дельта' для подготовки сведений.")
+        return
+
+    ctx.log(f"Найдено {len(results_to_process)} записей от 'Дельта' для обработки.")
+    for i, result in enumerate(results_to_process):
+        payload = result['codes_json']  # JSON уже готов
+        ctx.log(f"--- {i+1}/{len(results_to_process)}: Отправка данных для тиража ID {result['printrun_id']} (запись #{result['id']}) ---")
+
+        # Если в JSON есть ключ 'attributes', используем /psp/utilisation/upload, иначе /psp/utilisation/upload/include
+        path = '/psp/utilisation/upload' if 'attributes' in payload else '/psp/utilisation/upload/include'
+        response = ctx.api('POST', path, json=payload, timeout=120)
+        ctx.log(f"  Статус ответа: {response.status_code}")
+        _raise_for_status(ctx, response)
+
+        # Генерируем собственный ID вместо получения из API: (ID заказа * 1000) + порядковый номер записи
+        generated_upload_id = (ctx.order_id * 1000) + result['position']
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE delta_result SET utilisation_upload_id = %s WHERE id = %s",
+                (generated_upload_id, result['id'])
+            )
+        conn.commit()
+        ctx.log(f"  Записи ID {result['id']} присвоен сгенерированный ID: {generated_upload_id}")
+
+    with conn.cursor() as cur:
+        cur.execute("UPDATE orders SET api_status = 'Сведения подготовлены' WHERE id = %s", (ctx.order_id,))
+    conn.commit()
+    ctx.log(f"Успешно обработано {len(results_to_process)} записей. Сведения подготовлены.")
+
+
+@workflow_step('prepare_report_data', 'Подготовить сведения')
+def prepare_report_data(ctx, conn):
+    _require_api_order_id(conn, ctx.order_id)
+    with conn.cursor() as cur:
+        cur.execute("SELECT status FROM orders WHERE id = %s", (ctx.order_id,))
+        order_status = cur.fetchone()[0]
+    if order_status == 'delta':
+        _prepare_delta_report_data(ctx, conn)
+        return
+
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(
+            """
+            SELECT
+                d.api_id, d.gtin, d.production_date, d.expiry_date, d.utilisation_upload_id,
+                o.fias_code,
+                d.id as detail_id,
+                ROW_NUMBER() OVER (ORDER BY d.id) AS position
+            FROM dmkod_aggregation_details d
+            JOIN orders o ON d.order_id = o.id
+            WHERE d.order_id = %s AND d.api_id IS NOT NULL
+            ORDER BY d.id
+            """,
+            (ctx.order_id,)
+        )
+        details_to_process = [d for d in cur.fetchall() if d['utilisation_upload_id'] is None]
+
+    if not details_to_process:
+        ctx.log("Все сведения для данного заказа уже были подготовлены и отправлены в API.")
+        return
+
+    ctx.log(f"Найдено {len(details_to_process)} позиций для подготовки сведений.")
+    for i, detail in enumerate(details_to_process):
+        attributes = {}
+        if detail.get('production_date'):
+            attributes['production_date'] = detail['production_date'].strftime('%Y-%m-%d')
+        if detail.get('expiry_date'):
+            attributes['expiration_date'] = detail['expiry_date'].strftime('%Y-%m-%d')
+        if detail.get('fias_code'):
+            attributes['fias_id'] = detail['fias_code']
+
+        payload = {"all_from_printrun": detail['api_id']}
+        if attributes:
+            payload['attributes'] = attributes
+
+        ctx.log(f"--- {i+1}/{len(details_to_process)}: Отправка запроса для GTIN {detail['gtin']} (ID тиража: {detail['api_id']}) ---")
+        ctx.log(f"  Тело: {json.dumps(payload)}")
+        response = ctx.api('POST', '/psp/utilisation/upload', json=payload, timeout=240)
+        ctx.log(f"  Статус ответа: {response.status_code}")
+        _raise_for_status(ctx, response)
+
+        # Генерируем собственный ID вместо получения из API: (ID заказа * 1000) + порядковый номер тиража.
+        # Фиксируем сразу, чтобы при повторе шага сведения по этому тиражу не отправлялись снова.
+        generated_upload_id = (ctx.order_id * 1000) + detail['position']
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE dmkod_aggregation_details SET utilisation_upload_id = %s WHERE id = %s",
+                (generated_upload_id, detail['detail_id'])
+            )
+        conn.commit()
+        ctx.log(f"  Записи детализации ID {detail['detail_id']} присвоен сгенерированный ID: {generated_upload_id}")
+
+    # Обновляем статус заказа только после успешной обработки всех позиций
+    with conn.cursor() as cur:
+        cur.execute("UPDATE orders SET api_status = 'Сведения подготовлены' WHERE id = %s", (ctx.order_id,))
+    conn.commit()
+    ctx.log('Операция "Подготовить сведения" успешно выполнена.')
+
+
+@workflow_step('prepare_report', 'Подготовить отчет')
+def prepare_report(ctx, conn):
+    _require_api_order_id(conn, ctx.order_id)
+    details_to_process = _details_with_printrun(conn, ctx.order_id, 'подготовки отчета')
+    ctx.log(f"Найдено {len(details_to_process)} позиций для подготовки отчета.")
+    done = _done_printruns(ctx, 'report_requested')
+
+    for i, detail in enumerate(details_to_process):
+        if detail['api_id'] in done:
+            ctx.log(f"--- {i+1}/{len(details_to_process)}: Отчет по тиражу {detail['api_id']} уже запрошен предыдущей попыткой, пропуск ---")
+            continue
+        payload = {"printrun_id": detail['api_id']}
+        ctx.log(f"--- {i+1}/{len(details_to_process)}: Отправка запроса для GTIN {detail['gtin']} (ID тиража: {detail['api_id']}) ---")
+        response = ctx.api('POST', '/psp/utilisation/report/create', json=payload, timeout=120)
+        ctx.log(f"  Статус ответа: {response.status_code}")
+        _raise_for_status(ctx, response)
+        _mark_printrun_done(ctx, 'report_requested', detail['api_id'])
+
+    with conn.cursor() as cur:
+        cur.execute("UPDATE orders SET api_status = 'Отчет подготовлен' WHERE id = %s", (ctx.order_id,))
+    conn.commit()
+    ctx.log('Операция "Подготовить отчет" успешно выполнена. Статус заказа обновлен.')
@@ -0,0 +1,101 @@
+# dmkod-integration-app/app/json_stream.py
+"""
+Потоковый разбор больших JSON-ответов API без загрузки всего документа в память.
+
+Ответ вида {"codes": ["...", "...", ...], ...} читается по частям (например, из response.iter_content),
+элементы нужного массива возвращаются по одному, по мере поступления данных.
+Остальные значения верхнего уровня разбираются целиком и пропускаются - они небольшие.
+"""
+import codecs
+import json
+
+_WHITESPACE = ' \t\n\r'
+_NUMBER_CHARS = '0123456789.eE+-'
+_decoder = json.JSONDecoder()
+
+
+class _Reader:
+    """Буфер над потоком байтовых фрагментов. Прочитанная часть буфера отбрасывается."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.exhausted = False
+
+    def read_more(self):
+        if self.exhausted:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self.buffer = self.buffer[self.pos:] + self._utf8.decode(b'', final=True)
+            self.exhausted = True
+        else:
+            self.buffer = self.buffer[self.pos:] + self._utf8.decode(chunk)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Следующий значимый символ (пробелы пропускаются) или '' в конце потока."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                return ''
+
+    def expect(self, char):
+        found = self.peek()
+        if not found:
+            raise ValueError("JSON-ответ оборвался до конца документа")
+        if found != char:
+            raise ValueError(f"Ожидался символ '{char}' в позиции {self.pos} JSON-ответа")
+        self.pos += 1
+
+    def value(self):
+        """Разбирает очередное JSON-значение целиком, дочитывая поток, пока значение не будет полным."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.read_more():
+                    continue
+                raise
+            # Число, оборванное на границе фрагмента ("15" из "1500", "1." из "1.5e3"), разбирается заново
+            if (end == len(self.buffer) or self.buffer[end] in _NUMBER_CHARS) and self.read_more():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_array(chunks, key):
+    """
+    Возвращает по одному элементы массива `key` из JSON-объекта, поступающего фрагментами байтов `chunks`.
+    Если ключа нет (или его значение - не массив), не возвращает ничего.
+    """
+    reader = _Reader(chunks)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name == key and reader.peek() == '[':
+            reader.pos += 1
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.peek() == ']':
+                        reader.pos += 1
+                        break
+                    reader.expect(',')
+        else:
+            reader.value()
+        if reader.peek() == '}':
+            return
+        reader.expect(',')
@@ -7,6 +7,7 @@ from flask_wtf.csrf import CSRFProtect
 
 # --- Импорты из нашего приложения ---
 from .auth import login_manager
+from . import db
 from .routes import dmkod_bp
 
 def create_app():
@@ -37,6 +38,9 @@ def create_app():
     CSRFProtect(app)
     logging.debug("Flask-Login and CSRFProtect initialized.")
 
+    # Пул соединений с БД: одно соединение на запрос, возврат в пул по завершении запроса
+    db.init_app(app)
+
     # Регистрация Blueprint с маршрутами
     app.register_blueprint(dmkod_bp, url_prefix='/dmkod')
     logging.debug("Blueprint 'dmkod_bp' registered with prefix '/dmkod'.")
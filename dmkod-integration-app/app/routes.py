@@ -3,56 +3,46 @@ import requests
 import json
 from functools import wraps
 import logging
-import time
 import pandas as pd # Уже импортирован
 import re
 import math
+from collections import defaultdict
 from dateutil.relativedelta import relativedelta
-from flask import Blueprint, render_template, redirect, url_for, flash, request, session, Response, send_file
+from flask import Blueprint, render_template, redirect, url_for, flash, request, session, Response, send_file, stream_with_context, jsonify
 from flask_login import login_user, logout_user, login_required, current_user
 from psycopg2 import sql
 from dateutil.relativedelta import relativedelta
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 from bcrypt import checkpw
-from io import BytesIO, StringIO
+from io import BytesIO
 
 from .db import get_db_connection
 from .forms import LoginForm, IntegrationForm, ProductGroupForm
 from .auth import User
-
-# --- ИСПРАВЛЕННАЯ ФУНКЦИЯ: Полная копия из datamatrix-app ---
-GS_SEPARATOR = '\x1d'
-def parse_datamatrix(dm_string: str) -> dict:
-    """Разбирает (парсит) строку DataMatrix на составные части."""
-    result = {
-        'datamatrix': dm_string, 'gtin': '', 'serial': '',
-        'crypto_part_91': '', 'crypto_part_92': '', 'crypto_part_93': ''
-    }
-    cleaned_dm = dm_string.replace(' ', '\x1d').strip()
-    parts = cleaned_dm.split(GS_SEPARATOR)
-    if len(parts) > 0:
-        main_part = parts.pop(0)
-        if main_part.startswith('01'):
-            result['gtin'] = main_part[2:16]
-            serial_part = main_part[16:]
-            if serial_part.startswith('21'):
-                # Убираем возможный GS в конце серийного номера
-                result['serial'] = serial_part[2:].split(GS_SEPARATOR)[0]
-
-    for part in parts:
-        if not part: continue
-        if part.startswith('91'): result['crypto_part_91'] = part[2:]
-        elif part.startswith('92'): result['crypto_part_92'] = part[2:]
-        elif part.startswith('93'): result['crypto_part_93'] = part[2:]
-    return result
+from .delta_import import parse_datamatrix_series, map_parent_sscc, build_delta_payloads
+from .file_store import save_order_file, get_file_path, delete_unreferenced_files
+from .api_cache import api_cache
+from .workflow import enqueue_step, get_job, get_latest_job, job_to_dict, step_title, WorkflowBusyError
+from . import integration_steps  # noqa: F401  (регистрация шагов интеграции)
 
 # 1. Определяем Blueprint
 import zipfile # Добавляем импорт для работы с ZIP-архивами
+import tempfile
 dmkod_bp = Blueprint(
     'dmkod_integration_app', __name__,
     static_folder='static'
 )
 
+def _cleanup_stored_files(conn, checksums):
+    """Убирает из хранилища файлы без строк в dmkod_order_files; сбой очистки оставляет лишь лишние файлы."""
+    if not checksums:
+        return
+    try:
+        delete_unreferenced_files(conn, checksums)
+    except Exception as e:
+        conn.rollback()
+        logging.error(f"Не удалось удалить файлы из хранилища {checksums}: {e}")
+
 def _sanitize_filename_part(text):
     """
     Sanitizes a string to be safe for use as part of a filename.
@@ -68,6 +58,67 @@ def _sanitize_filename_part(text):
     sanitized = sanitized.strip('_.')
     return sanitized
 
+# Коды заказа для выгрузки "Дельта": массив api_codes_json->'codes' разворачивается на стороне БД,
+# коды короче 16 символов (без GTIN) отбрасываются.
+DELTA_EXPORT_CODES_FROM = """
+    FROM dmkod_aggregation_details d
+    CROSS JOIN LATERAL jsonb_array_elements_text(d.api_codes_json->'codes') AS c(code)
+    WHERE d.order_id = %s
+      AND jsonb_typeof(d.api_codes_json->'codes') = 'array'
+      AND length(c.code) >= 16
+"""
+# Сколько строк курсор забирает с сервера за один раз и сколько строк уходит клиенту одним куском
+DELTA_EXPORT_FETCH_SIZE = 10000
+DELTA_EXPORT_CHUNK_ROWS = 2000
+
+
+def _generate_delta_export(order_id):
+    """
+    Генератор файла "Дельта" (TSV, окончания строк CRLF) для заказа.
+    Коды читаются именованным (серверным) курсором порциями, поэтому память не зависит от размера заказа.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor(name=f'delta_export_{order_id}') as cur:
+            cur.itersize = DELTA_EXPORT_FETCH_SIZE
+            cur.execute(
+                f"SELECT c.code, d.production_date, d.expiry_date {DELTA_EXPORT_CODES_FROM}",
+                (order_id,)
+            )
+            lifetimes = {}
+            chunk = ['DataMatrix\tDataMatrixCode\tBarcode\tLifeTime\r\n']
+            for code, prod_date, exp_date in cur:
+                dates = (prod_date, exp_date)
+                if dates not in lifetimes:
+                    life_time_months = ''
+                    if prod_date and exp_date:
+                        # Считаем разницу в месяцах
+                        delta = relativedelta(exp_date, prod_date)
+                        life_time_months = delta.years * 12 + delta.months
+                    lifetimes[dates] = life_time_months
+                # Barcode - EAN-13 (символы с 4 по 16)
+                chunk.append(f"{code}\t\t{code[3:16]}\t{lifetimes[dates]}\r\n")
+                if len(chunk) >= DELTA_EXPORT_CHUNK_ROWS:
+                    yield ''.join(chunk).encode('utf-8')
+                    chunk = []
+            if chunk:
+                yield ''.join(chunk).encode('utf-8')
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+# Действия панели интеграции, выполняемые в фоне, и сообщение, если заказ еще не создан в API
+WORKFLOW_ACTIONS = {
+    'create_order': None,
+    'create_suborder_request': 'Сначала необходимо создать заказ в API (кнопка "Создать заказ").',
+    'split_runs': 'Сначала необходимо создать заказ в API.',
+    'prepare_json': 'Сначала необходимо создать заказ и разбить его на тиражи.',
+    'download_codes': 'Сначала необходимо создать заказ в API и разбить его на тиражи.',
+    'prepare_report_data': 'Сначала необходимо создать заказ в API и разбить его на тиражи.',
+    'prepare_report': 'Сначала необходимо создать заказ в API и разбить его на тиражи.',
+}
+
 def api_token_required(f):
     """
     Кастомный декоратор, который проверяет наличие 'api_access_token' в сессии.
@@ -111,19 +162,8 @@ def login():
 
         # 2. Если локальная проверка прошла, получаем API токен
         try:
-            api_base_url = os.getenv('API_BASE_URL')
-            # Убираем возможный слэш в конце и корректно соединяем URL
-            token_url = f"{api_base_url.rstrip('/')}/user/token"
-            api_credentials = {
-                "email": os.getenv('API_EMAIL'),
-                "password": os.getenv('API_PASSWORD')
-            }
-            # Используем GET и передаем данные в теле запроса как JSON.
-            # Это нестандартный способ, но требуется для данного API.
-            response = requests.get(token_url, json=api_credentials)
-            response.raise_for_status()  # Вызовет ошибку, если статус ответа не 2xx
-
-            tokens = response.json()
+            # Токен общий для всех пользователей и хранится в Redis, запрос к API - только если он устарел
+            tokens = api_cache.get_tokens()
             session['api_access_token'] = tokens.get('access')
             session['api_refresh_token'] = tokens.get('refresh')
 
@@ -206,25 +246,11 @@ def dashboard():
 def participants():
     """Страница для отображения списка клиентов из API."""
     participants_list = []
-    access_token = session.get('api_access_token')
-    if not access_token:
-        flash('Токен API не найден. Пожалуйста, войдите заново.', 'warning')
-        return redirect(url_for('.login'))
-
     try:
-        api_base_url = os.getenv('API_BASE_URL')
-        # Корректно формируем URL, убирая возможный слэш в конце
-        participants_url = f"{api_base_url.rstrip('/')}/psp/participants"
-        headers = {'Authorization': f'Bearer {access_token}'}
-        response = requests.get(participants_url, headers=headers)
-        response.raise_for_status()
-        # Проверяем, есть ли что-то в ответе перед декодированием
-        if response.text:
-            # Извлекаем список участников из ключа 'participants' в ответе API
-            data = response.json()
-            participants_list = data.get('participants', [])
+        # Список берется из кэша; кнопка "Обновить" (refresh=1) запрашивает его у API заново
+        participants_list = api_cache.get_participants(force_refresh=request.args.get('refresh', type=int) == 1)
     except (requests.exceptions.RequestException, requests.exceptions.JSONDecodeError) as e:
-        error_text = response.text if 'response' in locals() and response.text else str(e)
+        error_text = e.response.text if getattr(e, 'response', None) is not None and e.response.text else str(e)
         flash(f'Не удалось получить список клиентов. Ошибка: {error_text}', 'danger')
 
     # Добавляем загрузку товарных групп из БД
@@ -253,10 +279,11 @@ def api_tester():
         method = request.form.get('method', 'GET').upper()
         body = request.form.get('body')
         
-        access_token = session.get('api_access_token')
-        if not access_token:
-            flash('Токен API не найден. Пожалуйста, войдите заново.', 'warning')
-            return redirect(url_for('.login'))
+        try:
+            access_token = api_cache.get_access_token()
+        except requests.exceptions.RequestException as e:
+            flash(f'Не удалось получить токен API: {e}', 'danger')
+            return render_template('dmkod_api_tester.html', title="Тестировщик API", api_response=api_response, base_url=api_base_url)
             
         full_url = f"{api_base_url}{endpoint}"
         headers = {'Authorization': f'Bearer {access_token}'}
@@ -291,6 +318,96 @@ def api_tester():
 
     return render_template('dmkod_api_tester.html', title="Тестировщик API", api_response=api_response, base_url=api_base_url)
 
+# Поля детализации, которые можно править в таблице на странице редактирования, и их типы в БД
+DETAIL_EDITABLE_COLUMNS = {
+    'gtin': 'varchar',
+    'dm_quantity': 'integer',
+    'aggregation_level': 'smallint',
+    'production_date': 'date',
+    'expiry_date': 'date',
+}
+
+DETAILS_FILE_COLUMNS = {
+    'GTIN': 'gtin',
+    'Кол-во': 'dm_quantity',
+    'Агрегация': 'aggregation_level',
+    'Дата производства': 'production_date',
+    'Срок годности': 'shelf_life_years',
+    'Окончание срока годности': 'expiry_date'
+}
+
+
+def _prepare_details_rows(df, order_id):
+    """
+    Готовит строки детализации (колонки уже переименованы по DETAILS_FILE_COLUMNS) для вставки
+    в dmkod_aggregation_details. Преобразования выполняются над колонками целиком, без обхода строк.
+    """
+    def column(name):
+        if name in df.columns:
+            return df[name]
+        return pd.Series([None] * len(df), index=df.index, dtype=object)
+
+    prod_dates = pd.to_datetime(column('production_date'), errors='coerce')
+    exp_dates = pd.to_datetime(column('expiry_date'), errors='coerce')
+    shelf_life = pd.to_numeric(column('shelf_life_years'), errors='coerce')
+
+    # Окончание срока годности = дата производства + срок годности в годах, если оно не указано явно.
+    # Сдвиг считается отдельно для каждого значения срока (их в файле единицы).
+    needs_expiry = prod_dates.notna() & shelf_life.notna() & exp_dates.isna()
+    shelf_years = shelf_life[needs_expiry].astype(int)
+    for years, index in shelf_years.groupby(shelf_years).groups.items():
+        exp_dates.loc[index] = prod_dates.loc[index] + pd.DateOffset(years=int(years))
+
+    gtins = column('gtin').fillna('').astype(str)
+    quantities = pd.to_numeric(column('dm_quantity'), errors='coerce').fillna(0).astype(int)
+    levels = pd.to_numeric(column('aggregation_level'), errors='coerce').fillna(0).astype(int)
+    prod_dates = prod_dates.dt.date.astype(object).where(prod_dates.notna(), None)
+    exp_dates = exp_dates.dt.date.astype(object).where(exp_dates.notna(), None)
+
+    return list(zip(
+        [order_id] * len(df), gtins.tolist(), quantities.tolist(), levels.tolist(),
+        prod_dates.tolist(), exp_dates.tolist()
+    ))
+
+
+def _insert_details(cur, details_to_insert):
+    """Вставляет строки детализации одним запросом."""
+    if details_to_insert:
+        execute_values(
+            cur,
+            "INSERT INTO dmkod_aggregation_details (order_id, gtin, dm_quantity, aggregation_level, production_date, expiry_date) VALUES %s",
+            details_to_insert,
+            page_size=len(details_to_insert)
+        )
+
+
+def _update_details(cur, order_id, changes):
+    """
+    Применяет правки таблицы детализации {id: {поле: значение}} одним UPDATE ... FROM (VALUES ...).
+    Строки с разным набором полей (форма обычно присылает все поля) обновляются отдельными запросами.
+    """
+    rows_by_columns = defaultdict(list)
+    for detail_id, fields in changes.items():
+        columns = tuple(column for column in DETAIL_EDITABLE_COLUMNS if column in fields)
+        rows_by_columns[columns].append((detail_id, *(fields[column] for column in columns)))
+
+    for columns, rows in rows_by_columns.items():
+        query = sql.SQL("""
+            UPDATE dmkod_aggregation_details AS d SET {assignments}
+            FROM (VALUES %s) AS v (id, {columns})
+            WHERE d.id = v.id AND d.order_id = {order_id}
+        """).format(
+            assignments=sql.SQL(', ').join(
+                sql.SQL("{} = v.{}").format(sql.Identifier(column), sql.Identifier(column)) for column in columns
+            ),
+            columns=sql.SQL(', ').join(map(sql.Identifier, columns)),
+            order_id=sql.Literal(order_id)
+        )
+        # Явные типы нужны, т.к. значения из формы приходят строками
+        template = '(' + ', '.join(['%s::integer'] + [f'%s::{DETAIL_EDITABLE_COLUMNS[column]}' for column in columns]) + ')'
+        execute_values(cur, query.as_string(cur), rows, template=template, page_size=len(rows))
+
+
 @dmkod_bp.route('/integration/new', methods=['GET', 'POST'])
 @login_required
 @api_token_required
@@ -302,18 +419,10 @@ def create_integration():
     # --- Заполняем выпадающие списки ---
     # 1. Клиенты из API
     participants_list = []
-    access_token = session.get('api_access_token')
-    if access_token:
-        try:
-            api_base_url = os.getenv('API_BASE_URL')
-            participants_url = f"{api_base_url.rstrip('/')}/psp/participants"
-            headers = {'Authorization': f'Bearer {access_token}'}
-            response = requests.get(participants_url, headers=headers)
-            response.raise_for_status()
-            if response.text:
-                participants_list = response.json().get('participants', [])
-        except (requests.exceptions.RequestException, requests.exceptions.JSONDecodeError) as e:
-            flash(f'Не удалось загрузить список клиентов из API: {e}', 'warning')
+    try:
+        participants_list = api_cache.get_participants()
+    except (requests.exceptions.RequestException, requests.exceptions.JSONDecodeError) as e:
+        flash(f'Не удалось загрузить список клиентов из API: {e}', 'warning')
     form.client_id.choices = [(p['id'], p['name']) for p in participants_list]
 
     # 2. Товарные группы из нашей БД
@@ -342,6 +451,7 @@ def create_integration():
             return render_template('dmkod_create_integration.html', title="Создание новой интеграции", form=form, product_groups_data=product_groups)
         # --- Конец валидации ---
 
+        stored_checksums = []
         try:
             # Получаем имя клиента по ID
             client_name = dict(form.client_id.choices).get(form.client_id.data)
@@ -358,12 +468,9 @@ def create_integration():
                 )
                 order_id = cur.fetchone()['id']
 
-                # 2. Сохраняем файл в 'dmkod_order_files'
+                # 2. Сохраняем файл в хранилище, в 'dmkod_order_files' - только метаданные
                 file = form.xls_file.data
-                cur.execute(
-                    "INSERT INTO dmkod_order_files (order_id, filename, file_data) VALUES (%s, %s, %s)",
-                    (order_id, file.filename, file.read())
-                )
+                save_order_file(cur, order_id, file.filename, file.stream, stored_checksums)
 
                 # 3. Обрабатываем и сохраняем файл с детализацией, если он есть
                 details_file = form.details_file.data
@@ -372,14 +479,7 @@ def create_integration():
                         # Указываем dtype={'GTIN': str}, чтобы pandas не обрезал ведущие нули
                         df = pd.read_excel(details_file, dtype={'GTIN': str})
                         # Переименовываем колонки для удобства
-                        df.rename(columns={
-                            'GTIN': 'gtin',
-                            'Кол-во': 'dm_quantity',
-                            'Агрегация': 'aggregation_level',
-                            'Дата производства': 'production_date',
-                            'Срок годности': 'shelf_life_years',
-                            'Окончание срока годности': 'expiry_date'
-                        }, inplace=True)
+                        df.rename(columns=DETAILS_FILE_COLUMNS, inplace=True)
 
                         # --- НОВАЯ ЛОГИКА: Группировка и суммирование ---
                         # Преобразуем dm_quantity в числовой тип, обрабатывая возможные ошибки
@@ -394,37 +494,8 @@ def create_integration():
                             'expiry_date': 'first'
                         }).reset_index()
 
-                        details_to_insert = []
-                        # Теперь итерируемся по сгруппированному DataFrame
-                        for index, row in aggregated_df.iterrows():
-                            prod_date = pd.to_datetime(row.get('production_date'), errors='coerce')
-                            exp_date = pd.to_datetime(row.get('expiry_date'), errors='coerce')
-                            shelf_life = pd.to_numeric(row.get('shelf_life_years'), errors='coerce')
-                        
-                            # Логика расчета срока годности
-                            if pd.notna(prod_date) and pd.notna(shelf_life) and pd.isna(exp_date):
-                                exp_date = prod_date + relativedelta(years=int(shelf_life))
-                        
-                            details_to_insert.append((
-                                order_id,
-                                str(row.get('gtin', '')),
-                                int(row.get('dm_quantity', 0)),
-                                # --- ИСПРАВЛЕННАЯ ЛОГИКА ---
-                                # Сначала преобразуем в число, обрабатывая ошибки. Результатом может быть float или NaN.
-                                # Затем используем fillna, если это необходимо (если результат - Series/NaN).
-                                # И только потом преобразуем в int.
-                                int(pd.to_numeric(row.get('aggregation_level'), errors='coerce') or 0),
-                                # Старый код: int(pd.to_numeric(row.get('aggregation_level'), errors='coerce', downcast='integer').fillna(0)),
-                                # --------------------------
-                                None if pd.isna(prod_date) else prod_date.date(),
-                                None if pd.isna(exp_date) else exp_date.date()
-                            ))
-
                         # Массовая вставка в dmkod_aggregation_details
-                        if details_to_insert:
-                            from psycopg2.extras import execute_values
-                            insert_query = "INSERT INTO dmkod_aggregation_details (order_id, gtin, dm_quantity, aggregation_level, production_date, expiry_date) VALUES %s"
-                            execute_values(cur, insert_query, details_to_insert)
+                        _insert_details(cur, _prepare_details_rows(aggregated_df, order_id))
 
                     except Exception as e:
                         raise Exception(f"Ошибка при обработке файла детализации: {e}")
@@ -434,6 +505,8 @@ def create_integration():
             return redirect(url_for('.dashboard'))
         except Exception as e:
             conn.rollback()
+            # Файл уже записан в хранилище, а строка о нем откатилась
+            _cleanup_stored_files(conn, stored_checksums)
             flash(f'Произошла ошибка при создании интеграции: {e}', 'danger')
         finally:
             conn.close()
@@ -476,74 +549,26 @@ def edit_integration(order_id):
                         # 2. Затем загружаем новые (логика скопирована из create_integration)
                         # Указываем dtype={'GTIN': str}, чтобы pandas не обрезал ведущие нули
                         df = pd.read_excel(details_file, dtype={'GTIN': str})
-                        df.rename(columns={
-                            'GTIN': 'gtin', 'Кол-во': 'dm_quantity', 'Агрегация': 'aggregation_level',
-                            'Дата производства': 'production_date', 'Срок годности': 'shelf_life_years',
-                            'Окончание срока годности': 'expiry_date'
-                        }, inplace=True)
-
-                        details_to_insert = []
-                        for index, row in df.iterrows():
-                            prod_date = pd.to_datetime(row.get('production_date'), errors='coerce')
-                            exp_date = pd.to_datetime(row.get('expiry_date'), errors='coerce')
-                            shelf_life = pd.to_numeric(row.get('shelf_life_years'), errors='coerce')
-
-                            if pd.notna(prod_date) and pd.notna(shelf_life) and pd.isna(exp_date):
-                                exp_date = prod_date + relativedelta(years=int(shelf_life))
-
-                            details_to_insert.append((
-                                order_id, str(row.get('gtin', '')), int(row.get('dm_quantity', 0)),
-                                int(row.get('aggregation_level', 0)),
-                                None if pd.isna(prod_date) else prod_date.date(),
-                                None if pd.isna(exp_date) else exp_date.date()
-                            ))
-                        
-                        if details_to_insert:
-                            insert_query = sql.SQL("""
-                                INSERT INTO dmkod_aggregation_details (order_id, gtin, dm_quantity, aggregation_level, production_date, expiry_date) 
-                                VALUES {}
-                            """).format(sql.SQL(',').join(map(sql.Literal, details_to_insert)))
-                            cur.execute(insert_query)
-                        
+                        df.rename(columns=DETAILS_FILE_COLUMNS, inplace=True)
+
+                        details_to_insert = _prepare_details_rows(df, order_id)
+                        _insert_details(cur, details_to_insert)
+
                         flash(f'Детализация заказа успешно заменена. Загружено {len(details_to_insert)} строк.', 'success')
 
                 elif action == 'save_table_changes':
-                    updates = []
+                    # Ищем ключи вида "gtin-123", "dm_quantity-123" и собираем изменения по строкам
+                    changes = defaultdict(dict)
                     for key, value in request.form.items():
-                        # Ищем ключи вида "gtin-123", "dm_quantity-123" и т.д.
-                        if '-' in key:
-                            try:
-                                field, detail_id_str = key.split('-', 1)
-                            except ValueError:
-                                continue # Пропускаем ключи, которые не соответствуют формату
-
-                            if detail_id_str.isdigit():
-                                detail_id = int(detail_id_str)
-                                # Собираем все изменения для одной строки
-                                found = False
-                                for u in updates:
-                                    if u['id'] == detail_id:
-                                        u[field] = value # Сохраняем как есть, пустая строка будет обработана ниже
-                                        found = True
-                                        break
-                                if not found:
-                                    updates.append({'id': detail_id, field: value})
-                    
-                    # Применяем изменения к базе данных
-                    for update_data in updates:
-                        detail_id = update_data.pop('id')
-                        # Формируем SQL-запрос динамически
-                        set_clauses = [sql.SQL("{} = %s").format(sql.Identifier(key)) for key in update_data.keys()]
-                        values = list(update_data.values())
-                        # Заменяем пустые строки на None, чтобы в БД не попадали пустые значения
-                        # для числовых или датовых полей.
-                        processed_values = [v if v != '' else None for v in values]
-                        processed_values.append(detail_id)
-                        
-                        query = sql.SQL("UPDATE dmkod_aggregation_details SET {} WHERE id = %s").format(sql.SQL(', ').join(set_clauses))
-                        cur.execute(query, processed_values)
-                    
-                    flash(f'Изменения в {len(updates)} строках успешно сохранены.', 'success')
+                        field, _, detail_id_str = key.partition('-')
+                        if field in DETAIL_EDITABLE_COLUMNS and detail_id_str.isdigit():
+                            # Пустые строки заменяем на None, чтобы в БД не попадали пустые значения
+                            # для числовых или датовых полей.
+                            changes[int(detail_id_str)][field] = value if value != '' else None
+
+                    # Применяем все изменения к базе данных одним запросом
+                    _update_details(cur, order_id, changes)
+                    flash(f'Изменения в {len(changes)} строках успешно сохранены.', 'success')
 
                 elif action == 'upload_delta_result':
                     delta_file = request.files.get('delta_file')
@@ -597,13 +622,11 @@ def edit_integration(order_id):
 
                         logging.info(f"[Delta CSV] Начало обработки файла '{delta_csv_file.filename}' для заказа #{order_id}.")
                         # Читаем CSV-файл с помощью pandas
-                        # Используем BytesIO для обработки потока файла и указываем кодировку/разделитель
-                        file_content = delta_csv_file.read().decode('utf-8')
+                        # Читаем прямо из потока загруженного файла, без промежуточной копии в памяти
                         # --- КЛЮЧЕВОЕ ИСПРАВЛЕНИЕ: Сразу указываем pandas читать SSCC как строки ---
                         # Это предотвращает их автоматическое преобразование в числа (float) и потерю точности.
-                        df = pd.read_csv(StringIO(file_content), sep='\t', dtype={'Barcode': str, 
-                                                                                  'BoxSSCC': str, 
-                                                                                  'PaletSSCC': str})
+                        df = pd.read_csv(delta_csv_file.stream, sep='\t', encoding='utf-8',
+                                         dtype={'DataMatrix': str, 'Barcode': str, 'BoxSSCC': str, 'PaletSSCC': str})
                         df.columns = df.columns.str.strip() # Очищаем пробелы в заголовках
 
                         # Проверяем наличие обязательных колонок
@@ -627,6 +650,7 @@ def edit_integration(order_id):
                         unique_pallets = df[['PaletSSCC']].dropna().drop_duplicates().rename(columns={'PaletSSCC': 'sscc'})
 
                         logging.info(f"[Delta CSV] Найдено {len(unique_boxes)} уникальных коробов и {len(unique_pallets)} уникальных паллет в файле.")
+                        sscc_to_id_map = {}
                         packages_to_insert = []
                         # --- ИСПРАВЛЕНИЕ: Добавляем 'level' сразу при создании ---
                         if not unique_boxes.empty:
@@ -646,89 +670,74 @@ def edit_integration(order_id):
                             all_packages_df['parent_id'] = None # Родители будут определены на след. шаге
 
                             # 2. Определяем связи "короб-паллета"
+                            # ID паллет заранее неизвестны, поэтому родителя короба запоминаем по SSCC
                             box_pallet_map = df[['BoxSSCC', 'PaletSSCC']].dropna().drop_duplicates()
-                            
-                            # Создаем словарь {pallet_sscc: pallet_id}
-                            # Мы не знаем ID паллет заранее, поэтому используем сами SSCC как временные ID
-                            
-                            # Создаем словарь {box_sscc: pallet_sscc}
-                            box_to_pallet_sscc_map = pd.Series(box_pallet_map.PaletSSCC.values, index=box_pallet_map.BoxSSCC).to_dict()
-
-                            # Функция для поиска parent_id (SSCC паллеты)
-                            def find_parent_sscc(row):
-                                if row['level'] == 1:
-                                    return box_to_pallet_sscc_map.get(row['sscc'])
-                                return None
-
-                            all_packages_df['parent_sscc'] = all_packages_df.apply(find_parent_sscc, axis=1)
-
-                            # --- НОВАЯ ЛОГИКА: Блокировка таблицы и получение ID перед вставкой ---
-                            # Это решает проблему с гонкой состояний и ошибкой UniqueViolation.
+                            all_packages_df['parent_sscc'] = map_parent_sscc(all_packages_df, box_pallet_map)
+
+                            # --- Вставка без блокировки таблицы ---
+                            # ID назначает сама БД (DEFAULT nextval), а RETURNING возвращает их вместе с SSCC.
+                            # Так импорт не блокирует чтение 'packages' другими приложениями.
                             packages_table_name = os.getenv('TABLE_PACKAGES', 'packages')
-                            sequence_name = f"{packages_table_name}_id_seq"
-                            num_packages = len(all_packages_df)
-
-                            # 1. Блокируем таблицу в эксклюзивном режиме на время транзакции
-                            logging.info(f"[Delta CSV] Блокирую таблицу '{packages_table_name}' для безопасной вставки...")
-                            cur.execute(sql.SQL("LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE").format(table=sql.Identifier(packages_table_name)))
-
-                            # --- НОВЫЙ ШАГ: Синхронизация счетчика перед получением ID ---
-                            # Это гарантирует, что sequence не отстает от реальных данных в таблице,
-                            # решая проблему UniqueViolation при конкурентном доступе.
-                            logging.info(f"[Delta CSV] Синхронизирую счетчик '{sequence_name}'...")
-                            cur.execute(sql.SQL("SELECT setval('{seq}', (SELECT MAX(id) FROM {tbl}), true)").format(
-                                seq=sql.Identifier(sequence_name),
-                                tbl=sql.Identifier(packages_table_name)
-                            ))
-
-                            # 2. Получаем блок ID из последовательности
-                            logging.info(f"[Delta CSV] Резервирую {num_packages} ID из последовательности '{sequence_name}'...")
-                            cur.execute(sql.SQL("SELECT nextval('{seq}') FROM generate_series(1, %s)").format(seq=sql.Identifier(sequence_name)), (num_packages,))
-                            # --- ИСПРАВЛЕНИЕ: Используем доступ по ключу 'nextval' для RealDictCursor ---
-                            # Вместо row[0] используем row['nextval'], так как курсор возвращает словари.
-                            new_ids = [row['nextval'] for row in cur.fetchall()]
-
-                            # 3. Присваиваем ID нашему DataFrame
-                            all_packages_df['id'] = new_ids
-                            logging.info("[Delta CSV] ID успешно присвоены данным в памяти.")
-
-                            # 4. Выполняем обычную массовую вставку (не UPSERT)
+
                             from psycopg2.extras import execute_values
                             columns = all_packages_df.columns.tolist()
                             data_tuples = [tuple(x) for x in all_packages_df.to_numpy()]
-                            
-                            insert_query = sql.SQL("INSERT INTO {table} ({cols}) VALUES %s").format(
+
+                            insert_query = sql.SQL("INSERT INTO {table} ({cols}) VALUES %s RETURNING id, sscc, level").format(
                                 table=sql.Identifier(packages_table_name),
                                 cols=sql.SQL(', ').join(map(sql.Identifier, columns))
                             )
-                            
+
                             logging.info(f"[Delta CSV] Выполняю массовую вставку {len(data_tuples)} записей в '{packages_table_name}'...")
-                            execute_values(cur, insert_query, data_tuples, page_size=1000)
-                            flash(f"Создано {len(all_packages_df)} упаковок (короба и паллеты).", 'info')
-                            logging.info(f"[Delta CSV] Вставка упаковок завершена. Блокировка будет снята после коммита.")
-                            
+                            inserted_packages = execute_values(cur, insert_query, data_tuples, page_size=1000, fetch=True)
+                            # Карта {sscc: id} для коробов этого файла, нужна для привязки кодов в 'items'
+                            sscc_to_id_map = {row['sscc']: row['id'] for row in inserted_packages if row['level'] == 1}
+                            flash(f"Создано {len(inserted_packages)} упаковок (короба и паллеты).", 'info')
+                            logging.info(f"[Delta CSV] Вставка упаковок завершена, получено {len(inserted_packages)} ID.")
+
                             # --- НОВЫЙ БЛОК: Обновление parent_id ---
-                            # После того как все короба и паллеты вставлены,
-                            # мы можем обновить parent_id для коробов, используя parent_sscc.
+                            # Упаковки текущего файла складываем во временную таблицу, чтобы связывать
+                            # и очищать только их, а не сканировать всю таблицу 'packages'.
+                            cur.execute("""
+                                CREATE TEMP TABLE delta_batch_packages (
+                                    id INTEGER PRIMARY KEY,
+                                    sscc VARCHAR(18) NOT NULL,
+                                    level SMALLINT NOT NULL
+                                ) ON COMMIT DROP;
+                            """)
+                            execute_values(
+                                cur,
+                                "INSERT INTO delta_batch_packages (id, sscc, level) VALUES %s",
+                                [(row['id'], row['sscc'], row['level']) for row in inserted_packages],
+                                page_size=1000
+                            )
+                            cur.execute("CREATE INDEX ON delta_batch_packages (sscc);")
+                            cur.execute("ANALYZE delta_batch_packages;")
+
+                            # Родитель короба - паллета из этого же файла, ищем ее по SSCC только среди строк пакета.
                             update_parent_id_query = sql.SQL("""
                                 UPDATE {packages_table} p_child
-                                SET parent_id = p_parent.id
-                                FROM {packages_table} AS p_parent
-                                WHERE p_child.parent_sscc = p_parent.sscc
-                                  AND p_child.parent_sscc IS NOT NULL
+                                SET parent_id = b_parent.id, parent_sscc = NULL
+                                FROM delta_batch_packages AS b_child, delta_batch_packages AS b_parent
+                                WHERE p_child.id = b_child.id
+                                  AND b_parent.sscc = p_child.parent_sscc
+                                  AND b_parent.level = 2
                                   AND p_child.parent_id IS NULL;
                             """).format(packages_table=sql.Identifier(packages_table_name))
-                            
+
                             logging.info("[Delta CSV] Выполняю запрос на обновление parent_id для связки коробов и паллет...")
                             cur.execute(update_parent_id_query)
                             updated_parents_count = cur.rowcount
                             flash(f"Связи 'короб-паллета' обновлены для {updated_parents_count} записей.", 'info')
                             logging.info(f"[Delta CSV] Обновлено {updated_parents_count} связей parent_id.")
-                            
-                            # Очищаем временное поле parent_sscc
+
+                            # Очищаем временное поле parent_sscc у оставшихся без пары строк этого файла
                             if updated_parents_count > 0:
                                 cleanup_query = sql.SQL("""
-                                    UPDATE {packages_table} SET parent_sscc = NULL WHERE parent_sscc IS NOT NULL;
+                                    UPDATE {packages_table} p
+                                    SET parent_sscc = NULL
+                                    FROM delta_batch_packages AS b
+                                    WHERE p.id = b.id AND p.parent_sscc IS NOT NULL;
                                 """).format(packages_table=sql.Identifier(packages_table_name))
                                 cur.execute(cleanup_query)
                                 flash("Временные данные по связям очищены.", 'info')
@@ -737,25 +746,11 @@ def edit_integration(order_id):
 
                         # --- НОВЫЙ БЛОК: Создание и загрузка записей в 'items' ---
                         logging.info("[Delta CSV] Начинаю подготовку данных для таблицы 'items'.")
-                        # 1. Получаем карту {sscc: id} для только что созданных коробов
-                        packages_table_name = os.getenv('TABLE_PACKAGES', 'packages')
-                        box_ssccs_tuple = tuple(df['BoxSSCC'].dropna().unique())
-                        # --- ИСПРАВЛЕНИЕ: Выполняем запрос, только если есть короба ---
-                        sscc_to_id_map = {}
-                        if box_ssccs_tuple:
-                            cur.execute(
-                                sql.SQL("SELECT sscc, id FROM {table} WHERE sscc IN %s").format(
-                                    table=sql.Identifier(packages_table_name)
-                                ),
-                                (box_ssccs_tuple,)
-                            )
-                            sscc_to_id_map = {row['sscc']: row['id'] for row in cur.fetchall()}
-
+                        # 1. Карта {sscc: id} для только что созданных коробов уже получена из RETURNING
                         logging.info(f"[Delta CSV] Создана карта SSCC->ID для {len(sscc_to_id_map)} коробов.")
 
                         # 2. Создаем DataFrame для 'items' с использованием корректного парсера
-                        parsed_dm_data = [parse_datamatrix(dm) for dm in df['DataMatrix']]
-                        items_df = pd.DataFrame(parsed_dm_data)
+                        items_df = parse_datamatrix_series(df['DataMatrix'])
                         
                         # Добавляем остальные нужные колонки
                         items_df['order_id'] = order_id
@@ -791,9 +786,6 @@ def edit_integration(order_id):
 
                         # --- ВОССТАНОВЛЕННЫЙ БЛОК: Сохранение результатов в delta_result ---
                         # --- НОВАЯ ЛОГИКА: Группировка по printrun_id и дате производства ---
-                        df_for_json = df.copy()
-                        df_for_json.rename(columns={'Barcode': 'gtin', 'StartDate': 'production_date', 'EndDate': 'expiration_date'}, inplace=True)
-
                         # 1. Получаем карту {gtin: printrun_id} из деталей заказа
                         cur.execute(
                             "SELECT gtin, api_id FROM dmkod_aggregation_details WHERE order_id = %s AND api_id IS NOT NULL",
@@ -803,33 +795,9 @@ def edit_integration(order_id):
                         if not gtin_to_printrun_map:
                             raise Exception("Не удалось найти ID тиражей (api_id) в деталях заказа. Убедитесь, что тиражи созданы в API.")
 
-                        # 2. Добавляем printrun_id в DataFrame
-                        df_for_json['printrun_id'] = df_for_json['gtin'].map(gtin_to_printrun_map)
-
-                        # 3. Группируем по printrun_id, дате производства и сроку годности
-                        # --- ИСПРАВЛЕНО: Используем .agg(list) вместо .apply(list) для избежания MultiIndex ---
-                        grouped_for_api = df_for_json.groupby(
-                            ['printrun_id', 'production_date', 'expiration_date']
-                        ).agg({'DataMatrix': list}).reset_index()
-                        
-                        # 4. Формируем DataFrame для upsert
-                        def create_payload(row):
-                            # --- ИЗМЕНЕНО: Формируем структуру JSON согласно новому требованию ---
-                            cleaned_codes = [code.replace(GS_SEPARATOR, '') for code in row['DataMatrix']]
-                            payload = {
-                                "include": [{"code": c} for c in cleaned_codes],
-                                "attributes": {
-                                    "production_date": str(row['production_date']),
-                                    "expiration_date": str(row['expiration_date'])
-                                }
-                            }
-                            return json.dumps(payload)
-
-                        grouped_for_api['codes_json'] = grouped_for_api.apply(create_payload, axis=1)
+                        # 2-4. Группируем по printrun_id, дате производства и сроку годности и собираем JSON для API
+                        grouped_for_api = build_delta_payloads(df, gtin_to_printrun_map)
                         grouped_for_api['order_id'] = order_id
-                        # Преобразуем printrun_id в integer для корректной вставки
-                        grouped_for_api['printrun_id'] = grouped_for_api['printrun_id'].astype(int)
-                        grouped_for_api['production_date'] = pd.to_datetime(grouped_for_api['production_date']).dt.date
 
                         # 5. Выбираем колонки и выполняем upsert
                         delta_result_df = grouped_for_api[['order_id', 'printrun_id', 'production_date', 'codes_json']]
@@ -891,18 +859,30 @@ def download_original_file(file_id):
     conn = get_db_connection()
     try:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT filename, file_data FROM dmkod_order_files WHERE id = %s", (file_id,))
-            file_data = cur.fetchone()
+            cur.execute("SELECT filename, checksum_sha256 FROM dmkod_order_files WHERE id = %s", (file_id,))
+            file_info = cur.fetchone()
+
+            if file_info and not file_info['checksum_sha256']:
+                # Файл, загруженный до переноса в хранилище (см. migrate_order_files.py)
+                cur.execute("SELECT file_data FROM dmkod_order_files WHERE id = %s", (file_id,))
+                legacy_data = cur.fetchone()['file_data']
+                return send_file(
+                    BytesIO(legacy_data),
+                    mimetype='application/octet-stream',
+                    as_attachment=True,
+                    download_name=file_info['filename']
+                )
 
-        if not file_data:
+        if not file_info:
             flash('Файл не найден.', 'danger')
             return redirect(request.referrer or url_for('.dashboard'))
 
+        # Файл отдается с диска потоково
         return send_file(
-            BytesIO(file_data['file_data']),
+            get_file_path(file_info['checksum_sha256']),
             mimetype='application/octet-stream',
             as_attachment=True,
-            download_name=file_data['filename']
+            download_name=file_info['filename']
         )
     except Exception as e:
         flash(f'Ошибка при скачивании файла: {e}', 'danger')
@@ -996,6 +976,7 @@ def integration_panel():
     """Страница 'Интеграция' с выбором заказа."""
     api_response = None
     selected_order = None
+    workflow_job = None
     selected_order_id = request.form.get('order_id', type=int) if request.method == 'POST' else request.args.get('order_id', type=int)
 
     conn = get_db_connection()
@@ -1009,784 +990,61 @@ def integration_panel():
                 cur.execute("SELECT * FROM orders WHERE id = %s", (selected_order_id,))
                 selected_order = cur.fetchone()
 
+        if selected_order_id:
+            latest_job = get_latest_job(conn, selected_order_id)
+            workflow_job = job_to_dict(latest_job) if latest_job else None
+
         action = request.form.get('action')
         if action: # Все действия теперь внутри этого блока
             if not selected_order_id:
                 flash('Пожалуйста, сначала выберите заказ.', 'warning')
                 return redirect(url_for('.integration_panel'))
             
-            if action == 'create_order':
-                access_token = session.get('api_access_token')
-                if not access_token:
-                    flash('Токен API не найден. Пожалуйста, войдите заново.', 'warning')
-                    return redirect(url_for('.login'))
-
-                try:
-                    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                        # 1. Получаем основную информацию о заказе и товарной группе
-                        cur.execute("""
-                            SELECT o.participant_id, o.notes, pg.dm_template
-                            FROM orders o
-                            JOIN dmkod_product_groups pg ON o.product_group_id = pg.id
-                            WHERE o.id = %s
-                        """, (selected_order_id,))
-                        order_info = cur.fetchone()
-
-                        if not order_info:
-                            raise Exception("Не найдена информация о заказе или товарной группе.")
-
-                        # 2. Получаем детализацию для формирования продуктов с учетом дат
-                        cur.execute("""
-                            SELECT gtin, dm_quantity, production_date
-                            FROM dmkod_aggregation_details
-                            WHERE order_id = %s AND gtin IS NOT NULL AND gtin != ''
-                        """, (selected_order_id,))
-                        products_data = cur.fetchall()
-
-                        if not products_data:
-                            raise Exception("В заказе нет детализации по продуктам (GTIN) для отправки.")
-
-                    # --- НОВАЯ ЛОГИКА: Группировка данных перед отправкой в API ---
-                    # 3. Преобразуем данные в DataFrame для удобной агрегации
-                    products_df = pd.DataFrame(products_data)
-                    
-                    # Группируем по GTIN, суммируем количество и берем самую раннюю дату производства
-                    aggregated_products_df = products_df.groupby('gtin').agg(
-                        dm_quantity=('dm_quantity', 'sum'),
-                        production_date=('production_date', 'min') # Берем самую раннюю дату
-                    ).reset_index()
-
-                    # 4. Формируем тело запроса к API на основе сгруппированных данных
-                    products_payload = [
-                        {
-                            "gtin": p['gtin'],
-                            "code_template": order_info['dm_template'],
-                            "qty": int(p['dm_quantity']), # Используем суммированное количество
-                            "unit_type": "UNIT",
-                            "release_method": "IMPORT",
-                            "payment_type": 2,
-                            "attributes": {
-                                "production_date": p['production_date'].strftime('%Y-%m-%d')
-                            } if p.get('production_date') else {}
-                        } for index, p in aggregated_products_df.iterrows()
-                    ]
-                    # Удаляем пустые словари атрибутов, если дата не была указана
-                    for p in products_payload:
-                        if not p.get("attributes"):
-                            del p["attributes"]
-                    
-                    api_payload = { # Название переменной изменено для ясности
-                        "participant_id": order_info['participant_id'],
-                        "production_order_id": order_info['notes'] or "",
-                        "contact_person": current_user.username,
-                        "products": products_payload
-                    }
-
-                    # 5. Отправляем запрос к API
-                    api_base_url = os.getenv('API_BASE_URL', '').rstrip('/')
-                    full_url = f"{api_base_url}/psp/order/create"
-                    headers = {'Authorization': f'Bearer {access_token}'}
-                    
-                    response = requests.post(full_url, headers=headers, json=api_payload, timeout=30)
-                    response.raise_for_status()
-                    
-                    response_data = response.json()
-                    api_order_id = response_data.get('order_id')
-
-                    # 6. Обновляем наш заказ, записывая ID из API
-                    if api_order_id:
-                        with conn.cursor() as cur:
-                            cur.execute("UPDATE orders SET api_order_id = %s WHERE id = %s", (api_order_id, selected_order_id))
-                        conn.commit()
-                        flash(f'Заказ в API успешно создан с ID: {api_order_id}.', 'success')
-                        # Перенаправляем, чтобы обновить состояние кнопок
-                        return redirect(url_for('.integration_panel', order_id=selected_order_id))
-
-                    api_response = {
-                        'status_code': response.status_code,
-                        'body': json.dumps(response_data, indent=2, ensure_ascii=False)
-                    }
-
-                except Exception as e:
-                    conn.rollback()
-                    error_body = ""
-                    if 'response' in locals() and hasattr(response, 'text'):
-                        error_body = response.text
-                    api_response = {
-                        'status_code': response.status_code if 'response' in locals() else 500,
-                        'body': f"ОШИБКА: {e}\n\nОтвет сервера (если был):\n{error_body}"
-                    }
-            elif action == 'create_suborder_request':
-                access_token = session.get('api_access_token')
-                if not access_token:
-                    flash('Токен API не найден. Пожалуйста, войдите заново.', 'warning')
-                    return redirect(url_for('.login'))
-                
-                if not selected_order or not selected_order.get('api_order_id'):
-                    flash('Сначала необходимо создать заказ в API (кнопка "Создать заказ").', 'danger')
-                    return redirect(url_for('.integration_panel', order_id=selected_order_id))
-
-                try:
-                    api_payload = { "order_id": int(selected_order['api_order_id']) }
-
-                    # Отправляем запрос к API
-                    api_base_url = os.getenv('API_BASE_URL', '').rstrip('/')
-                    full_url = f"{api_base_url}/psp/suborders/create"
-                    headers = {'Authorization': f'Bearer {access_token}'}
-                    
-                    response = requests.post(full_url, headers=headers, json=api_payload, timeout=30)
-                    response.raise_for_status()
-                    
-                    response_data = response.json()
-
-                    # --- ИСПРАВЛЕННАЯ ЛОГИКА ---
-                    # Обновляем статус заказа в любом случае, если запрос прошел успешно (статус 2xx)
-                    with conn.cursor() as cur:
-                        cur.execute("UPDATE orders SET api_status = 'Запрос создан' WHERE id = %s", (selected_order_id,))
-                    conn.commit()
-                    flash('Запрос на получение кодов успешно отправлен. Статус заказа обновлен на "Запрос создан".', 'success')
-                    # Перенаправляем, чтобы обновить состояние кнопок
-                    return redirect(url_for('.integration_panel', order_id=selected_order_id))
-
-                except Exception as e:
-                    conn.rollback()
-                    error_body = response.text if 'response' in locals() and hasattr(response, 'text') else ""
-                    api_response = {
-                        'status_code': response.status_code if 'response' in locals() else 500,
-                        'body': f"ОШИБКА: {e}\n\nОтвет сервера (если был):\n{error_body}"
-                    }
-                    return render_template('integration_panel.html', orders=orders, selected_order_id=selected_order_id, selected_order=selected_order, api_response=api_response, title="Интеграция")
-            elif action == 'split_runs': # Полностью переписанная логика
-                access_token = session.get('api_access_token')
-                if not access_token:
-                    flash('Токен API не найден. Пожалуйста, войдите заново.', 'warning')
-                    return redirect(url_for('.login'))
-    
-                if not selected_order or not selected_order.get('api_order_id'):
-                    flash('Сначала необходимо создать заказ в API.', 'danger')
-                    return redirect(url_for('.integration_panel', order_id=selected_order_id))
-    
-                try:
-                    conn_local = get_db_connection()
-                    api_base_url = os.getenv('API_BASE_URL', '').rstrip('/')
-                    headers = {'Authorization': f'Bearer {access_token}'}
-    
-                    # --- Шаг 1: Собираем данные из нашей БД в DataFrame ---
-                    with conn_local.cursor(cursor_factory=RealDictCursor) as cur:
-                        cur.execute(
-                            "SELECT id, gtin, dm_quantity, production_date, api_id FROM dmkod_aggregation_details WHERE order_id = %s ORDER BY id",
-                            (selected_order_id,)
-                        )
-                        details_data = cur.fetchall()
-                        if not details_data:
-                            raise Exception("В заказе нет детализации для создания тиражей.")
-                    details_df = pd.DataFrame(details_data)
-    
-                    # --- Шаг 2: Получение деталей заказа из API и обогащение DataFrame ---
-                    get_order_url = f"{api_base_url}/psp/orders"
-                    get_order_payload = {"order_id": selected_order['api_order_id']}
-                    response_get = requests.get(get_order_url, headers=headers, json=get_order_payload, timeout=30)
-                    response_get.raise_for_status()
-                    order_details_from_api = response_get.json()
-    
-                    if not order_details_from_api.get('orders'):
-                        raise Exception("API не вернуло информацию о заказе.")
-    
-                    api_order_data = order_details_from_api['orders'][0]
-                    api_products = api_order_data.get('products', [])
-                    if not api_products:
-                        raise Exception("API не вернуло список продуктов в заказе.")
-    
-                    # Создаем словарь для быстрого поиска api_product_id по gtin
-                    # с учетом условий: state=ACTIVE и qty=qty_received
-                    gtin_to_api_product_id = {}
-                    for p in api_products:
-                        if p.get('state') == 'ACTIVE' and p.get('qty') == p.get('qty_received'):
-                            gtin_to_api_product_id[p['gtin']] = p['id']
-                    details_df['api_product_id'] = details_df['gtin'].map(gtin_to_api_product_id)
-
-                    # --- ДЛЯ ОТЛАДКИ: Сохраняем итоговый DataFrame в переменную ПЕРЕД циклом ---
-                    debug_details_df_output = details_df.to_string()
-
-                    # --- Шаг 3: Обновление/добавление названий товаров ---
-                    products_to_upsert = [{'gtin': p['gtin'], 'name': p['name']} for p in api_products if p.get('name')]
-                    if products_to_upsert:
-                        with conn_local.cursor() as cur:
-                            from .utils import upsert_data_to_db
-                            upsert_df = pd.DataFrame(products_to_upsert)
-                            upsert_data_to_db(cur, 'TABLE_PRODUCTS', upsert_df, 'gtin')
-                        conn_local.commit()
-    
-                    # --- Шаг 4: Цикл создания тиражей и обновления api_id ---
-                    create_tirage_url = f"{api_base_url}/psp/printrun/create"
-                    get_tirages_url = f"{api_base_url}/psp/printruns"
-                    user_logs = [f"Начинаю создание тиражей для {len(details_df)} позиций заказа."]
- 
-                    for i, row in details_df.iterrows():
-                        api_product_id = row.get('api_product_id')
-                        if pd.isna(api_product_id):
-                            log_msg = f"Пропуск строки {i+1}/{len(details_df)} (gtin: {row['gtin']}), т.к. не найден api_product_id."
-                            logging.warning(log_msg)
-                            user_logs.append(log_msg)
-                            continue
-    
-                        # Пропускаем строки, для которых тираж уже был создан ранее
-                        if pd.notna(row.get('api_id')):
-                            log_msg = f"Пропуск строки {i+1}/{len(details_df)} (gtin: {row['gtin']}), так как тираж (api_id: {row['api_id']}) уже существует."
-                            user_logs.append(log_msg)
-                            continue
- 
-                        user_logs.append(f"--- Создаю тираж {i+1}/{len(details_df)} ---")
-                        tirage_payload = {
-                            "order_product_id": int(api_product_id),
-                            "qty": int(row['dm_quantity'])
-                        }
-                        user_logs.append(f"  GTIN: {row['gtin']}, Кол-во: {row['dm_quantity']}")
-                        
-                        # Отправляем POST на создание тиража
-                        response_post = requests.post(create_tirage_url, headers=headers, json=tirage_payload, timeout=30)
-                        response_post.raise_for_status()
-                        response_data = response_post.json()
-                        user_logs.append(f"  Запрос на создание тиража отправлен. Ответ: {response_post.status_code}, Тело: {json.dumps(response_data)}")
- 
-                        # --- НОВАЯ ЛОГИКА: Получаем ID тиража напрямую из ответа ---
-                        new_printrun_id = response_data.get('printrun_id')
-                        
-                        if new_printrun_id:
-                            user_logs.append(f"  Получен ID нового тиража: {new_printrun_id}")
-                        else:
-                            # Если ID не пришел, прерываем операцию с ошибкой
-                            raise Exception(f"API не вернуло 'printrun_id' в ответе на создание тиража. Ответ: {json.dumps(response_data)}")
-                        
-                        # Обновляем поле api_id в нашей БД
-                        with conn_local.cursor() as cur:
-                            cur.execute(
-                                "UPDATE dmkod_aggregation_details SET api_id = %s WHERE id = %s",
-                                (new_printrun_id, row['id'])
-                            )
-                        # Обновляем DataFrame, чтобы на следующей итерации этот ID считался существующим
-                        conn_local.commit()
-                        user_logs.append(f"  ID тиража {new_printrun_id} присвоен позиции заказа (ID: {row['id']}) в базе данных.")
-
-                        # --- ДОБАВЛЕНО: Задержка между запросами ---
-                        if i < len(details_df) - 1: # Не делаем паузу после последнего запроса
-                            user_logs.append("  Пауза 5 секунд перед следующим запросом...")
-                            time.sleep(10)
-    
-                    # --- Шаг 5: Обновление статуса заказа ---
-                    with conn_local.cursor() as cur:
-                        cur.execute("UPDATE orders SET api_status = 'Тиражи созданы' WHERE id = %s", (selected_order_id,))
-                    conn_local.commit()
-                    flash('Тиражи успешно созданы в API.', 'success')
-                    # Перенаправляем, чтобы обновить состояние кнопок
-                    api_response = {
-                        'status_code': 200,
-                        'body': "\n".join(user_logs),
-                        'debug_details_df_output': debug_details_df_output
-                    }
-                    # После успешного выполнения показываем результат, а не делаем редирект
-                    return render_template('integration_panel.html', orders=orders, selected_order_id=selected_order_id, selected_order=selected_order, api_response=api_response, title="Интеграция")
-    
-                except Exception as e:
-                    if 'conn_local' in locals() and conn_local: conn_local.rollback()
-                    # Инициализируем переменные для блока finally
-                    debug_details_df_output = debug_details_df_output if 'debug_details_df_output' in locals() else "DataFrame не был сформирован из-за ранней ошибки."
-                    error_body = ""
-                    if 'response_post' in locals() and hasattr(response_post, 'text'):
-                        error_body = response_post.text
-                    elif 'response_get' in locals() and hasattr(response_get, 'text'):
-                        error_body = response_get.text
-                    
-                    api_response = {
-                        'status_code': 500,
-                        'body': f"ОШИБКА: {e}\n\nОтвет сервера (если был):\n{error_body}",
-                        'debug_details_df_output': debug_details_df_output
-                    }
-                finally:
-                    if 'conn_local' in locals() and conn_local: conn_local.close()
-            
-            elif action == 'prepare_json':
-                access_token = session.get('api_access_token')
-                if not access_token:
-                    flash('Токен API не найден. Пожалуйста, войдите заново.', 'warning')
-                    return redirect(url_for('.login'))
-
-                if not selected_order or not selected_order.get('api_order_id'):
-                    flash('Сначала необходимо создать заказ и разбить его на тиражи.', 'danger')
+            if action in WORKFLOW_ACTIONS:
+                # Шаги интеграции выполняются фоновым обработчиком (app/worker.py), здесь - только постановка в очередь
+                if action != 'create_order' and (not selected_order or not selected_order.get('api_order_id')):
+                    flash(WORKFLOW_ACTIONS[action], 'danger')
                     return redirect(url_for('.integration_panel', order_id=selected_order_id))
-
-                user_logs = []
                 try:
-                    conn_local = get_db_connection()
-                    with conn_local.cursor(cursor_factory=RealDictCursor) as cur:
-                        cur.execute(
-                            "SELECT id, api_id, gtin FROM dmkod_aggregation_details WHERE order_id = %s AND api_id IS NOT NULL ORDER BY id",
-                            (selected_order_id,)
-                        )
-                        details_to_process = cur.fetchall()
-
-                    if not details_to_process:
-                        raise Exception("Не найдено позиций с ID тиража (api_id) для обработки.")
-
-                    api_base_url = os.getenv('API_BASE_URL', '').rstrip('/')
-                    full_url = f"{api_base_url}/psp/printrun/json/create"
-                    headers = {'Authorization': f'Bearer {access_token}'}
-                    
-                    user_logs.append(f"Найдено {len(details_to_process)} позиций для обработки.")
-
-                    for i, detail in enumerate(details_to_process):
-                        payload = {"printrun_id": detail['api_id']}
-                        user_logs.append(f"--- {i+1}/{len(details_to_process)}: Отправка запроса для GTIN {detail['gtin']} (ID тиража: {detail['api_id']}) ---")
-                        
-                        response = requests.post(full_url, headers=headers, json=payload, timeout=30)
-                        
-                        user_logs.append(f"  URL: {full_url}")
-                        user_logs.append(f"  Тело: {json.dumps(payload)}")
-                        user_logs.append(f"  Статус ответа: {response.status_code}")
-                        
-                        response.raise_for_status() # Прервет выполнение, если статус не 2xx
-                        
-                        # Добавляем небольшую паузу, чтобы API успело обработать запрос
-                        time.sleep(0.5) # Пауза в 0.5 секунды
-
-                    # Обновляем статус заказа в нашей БД
-                    with conn_local.cursor() as cur:
-                        cur.execute(
-                            "UPDATE orders SET api_status = 'JSON заказан' WHERE id = %s",
-                            (selected_order_id,)
-                        )
-                    conn_local.commit()
-
-                    flash('Операция "Подготовить JSON" успешно выполнена. Статус заказа обновлен на "JSON заказан".', 'success')
-                    # Перенаправляем, чтобы обновить состояние кнопок
-                    return redirect(url_for('.integration_panel', order_id=selected_order_id))
-                    api_response = {
-                        'status_code': 200, # Используем 200, т.к. операция прошла успешно
-                        'body': "\n".join(user_logs)
-                    }
-
-                except Exception as e:
-                    error_body = response.text if 'response' in locals() and hasattr(response, 'text') else ""
-                    user_logs.append(f"\n!!! ОШИБКА: {e}\nОтвет сервера (если был):\n{error_body}")
-                    api_response = {'status_code': 500, 'body': "\n".join(user_logs)}
-                finally:
-                    if 'conn_local' in locals() and conn_local: conn_local.close()
-
-            elif action == 'download_codes':
-                access_token = session.get('api_access_token')
-                if not access_token:
-                    flash('Токен API не найден. Пожалуйста, войдите заново.', 'warning')
-                    return redirect(url_for('.login'))
-
-                if not selected_order or not selected_order.get('api_order_id'):
-                    flash('Сначала необходимо создать заказ в API и разбить его на тиражи.', 'danger')
-                    return redirect(url_for('.integration_panel', order_id=selected_order_id))
-
-                user_logs = []
-                zip_buffer = BytesIO()
-                
+                    enqueue_step(conn, selected_order_id, action,
+                                 params={'contact_person': current_user.username},
+                                 created_by=current_user.username)
+                    flash(f'Операция "{step_title(action)}" поставлена в очередь. Ход выполнения отображается ниже.', 'info')
+                except WorkflowBusyError as e:
+                    flash(str(e), 'warning')
+                return redirect(url_for('.integration_panel', order_id=selected_order_id))
+
+            if action == 'export_delta':
                 try:
                     conn_local = get_db_connection()
-                    with conn_local.cursor(cursor_factory=RealDictCursor) as cur:
-                        # Получаем имя клиента для формирования имени файла
-                        cur.execute("SELECT client_name FROM orders WHERE id = %s", (selected_order_id,))
-                        client_name_row = cur.fetchone()
-                        if not client_name_row:
-                            raise Exception(f"Не удалось найти клиента для заказа ID {selected_order_id}.")
-                        client_name = client_name_row['client_name'] # Получаем оригинальное имя клиента
-
-                        # Получаем детализацию заказа с api_id
-                        cur.execute(
-                            "SELECT id, api_id, gtin FROM dmkod_aggregation_details WHERE order_id = %s AND api_id IS NOT NULL ORDER BY id",
-                            (selected_order_id,)
-                        )
-                        details_to_process = cur.fetchall()
-
-                    if not details_to_process:
-                        raise Exception("Не найдено позиций с ID тиража (api_id) для скачивания кодов.")
-
-                    api_base_url = os.getenv('API_BASE_URL', '').rstrip('/')
-                    full_url = f"{api_base_url}/psp/printrun/json/download"
-                    headers = {'Authorization': f'Bearer {access_token}'}
-                    
-                    user_logs.append(f"Найдено {len(details_to_process)} позиций для скачивания кодов.")
-
-                    # Санитизируем имя клиента для использования в именах файлов
-                    sanitized_client_name = _sanitize_filename_part(client_name)
-
                     with conn_local.cursor() as cur:
-                        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-                            for i, detail in enumerate(details_to_process):
-                                payload = {"printrun_id": detail['api_id']}
-                                user_logs.append(f"--- {i+1}/{len(details_to_process)}: Запрос кодов для GTIN {detail['gtin']} (ID тиража: {detail['api_id']}) ---")
-                                
-                                # Отправляем GET-запрос к API
-                                response = requests.get(full_url, headers=headers, json=payload, timeout=60)
-                                
-                                user_logs.append(f"  URL: {full_url}")
-                                user_logs.append(f"  Тело запроса: {json.dumps(payload)}")
-                                user_logs.append(f"  Статус ответа: {response.status_code}")
-                                
-                                response.raise_for_status()
-                                
-                                response_data = response.json()
-                                codes = response_data.get('codes', [])
-
-                                if not codes:
-                                    user_logs.append(f"  В ответе для тиража {detail['api_id']} не найдено кодов.")
-                                    continue
-                                
-                                # Сохраняем JSON с кодами в dmkod_aggregation_details для текущей строки
-                                cur.execute(
-                                    "UPDATE dmkod_aggregation_details SET api_codes_json = %s WHERE id = %s",
-                                    (json.dumps({'codes': codes}), detail['id'])
-                                )
-                                user_logs.append(f"  Сохранено {len(codes)} кодов в базу данных для строки ID {detail['id']}.")
-
-                                # Формируем CSV-содержимое для ZIP-архива
-                                csv_content = "\n".join(codes)
-                                
-                                csv_filename_parts = [f"{i+1}", f"{selected_order_id}"]
-                                if sanitized_client_name:
-                                    csv_filename_parts.append(sanitized_client_name)
-                                csv_filename_parts.append(f"{len(codes)}")
-                                filename = "_".join(csv_filename_parts) + ".csv"
-                                
-                                zf.writestr(filename, csv_content)
-                                user_logs.append(f"  Создан файл '{filename}' с {len(codes)} кодами.")
-                        
-                        # Обновляем статус заказа в нашей БД
+                        # Проверяем, что в заказе есть хотя бы один корректный код, не вычитывая сами коды
                         cur.execute(
-                            "UPDATE orders SET api_status = 'Коды скачаны' WHERE id = %s",
-                            (selected_order_id,)
-                        )
-                    conn_local.commit()
-                    zip_buffer.seek(0) # Перематываем буфер в начало
-
-                    # Формируем имя ZIP-файла, избегая лишнего подчеркивания
-                    zip_download_name_parts = [f"codes_order_{selected_order_id}"]
-                    if sanitized_client_name:
-                        zip_download_name_parts.append(sanitized_client_name)
-                    final_zip_download_name = "_".join(zip_download_name_parts) + ".zip"
-                    
-                    flash('Коды успешно скачаны и упакованы в ZIP-архив.', 'success')
-                    
-                    # Вместо прямой отправки файла, сохраняем его в сессии и делаем редирект
-                    session['download_file'] = {'data': zip_buffer.getvalue(), 'name': final_zip_download_name, 'mimetype': 'application/zip'}
-                    return redirect(url_for('.integration_panel', order_id=selected_order_id))
-                    
-                except Exception as e:
-                    if 'conn_local' in locals() and conn_local: conn_local.rollback() # Откатываем транзакцию при ошибке
-                    error_body = response.text if 'response' in locals() and hasattr(response, 'text') else ""
-                    user_logs.append(f"\n!!! ОШИБКА: {e}\nОтвет сервера (если был):\n{error_body}")
-                    api_response = {'status_code': 500, 'body': "\n".join(user_logs)}
-                finally:
-                    if 'conn_local' in locals() and conn_local: conn_local.close()
-
-            elif action == 'prepare_report_data':
-                access_token = session.get('api_access_token')
-                if not access_token:
-                    flash('Токен API не найден. Пожалуйста, войдите заново.', 'warning')
-                    return redirect(url_for('.login'))
-
-                if not selected_order or not selected_order.get('api_order_id'):
-                    flash('Сначала необходимо создать заказ в API и разбить его на тиражи.', 'danger')
-                    return redirect(url_for('.integration_panel', order_id=selected_order_id))
-
-                # --- ИСПРАВЛЕННАЯ ЛОГИКА: Обработка статуса 'delta' ---
-                if selected_order.get('status') == 'delta':
-                    user_logs = []
-                    conn_local = None # Инициализируем переменную
-                    try:
-                        conn_local = get_db_connection()
-                        with conn_local.cursor(cursor_factory=RealDictCursor) as cur:
-                            # 1. Получаем все необработанные записи из delta_result, где еще не был получен ID загрузки
-                            cur.execute(
-                                "SELECT id, printrun_id, codes_json FROM delta_result WHERE order_id = %s AND utilisation_upload_id IS NULL",
-                                (selected_order_id,)
+                            f"""
+                            SELECT EXISTS (
+                                SELECT 1 {DELTA_EXPORT_CODES_FROM}
                             )
-                            results_to_process = cur.fetchall()
-
-                        if not results_to_process:
-                            # --- ИЗМЕНЕНО: Проверяем, есть ли вообще записи. Если есть, но все обработаны - это успех. ---
-                            with conn_local.cursor() as cur:
-                                cur.execute("SELECT EXISTS (SELECT 1 FROM delta_result WHERE order_id = %s)", (selected_order_id,))
-                                has_any_results = cur.fetchone()[0]
-                            flash("Все ранее загруженные сведения от 'Дельта' уже подготовлены и отправлены в API." if has_any_results else "Нет данных от 'Дельта' для подготовки сведений.", 'info')
-                            return redirect(url_for('.integration_panel', order_id=selected_order_id))
-
-                        api_base_url = os.getenv('API_BASE_URL', '').rstrip('/')
-                        headers = {'Authorization': f'Bearer {access_token}'}
-                        user_logs.append(f"Найдено {len(results_to_process)} записей от 'Дельта' для обработки.")
-                        
-                        updated_count = 0
-                        with conn_local.cursor() as cur:
-                            for i, result in enumerate(results_to_process):
-                                payload = result['codes_json'] # JSON уже готов
-                                user_logs.append(f"--- {i+1}/{len(results_to_process)}: Отправка данных для тиража ID {result['printrun_id']} (запись #{result['id']}) ---")
-                                
-                                # --- ИЗМЕНЕНО: URL зависит от наличия атрибутов ---
-                                # Если в JSON есть ключ 'attributes', используем /psp/utilisation/upload, иначе /psp/utilisation/upload/include
-                                full_url = f"{api_base_url}/psp/utilisation/upload" if 'attributes' in payload else f"{api_base_url}/psp/utilisation/upload/include"
-
-                                response = requests.post(full_url, headers=headers, json=payload, timeout=120)
-                                user_logs.append(f"  Статус ответа: {response.status_code}")
-                                response.raise_for_status()
-                                
-                                # --- ИЗМЕНЕНО: Генерируем собственный ID вместо получения из API ---
-                                # Формула: (ID заказа * 1000) + (индекс цикла + 1)
-                                generated_upload_id = (selected_order_id * 1000) + (i + 1)
-                                
-                                # Обновляем запись в delta_result
-                                cur.execute(
-                                    "UPDATE delta_result SET utilisation_upload_id = %s WHERE id = %s",
-                                    (generated_upload_id, result['id'])
-                                )
-                                user_logs.append(f"  Записи ID {result['id']} присвоен сгенерированный ID: {generated_upload_id}")
-                                updated_count += 1
-                        
-                        conn_local.commit()
-                        # --- ДОБАВЛЕНО: Обновляем api_status заказа ---
-                        with conn_local.cursor() as cur:
-                            cur.execute("UPDATE orders SET api_status = 'Сведения подготовлены' WHERE id = %s", (selected_order_id,))
-                        conn_local.commit()
-                        # --- КОНЕЦ ИЗМЕНЕНИЯ ---
-                        flash(f'Успешно обработано {updated_count} записей. Сведения подготовлены.', 'success')
-                        return redirect(url_for('.integration_panel', order_id=selected_order_id))
-
-                    except Exception as e:
-                        if conn_local: conn_local.rollback()
-                        error_body = response.text if 'response' in locals() and hasattr(response, 'text') else ""
-                        user_logs.append(f"\n!!! ОШИБКА: {e}\nОтвет сервера (если был):\n{error_body}")
-                        api_response = {'status_code': 500, 'body': "\n".join(user_logs)}
-                    finally:
-                        if conn_local: conn_local.close()
-                    # ВАЖНО: Завершаем выполнение здесь, чтобы не провалиться в старую логику
-                    return render_template('integration_panel.html', orders=orders, selected_order_id=selected_order_id, selected_order=selected_order, api_response=api_response, title="Интеграция")
-
-                user_logs = []
-                try:
-                    conn_local = get_db_connection()
-                    with conn_local.cursor(cursor_factory=RealDictCursor) as cur:
-                        # --- ИЗМЕНЕНО: Выбираем только те строки, где сведения еще не были подготовлены (utilisation_upload_id IS NULL) ---
-                        cur.execute(
-                            """
-                            SELECT 
-                                d.api_id, d.gtin, d.production_date, d.expiry_date,
-                                o.fias_code,
-                                d.id as detail_id
-                            FROM dmkod_aggregation_details d
-                            JOIN orders o ON d.order_id = o.id
-                            WHERE d.order_id = %s AND d.api_id IS NOT NULL AND d.utilisation_upload_id IS NULL
-                            ORDER BY d.id
                             """,
                             (selected_order_id,)
                         )
-                        details_to_process = cur.fetchall()
-
-                    # --- ИЗМЕНЕНО: Сообщение пользователю, если все уже обработано ---
-                    if not details_to_process:
-                        flash("Все сведения для данного заказа уже были подготовлены и отправлены в API.", 'info')
-                        return redirect(url_for('.integration_panel', order_id=selected_order_id))
-
-                    api_base_url = os.getenv('API_BASE_URL', '').rstrip('/')
-                    full_url = f"{api_base_url}/psp/utilisation/upload"
-                    headers = {'Authorization': f'Bearer {access_token}'}
-                    
-                    user_logs.append(f"Найдено {len(details_to_process)} позиций для подготовки сведений.")
-
-                    # --- ИЗМЕНЕНО: Оборачиваем отправку в транзакцию ---
-                    with conn_local.cursor() as cur:
-                        for i, detail in enumerate(details_to_process):
-                            attributes = {}
-                            if detail.get('production_date'):
-                                attributes['production_date'] = detail['production_date'].strftime('%Y-%m-%d')
-                            if detail.get('expiry_date'):
-                                attributes['expiration_date'] = detail['expiry_date'].strftime('%Y-%m-%d')
-                            if detail.get('fias_code'):
-                                attributes['fias_id'] = detail['fias_code']
-
-                            payload = {"all_from_printrun": detail['api_id']}
-                            if attributes:
-                                payload['attributes'] = attributes
-
-                            user_logs.append(f"--- {i+1}/{len(details_to_process)}: Отправка запроса для GTIN {detail['gtin']} (ID тиража: {detail['api_id']}) ---")
-                            
-                            # РЕКОМЕНДАЦИЯ: Запускайте Gunicorn с увеличенным таймаутом, например:
-                            # gunicorn --workers 3 --timeout 300 'app:create_app()'
-                            # Увеличиваем таймаут для одного запроса, чтобы дать API больше времени на обработку.
-                            response = requests.post(full_url, headers=headers, json=payload, timeout=240)
-                            
-                            user_logs.append(f"  URL: {full_url}")
-                            user_logs.append(f"  Тело: {json.dumps(payload)}")
-                            user_logs.append(f"  Статус ответа: {response.status_code}")
-                            
-                            response.raise_for_status()
-
-                            # --- ИЗМЕНЕНО: Генерируем собственный ID вместо получения из API ---
-                            # Формула: (ID заказа * 1000) + (индекс цикла + 1)
-                            generated_upload_id = (selected_order_id * 1000) + (i + 1)
-                            
-                            cur.execute(
-                                "UPDATE dmkod_aggregation_details SET utilisation_upload_id = %s WHERE id = %s",
-                                (generated_upload_id, detail['detail_id'])
-                            )
-                            user_logs.append(f"  Записи детализации ID {detail['detail_id']} присвоен сгенерированный ID: {generated_upload_id}")
-
-                        # Обновляем статус заказа в нашей БД только после успешной обработки всех позиций
-                        cur.execute("UPDATE orders SET api_status = 'Сведения подготовлены' WHERE id = %s", (selected_order_id,))
-                    conn_local.commit() # Коммитим все изменения разом
-
-                    flash('Операция "Подготовить сведения" успешно выполнена. Статус заказа обновлен.', 'success')
-                    # Перенаправляем, чтобы обновить состояние кнопок
-                    return redirect(url_for('.integration_panel', order_id=selected_order_id))
-
-                except Exception as e:
-                    error_body = response.text if 'response' in locals() and hasattr(response, 'text') else ""
-                    user_logs.append(f"\n!!! ОШИБКА: {e}\nОтвет сервера (если был):\n{error_body}")
-                    api_response = {'status_code': 500, 'body': "\n".join(user_logs)}
-                finally:
-                    if 'conn_local' in locals() and conn_local: conn_local.close()
-
-            elif action == 'prepare_report':
-                access_token = session.get('api_access_token')
-                if not access_token:
-                    flash('Токен API не найден. Пожалуйста, войдите заново.', 'warning')
-                    return redirect(url_for('.login'))
-
-                if not selected_order or not selected_order.get('api_order_id'):
-                    flash('Сначала необходимо создать заказ в API и разбить его на тиражи.', 'danger')
-                    return redirect(url_for('.integration_panel', order_id=selected_order_id))
-
-                user_logs = []
-                try:
-                    conn_local = get_db_connection()
-                    with conn_local.cursor(cursor_factory=RealDictCursor) as cur:
-                        cur.execute(
-                            "SELECT id, api_id, gtin FROM dmkod_aggregation_details WHERE order_id = %s AND api_id IS NOT NULL ORDER BY id",
-                            (selected_order_id,)
-                        )
-                        details_to_process = cur.fetchall()
-
-                    if not details_to_process:
-                        raise Exception("Не найдено позиций с ID тиража (api_id) для подготовки отчета.")
-
-                    api_base_url = os.getenv('API_BASE_URL', '').rstrip('/')
-                    full_url = f"{api_base_url}/psp/utilisation/report/create"
-                    headers = {'Authorization': f'Bearer {access_token}'}
-                    
-                    user_logs.append(f"Найдено {len(details_to_process)} позиций для подготовки отчета.")
-
-                    for i, detail in enumerate(details_to_process):
-                        payload = {"printrun_id": detail['api_id']}
-                        user_logs.append(f"--- {i+1}/{len(details_to_process)}: Отправка запроса для GTIN {detail['gtin']} (ID тиража: {detail['api_id']}) ---")
-                        
-                        # Увеличиваем таймаут для одного запроса, чтобы дать API больше времени на обработку.
-                        # Общий таймаут Gunicorn также должен быть увеличен.
-                        response = requests.post(full_url, headers=headers, json=payload, timeout=120)
-                        
-                        user_logs.append(f"  URL: {full_url}")
-                        user_logs.append(f"  Тело: {json.dumps(payload)}")
-                        user_logs.append(f"  Статус ответа: {response.status_code}")
-                        
-                        response.raise_for_status()
-
-                    # Обновляем статус заказа в нашей БД
-                    with conn_local.cursor() as cur:
-                        cur.execute(
-                            "UPDATE orders SET api_status = 'Отчет подготовлен' WHERE id = %s",
-                            (selected_order_id,)
-                        )
-                    conn_local.commit()
-
-                    flash('Операция "Подготовить отчет" успешно выполнена. Статус заказа обновлен.', 'success')
-                    # Перенаправляем, чтобы обновить состояние кнопок
-                    return redirect(url_for('.integration_panel', order_id=selected_order_id))
-                    api_response = {'status_code': 200, 'body': "\n".join(user_logs)}
-
-                except Exception as e:
-                    error_body = response.text if 'response' in locals() and hasattr(response, 'text') else ""
-                    user_logs.append(f"\n!!! ОШИБКА: {e}\nОтвет сервера (если был):\n{error_body}")
-                    api_response = {'status_code': 500, 'body': "\n".join(user_logs)}
-                finally:
-                    if 'conn_local' in locals() and conn_local: conn_local.close()
+                        has_codes = cur.fetchone()[0]
 
-            elif action == 'export_delta':
-                user_logs = []
-                try:
-                    conn_local = get_db_connection()
-                    with conn_local.cursor(cursor_factory=RealDictCursor) as cur:
-                        # Получаем все детали заказа с кодами и датами
-                        cur.execute(
-                            """
-                            SELECT 
-                                api_codes_json,
-                                production_date,
-                                expiry_date
-                            FROM dmkod_aggregation_details
-                            WHERE order_id = %s AND api_codes_json IS NOT NULL
-                            """,
-                            (selected_order_id,)
-                        )
-                        details_to_process = cur.fetchall()
-
-                    if not details_to_process:
-                        raise Exception("В заказе нет скачанных кодов для выгрузки.")
-
-                    # Используем StringIO для сборки CSV в памяти
-                    output = StringIO()
-                    # Используем pandas для удобной работы с данными и CSV
-                    all_rows = []
-
-                    for detail in details_to_process:
-                        codes = detail['api_codes_json'].get('codes', [])
-                        prod_date = detail.get('production_date')
-                        exp_date = detail.get('expiry_date')
-
-                        life_time_months = ''
-                        if prod_date and exp_date:
-                            # Считаем разницу в месяцах
-                            delta = relativedelta(exp_date, prod_date)
-                            life_time_months = delta.years * 12 + delta.months
-
-                        for code in codes:
-                            if not code or len(code) < 16:
-                                continue # Пропускаем некорректные коды
-                            
-                            all_rows.append({
-                                'DataMatrix': code,
-                                'DataMatrixCode': '',
-                                'Barcode': code[3:16], # Извлекаем EAN-13 (символы с 4 по 16)
-                                'LifeTime': life_time_months
-                            })
-                    
-                    if not all_rows:
+                    if not has_codes:
                         raise Exception("Не найдено корректных кодов для выгрузки.")
 
-                    # --- ИСПРАВЛЕНО: Обновляем статус заказа на 'delta' в той же транзакции ---
+                    # --- ИСПРАВЛЕНО: Обновляем статус заказа на 'delta' до начала выгрузки ---
                     with conn_local.cursor() as cur:
                         cur.execute("UPDATE orders SET status = 'delta' WHERE id = %s", (selected_order_id,))
                         conn_local.commit()
-                    user_logs.append(f"Статус заказа #{selected_order_id} обновлен на 'delta'.")
                     flash(f"Статус заказа #{selected_order_id} обновлен на 'delta'.", "info")
 
-                    df = pd.DataFrame(all_rows)
-
-                    # Используем StringIO для сборки CSV в памяти,
-                    # так как старая версия pandas не поддерживает line_terminator.
-                    # Мы сделаем замену вручную.
-                    buffer = StringIO()
-                    import csv
-                    df.to_csv(buffer, sep='\t', index=False, encoding='utf-8', quoting=csv.QUOTE_NONE)
-                    
-                    # Получаем содержимое как строку и заменяем окончания строк на CRLF для Windows
-                    csv_content_windows = buffer.getvalue().replace('\n', '\r\n')
-                    
-                    # Отправляем итоговый файл
-                    return send_file(BytesIO(csv_content_windows.encode('utf-8')),
-                                     mimetype='text/csv',
-                                     as_attachment=True,
-                                     download_name=f'delta_export_order_{selected_order_id}.csv')
+                    # Файл формируется построчно прямо в ответ; stream_with_context держит контекст запроса,
+                    # поэтому соединение запроса возвращается в пул только после окончания выгрузки.
+                    return Response(
+                        stream_with_context(_generate_delta_export(selected_order_id)),
+                        mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename=delta_export_order_{selected_order_id}.csv'}
+                    )
                 except Exception as e:
                     if 'conn_local' in locals() and conn_local: conn_local.rollback()
                     flash(f'Ошибка при формировании отчета "Дельта": {e}', 'danger')
@@ -1803,19 +1061,81 @@ def integration_panel():
         if conn: conn.rollback()
         orders = [] # Очищаем список заказов в случае ошибки
     finally:
-        # Проверяем, есть ли файл для скачивания в сессии
-        if 'download_file' in session:
-            file_info = session.pop('download_file')
-            if conn: conn.close() # Закрываем соединение перед отправкой файла
-            return send_file(
-                BytesIO(file_info['data']),
-                mimetype=file_info['mimetype'],
-                as_attachment=True,
-                download_name=file_info['name']
-            )
         if conn: conn.close()
 
-    return render_template('integration_panel.html', orders=orders, selected_order_id=selected_order_id, selected_order=selected_order, api_response=api_response, title="Интеграция")
+    return render_template('integration_panel.html', orders=orders, selected_order_id=selected_order_id, selected_order=selected_order,
+                           workflow_job=workflow_job, api_response=api_response, title="Интеграция")
+
+
+@dmkod_bp.route('/integration_panel/jobs/<int:job_id>')
+@login_required
+@api_token_required
+def workflow_job_status(job_id):
+    """Состояние фонового шага интеграции для опроса со страницы 'Интеграция'."""
+    conn = get_db_connection()
+    try:
+        job = get_job(conn, job_id)
+    finally:
+        conn.close()
+    if not job:
+        return jsonify({'error': 'Задание не найдено'}), 404
+    return jsonify(job_to_dict(job))
+
+
+@dmkod_bp.route('/integration/<int:order_id>/codes_archive')
+@login_required
+@api_token_required
+def download_codes_archive(order_id):
+    """ZIP-архив с кодами заказа, собранный из кодов, скачанных фоновым шагом 'Скачать коды'."""
+    conn = get_db_connection()
+    archive = tempfile.TemporaryFile()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SELECT client_name FROM orders WHERE id = %s", (order_id,))
+            client_name_row = cur.fetchone()
+        if not client_name_row:
+            flash(f"Не удалось найти клиента для заказа ID {order_id}.", 'danger')
+            return redirect(url_for('.integration_panel', order_id=order_id))
+
+        # Санитизируем имя клиента для использования в именах файлов
+        sanitized_client_name = _sanitize_filename_part(client_name_row['client_name'])
+        files_written = 0
+        # Именованный курсор: коды тиражей читаются по одному, а не все сразу
+        with conn.cursor(name=f'codes_archive_{order_id}', cursor_factory=RealDictCursor) as cur:
+            cur.itersize = 1
+            cur.execute(
+                "SELECT api_codes_json FROM dmkod_aggregation_details WHERE order_id = %s AND api_id IS NOT NULL ORDER BY id",
+                (order_id,)
+            )
+            with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+                for i, detail in enumerate(cur):
+                    codes = (detail['api_codes_json'] or {}).get('codes', [])
+                    if not codes:
+                        continue
+                    csv_filename_parts = [f"{i+1}", f"{order_id}"]
+                    if sanitized_client_name:
+                        csv_filename_parts.append(sanitized_client_name)
+                    csv_filename_parts.append(f"{len(codes)}")
+                    zf.writestr("_".join(csv_filename_parts) + ".csv", "\n".join(codes))
+                    files_written += 1
+
+        if not files_written:
+            flash('Коды для заказа еще не скачаны.', 'warning')
+            return redirect(url_for('.integration_panel', order_id=order_id))
+
+        # Формируем имя ZIP-файла, избегая лишнего подчеркивания
+        zip_download_name_parts = [f"codes_order_{order_id}"]
+        if sanitized_client_name:
+            zip_download_name_parts.append(sanitized_client_name)
+        archive.seek(0)
+        return send_file(archive, mimetype='application/zip', as_attachment=True,
+                         download_name="_".join(zip_download_name_parts) + ".zip")
+    except Exception as e:
+        archive.close()
+        flash(f'Ошибка при формировании архива с кодами: {e}', 'danger')
+        return redirect(url_for('.integration_panel', order_id=order_id))
+    finally:
+        conn.close()
     
 @dmkod_bp.route('/admin', methods=['GET', 'POST'])
 @login_required
@@ -1838,9 +1158,15 @@ def admin():
                 with conn.cursor() as cur:
                     # ВАЖНО: Каскадное удаление связанных данных
                     cur.execute("DELETE FROM dmkod_aggregation_details WHERE order_id = ANY(%s)", (order_ids_to_delete,))
-                    cur.execute("DELETE FROM dmkod_order_files WHERE order_id = ANY(%s)", (order_ids_to_delete,))
+                    cur.execute(
+                        "DELETE FROM dmkod_order_files WHERE order_id = ANY(%s) RETURNING checksum_sha256",
+                        (order_ids_to_delete,)
+                    )
+                    deleted_checksums = [row[0] for row in cur.fetchall()]
                     cur.execute("DELETE FROM orders WHERE id = ANY(%s)", (order_ids_to_delete,))
                 conn.commit()
+                # Файлы удаляются с диска после фиксации и только если на них не ссылаются другие заказы
+                _cleanup_stored_files(conn, deleted_checksums)
                 flash(f'Успешно удалено заказов: {len(order_ids_to_delete)}.', 'success')
             except Exception as e:
                 conn.rollback()
@@ -0,0 +1,34 @@
+# dmkod-integration-app/app/worker.py
+"""
+Процесс-обработчик фоновых шагов интеграции (см. app/workflow.py).
+
+Запуск из папки dmkod-integration-app:
+    python -m app.worker
+Количество потоков задается переменной WORKFLOW_WORKER_THREADS (по умолчанию 4).
+"""
+import logging
+import os
+import signal
+import threading
+
+from dotenv import load_dotenv
+
+from .workflow import run_worker
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(threadName)s - %(message)s')
+
+    dotenv_path = os.path.join(os.path.dirname(__file__), '..', '..', '.env')
+    if os.path.exists(dotenv_path):
+        load_dotenv(dotenv_path=dotenv_path)
+
+    stop_event = threading.Event()
+    # docker stop посылает SIGTERM: даем потокам закончить текущую итерацию.
+    # Незавершенный шаг после истечения аренды заберет следующий запуск обработчика.
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    run_worker(stop_event=stop_event)
+
+
+if __name__ == '__main__':
+    main()
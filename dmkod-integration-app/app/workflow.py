@@ -0,0 +1,385 @@
+# dmkod-integration-app/app/workflow.py
+"""
+Фоновое выполнение шагов интеграции с API ДМкод.
+
+Веб-процесс только ставит шаг в очередь (строка в таблице dmkod_workflow_jobs) и сразу отвечает,
+а выполняет шаг отдельный процесс-обработчик (app/worker.py). Состояние шага, попытки и журнал
+хранятся в БД, поэтому переживают перезапуск контейнеров, а страница интеграции опрашивает прогресс.
+
+- Для одного заказа одновременно может быть активен только один шаг (уникальный частичный индекс).
+- Задания забираются через FOR UPDATE SKIP LOCKED, поэтому обработчиков и потоков может быть несколько.
+- Пока шаг выполняется, отдельный поток обработчика продлевает "аренду" (locked_until), даже если
+  шаг долго ждет ответа API. Если процесс упал, задание после истечения аренды забирает другой
+  обработчик; задание, у которого попытки исчерпаны, завершается со статусом 'failed'.
+- Токен API берется из общего кэша (app/api_cache.py).
+- Временные сбои (нет соединения, 429/502/503/504) повторяются с экспоненциальной задержкой,
+  остальные ошибки сразу завершают шаг со статусом 'failed'.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import requests
+from psycopg2.extras import RealDictCursor
+
+from .api_cache import api_cache
+from .api_client import get_api_base_url
+from .db import get_db_connection
+
+JOBS_TABLE = 'dmkod_workflow_jobs'
+ACTIVE_STATUSES = ('pending', 'running')
+
+MAX_ATTEMPTS = int(os.getenv('WORKFLOW_MAX_ATTEMPTS', '5'))
+RETRY_BASE_SECONDS = int(os.getenv('WORKFLOW_RETRY_BASE_SECONDS', '30'))
+LEASE_SECONDS = int(os.getenv('WORKFLOW_LEASE_SECONDS', '300'))
+POLL_INTERVAL_SECONDS = float(os.getenv('WORKFLOW_POLL_INTERVAL_SECONDS', '2'))
+
+# HTTP-статусы, при которых запрос имеет смысл повторить позже
+TRANSIENT_HTTP_STATUSES = {429, 502, 503, 504}
+
+# Реестр шагов: имя -> (функция, название для интерфейса)
+STEPS = {}
+
+
+class WorkflowBusyError(Exception):
+    """Для заказа уже выполняется другой шаг."""
+
+
+class TransientStepError(Exception):
+    """Временный сбой: шаг будет повторен."""
+
+
+def workflow_step(name, title):
+    """Декоратор регистрации функции шага. Функция принимает (ctx, conn)."""
+    def decorator(func):
+        STEPS[name] = (func, title)
+        return func
+    return decorator
+
+
+def step_title(name):
+    return STEPS[name][1] if name in STEPS else name
+
+
+# --- Постановка в очередь и чтение состояния (веб-процесс) ---
+
+def enqueue_step(conn, order_id, step, params=None, created_by=None):
+    """Ставит шаг в очередь и возвращает id задания. Коммитит транзакцию `conn`."""
+    if step not in STEPS:
+        raise ValueError(f"Неизвестный шаг интеграции: {step}")
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                INSERT INTO {JOBS_TABLE} (order_id, step, params, max_attempts, created_by)
+                VALUES (%s, %s, %s, %s, %s)
+                RETURNING id
+                """,
+                (order_id, step, json.dumps(params or {}), MAX_ATTEMPTS, created_by)
+            )
+            job_id = cur.fetchone()[0]
+        conn.commit()
+        return job_id
+    except psycopg2.errors.UniqueViolation:
+        conn.rollback()
+        raise WorkflowBusyError(f"Для заказа №{order_id} уже выполняется другая операция.")
+
+
+def get_job(conn, job_id):
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(f"SELECT * FROM {JOBS_TABLE} WHERE id = %s", (job_id,))
+        return cur.fetchone()
+
+
+def get_latest_job(conn, order_id):
+    """Активное задание заказа, а если его нет - последнее завершенное."""
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(
+            f"""
+            SELECT * FROM {JOBS_TABLE}
+            WHERE order_id = %s
+            ORDER BY (status IN ('pending', 'running')) DESC, id DESC
+            LIMIT 1
+            """,
+            (order_id,)
+        )
+        return cur.fetchone()
+
+
+def job_to_dict(job):
+    """Представление задания для JSON-ответа страницы опроса."""
+    return {
+        'id': job['id'],
+        'order_id': job['order_id'],
+        'step': job['step'],
+        'title': step_title(job['step']),
+        'status': job['status'],
+        'attempts': job['attempts'],
+        'max_attempts': job['max_attempts'],
+        'run_after': job['run_after'].isoformat() if job['run_after'] else None,
+        'error': job['error'],
+        'log': job['log'] or '',
+        'result': job['result'] or {},
+        'finished': job['status'] not in ACTIVE_STATUSES,
+    }
+
+
+# --- Контекст выполнения шага (процесс-обработчик) ---
+
+class StepContext:
+    """
+    Передается в функцию шага: параметры задания, журнал и вызовы API.
+    Журнал и аренда пишутся через отдельное соединение в режиме autocommit,
+    чтобы прогресс был виден сразу, независимо от транзакции самого шага.
+    """
+
+    def __init__(self, job, job_conn):
+        self.job_id = job['id']
+        self.worker = job['worker']
+        self.order_id = job['order_id']
+        self.params = job['params'] or {}
+        # Результат и прогресс предыдущих попыток этого же задания (см. save_progress)
+        self.result = dict(job['result'] or {})
+        self._job_conn = job_conn
+        self._job_conn_lock = threading.Lock()
+        self._access_token = None
+
+    def log(self, message):
+        """Добавляет строку в журнал задания. Можно вызывать из нескольких потоков шага."""
+        logging.info(f"[workflow job {self.job_id}] {message}")
+        with self._job_conn_lock, self._job_conn.cursor() as cur:
+            cur.execute(
+                f"""
+                UPDATE {JOBS_TABLE}
+                SET log = log || %s, locked_until = NOW() + make_interval(secs => %s), updated_at = NOW()
+                WHERE id = %s
+                """,
+                (message + "\n", LEASE_SECONDS, self.job_id)
+            )
+
+    def save_progress(self):
+        """
+        Сразу сохраняет self.result в задании. Шаг отмечает в нем уже выполненные запросы к API,
+        которые нельзя повторять: при повторе задания (в т.ч. после падения обработчика) они пропускаются.
+        """
+        with self._job_conn_lock, self._job_conn.cursor() as cur:
+            cur.execute(
+                f"UPDATE {JOBS_TABLE} SET result = %s, updated_at = NOW() WHERE id = %s",
+                (json.dumps(self.result), self.job_id)
+            )
+
+    def renew_lease(self):
+        """Продлевает аренду задания, если оно все еще выполняется этим обработчиком."""
+        with self._job_conn_lock, self._job_conn.cursor() as cur:
+            cur.execute(
+                f"""
+                UPDATE {JOBS_TABLE}
+                SET locked_until = NOW() + make_interval(secs => %s), updated_at = NOW()
+                WHERE id = %s AND status = 'running' AND worker = %s
+                """,
+                (LEASE_SECONDS, self.job_id, self.worker)
+            )
+
+    def _renew_lease_periodically(self, stop_event):
+        while not stop_event.wait(LEASE_SECONDS / 3):
+            try:
+                self.renew_lease()
+            except psycopg2.Error:
+                logging.exception(f"[workflow job {self.job_id}] Не удалось продлить аренду задания.")
+
+    @contextmanager
+    def keep_lease(self):
+        """Продлевает аренду из отдельного потока, пока выполняется блок (шаг может долго молчать в ожидании API)."""
+        stop_event = threading.Event()
+        heartbeat = threading.Thread(target=self._renew_lease_periodically, args=(stop_event,),
+                                     name=f"workflow-lease-{self.job_id}", daemon=True)
+        heartbeat.start()
+        try:
+            yield
+        finally:
+            stop_event.set()
+            heartbeat.join()
+
+    def _headers(self, refresh=False):
+        if refresh:
+            # Сбрасываем в общем кэше только наш токен: другой процесс мог уже получить новый
+            api_cache.invalidate_token(self._access_token)
+            self._access_token = None
+        if not self._access_token:
+            self._access_token = api_cache.get_access_token()
+        return {'Authorization': f'Bearer {self._access_token}'}
+
+    def api(self, method, path, headers=None, idempotent=False, **kwargs):
+        """
+        Запрос к API ДМкод. Возвращает ответ без raise_for_status, как requests.
+        Сетевые сбои и временные HTTP-статусы превращаются в TransientStepError.
+        `idempotent=True` - запрос безопасно повторять даже после таймаута (например, POST с Idempotency-Key).
+        """
+        url = f"{get_api_base_url()}{path}"
+        extra_headers = headers or {}
+        try:
+            response = requests.request(method, url, headers={**self._headers(), **extra_headers}, **kwargs)
+            if response.status_code == 401:
+                # Токен истек - получаем новый и повторяем запрос один раз
+                response.close()
+                response = requests.request(method, url, headers={**self._headers(refresh=True), **extra_headers}, **kwargs)
+        except requests.exceptions.ConnectionError as e:
+            raise TransientStepError(f"Нет соединения с API: {e}") from e
+        except requests.exceptions.ReadTimeout as e:
+            # Неидемпотентный POST мог быть выполнен на стороне API, поэтому повторяем только чтение
+            if idempotent or method.upper() == 'GET':
+                raise TransientStepError(f"Превышено время ожидания ответа API: {e}") from e
+            raise
+        if response.status_code in TRANSIENT_HTTP_STATUSES:
+            raise TransientStepError(f"API временно недоступно (статус {response.status_code}): {response.text[:500]}")
+        return response
+
+
+# --- Обработчик очереди ---
+
+def _fail_abandoned_jobs(job_conn):
+    """Завершает задания, брошенные упавшим обработчиком на последней попытке: повторять их больше нельзя."""
+    with job_conn.cursor() as cur:
+        cur.execute(
+            f"""
+            UPDATE {JOBS_TABLE}
+            SET status = 'failed', error = %s, log = log || %s, locked_until = NULL,
+                finished_at = NOW(), updated_at = NOW()
+            WHERE status = 'running' AND locked_until < NOW() AND attempts >= max_attempts
+            """,
+            ("Обработчик прервался, попытки исчерпаны.", "!!! Обработчик прервался, попытки исчерпаны.\n")
+        )
+
+
+def _claim_job(job_conn, worker_name):
+    """Забирает одно готовое к выполнению задание и переводит его в 'running'."""
+    _fail_abandoned_jobs(job_conn)
+    with job_conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(
+            f"""
+            UPDATE {JOBS_TABLE}
+            SET status = 'running', attempts = attempts + 1, worker = %s, error = NULL,
+                started_at = COALESCE(started_at, NOW()), updated_at = NOW(),
+                locked_until = NOW() + make_interval(secs => %s)
+            WHERE id = (
+                SELECT id FROM {JOBS_TABLE}
+                WHERE (status = 'pending' AND run_after <= NOW())
+                   OR (status = 'running' AND locked_until < NOW() AND attempts < max_attempts)
+                ORDER BY run_after, id
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING *
+            """,
+            (worker_name, LEASE_SECONDS)
+        )
+        return cur.fetchone()
+
+
+def _finish_job(job_conn, job_id, status, error=None, result=None, retry_in=None):
+    with job_conn.cursor() as cur:
+        if retry_in is not None:
+            cur.execute(
+                f"""
+                UPDATE {JOBS_TABLE}
+                SET status = 'pending', error = %s, run_after = NOW() + make_interval(secs => %s),
+                    locked_until = NULL, updated_at = NOW()
+                WHERE id = %s
+                """,
+                (error, retry_in, job_id)
+            )
+        else:
+            cur.execute(
+                f"""
+                UPDATE {JOBS_TABLE}
+                SET status = %s, error = %s, result = %s, locked_until = NULL,
+                    finished_at = NOW(), updated_at = NOW()
+                WHERE id = %s
+                """,
+                (status, error, json.dumps(result or {}), job_id)
+            )
+
+
+def run_job(job, job_conn):
+    """Выполняет шаг задания в собственном соединении с БД и записывает итог."""
+    ctx = StepContext(job, job_conn)
+    step_func, title = STEPS.get(job['step'], (None, job['step']))
+    if step_func is None:
+        _finish_job(job_conn, job['id'], 'failed', error=f"Неизвестный шаг: {job['step']}")
+        return
+
+    ctx.log(f"=== {title}: попытка {job['attempts']} из {job['max_attempts']} ===")
+    conn = get_db_connection()
+    try:
+        with ctx.keep_lease():
+            step_func(ctx, conn)
+            conn.commit()
+        ctx.log("Шаг успешно завершен.")
+        _finish_job(job_conn, job['id'], 'done', result=ctx.result)
+    except TransientStepError as e:
+        conn.rollback()
+        if job['attempts'] < job['max_attempts']:
+            retry_in = RETRY_BASE_SECONDS * 2 ** (job['attempts'] - 1)
+            ctx.log(f"!!! Временная ошибка: {e}\nПовтор через {retry_in} с.")
+            _finish_job(job_conn, job['id'], 'pending', error=str(e), retry_in=retry_in)
+        else:
+            ctx.log(f"!!! Временная ошибка: {e}\nПопытки исчерпаны.")
+            _finish_job(job_conn, job['id'], 'failed', error=str(e), result=ctx.result)
+    except Exception as e:
+        conn.rollback()
+        logging.exception(f"[workflow job {job['id']}] Ошибка шага '{job['step']}'")
+        ctx.log(f"!!! ОШИБКА: {e}")
+        _finish_job(job_conn, job['id'], 'failed', error=str(e), result=ctx.result)
+    finally:
+        conn.close()
+
+
+def _worker_loop(worker_name, stop_event):
+    job_conn = None
+    while not stop_event.is_set():
+        try:
+            if job_conn is None or job_conn.closed:
+                job_conn = get_db_connection()
+                job_conn.autocommit = True
+            job = _claim_job(job_conn, worker_name)
+            if job is None:
+                stop_event.wait(POLL_INTERVAL_SECONDS)
+                continue
+            run_job(job, job_conn)
+        except psycopg2.Error:
+            logging.exception(f"[{worker_name}] Ошибка БД в цикле обработчика, переподключение.")
+            if job_conn is not None:
+                job_conn.close()
+            job_conn = None
+            stop_event.wait(POLL_INTERVAL_SECONDS)
+    if job_conn is not None:
+        job_conn.close()
+
+
+def run_worker(threads=None, stop_event=None):
+    """Запускает `threads` потоков-обработчиков и ждет их завершения."""
+    # Регистрация шагов интеграции
+    from . import integration_steps  # noqa: F401
+
+    threads = threads or int(os.getenv('WORKFLOW_WORKER_THREADS', '4'))
+    stop_event = stop_event or threading.Event()
+    base_name = f"{socket.gethostname()}:{os.getpid()}"
+    workers = [
+        threading.Thread(target=_worker_loop, args=(f"{base_name}:{i}", stop_event), name=f"workflow-{i}", daemon=True)
+        for i in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    logging.info(f"Обработчик шагов интеграции запущен: {threads} потоков.")
+    try:
+        while any(worker.is_alive() for worker in workers):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop_event.set()
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,96 @@
+# dmkod-integration-app/benchmarks/delta_csv_benchmark.py
+"""
+Бенчмарк разбора CSV-файла "Дельта" без базы данных.
+
+Генерирует фикстуру - файл в формате выгрузки "Дельта" (по умолчанию 500 000 строк) -
+и замеряет время каждого этапа преобразования из app/delta_import.py.
+
+Запуск из папки dmkod-integration-app:
+    python -m benchmarks.delta_csv_benchmark
+    python -m benchmarks.delta_csv_benchmark --rows 100000 --legacy
+"""
+import argparse
+import os
+import random
+import string
+import tempfile
+import time
+
+import pandas as pd
+
+from app.delta_import import (
+    GS_SEPARATOR, parse_datamatrix, parse_datamatrix_series, map_parent_sscc, build_delta_payloads
+)
+
+CODES_PER_BOX = 20
+BOXES_PER_PALLET = 40
+GTINS = ['04600000000017', '04600000000024', '04600000000031', '04600000000048']
+# Символы, допустимые в серийном номере и криптохвосте (без GS)
+CODE_ALPHABET = string.ascii_letters + string.digits + '!%&()*+,-./:;<=>?_'
+
+
+def generate_delta_fixture(path: str, rows: int, seed: int = 42):
+    """Записывает в `path` TSV-файл "Дельта" с `rows` кодами."""
+    rnd = random.Random(seed)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write('DataMatrix\tBarcode\tStartDate\tEndDate\tBoxSSCC\tPaletSSCC\n')
+        for i in range(rows):
+            gtin = GTINS[i % len(GTINS)]
+            serial = ''.join(rnd.choices(CODE_ALPHABET, k=13))
+            crypto_91 = ''.join(rnd.choices(CODE_ALPHABET, k=4))
+            crypto_92 = ''.join(rnd.choices(CODE_ALPHABET, k=44))
+            datamatrix = f"01{gtin}21{serial}{GS_SEPARATOR}91{crypto_91}{GS_SEPARATOR}92{crypto_92}"
+            box = i // CODES_PER_BOX
+            pallet = box // BOXES_PER_PALLET
+            f.write(f"{datamatrix}\t{gtin}\t2025-01-15\t2027-01-15\t{100000000000000000 + box}\t{200000000000000000 + pallet}\n")
+
+
+def _timed(label, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print(f"  {label:<40} {time.perf_counter() - start:8.3f} с")
+    return result
+
+
+def run(path: str, legacy: bool):
+    print(f"\nФайл: {path} ({os.path.getsize(path) / 1024 / 1024:.1f} МБ)")
+    df = _timed("read_csv", lambda: pd.read_csv(
+        path, sep='\t', encoding='utf-8', dtype={'DataMatrix': str, 'Barcode': str, 'BoxSSCC': str, 'PaletSSCC': str}
+    ))
+    print(f"  Строк: {len(df)}")
+
+    unique_boxes = df[['BoxSSCC']].drop_duplicates().rename(columns={'BoxSSCC': 'sscc'}).assign(level=1)
+    unique_pallets = df[['PaletSSCC']].drop_duplicates().rename(columns={'PaletSSCC': 'sscc'}).assign(level=2)
+    packages_df = pd.concat([unique_boxes, unique_pallets], ignore_index=True)
+    box_pallet_map = df[['BoxSSCC', 'PaletSSCC']].drop_duplicates()
+
+    _timed("map_parent_sscc", map_parent_sscc, packages_df, box_pallet_map)
+    _timed("parse_datamatrix_series", parse_datamatrix_series, df['DataMatrix'])
+    gtin_to_printrun_map = {gtin: 1000 + i for i, gtin in enumerate(GTINS)}
+    payloads = _timed("build_delta_payloads", build_delta_payloads, df, gtin_to_printrun_map)
+    print(f"  Групп для delta_result: {len(payloads)}")
+
+    if legacy:
+        # Построчный разбор, как было до векторизации, - для сравнения
+        _timed("parse_datamatrix (построчно)", lambda: pd.DataFrame([parse_datamatrix(dm) for dm in df['DataMatrix']]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=500_000, help='Количество строк в фикстуре')
+    parser.add_argument('--file', help='Путь к готовому файлу "Дельта" (фикстура не генерируется)')
+    parser.add_argument('--legacy', action='store_true', help='Дополнительно замерить построчный разбор')
+    args = parser.parse_args()
+
+    if args.file:
+        run(args.file, args.legacy)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'order_0.csv')
+        _timed(f"Генерация фикстуры ({args.rows} строк)", generate_delta_fixture, path, args.rows)
+        run(path, args.legacy)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+# dmkod-integration-app/benchmarks/integration_benchmark.py
+"""
+Сквозной бенчмарк шагов интеграции с API ДМкод на локальной заглушке API (benchmarks/psp_stub_server.py).
+
+Создает в БД тестовые заказы с детализацией и проводит каждый из них по цепочке шагов
+(создать заказ -> запрос -> тиражи -> JSON -> скачать коды -> сведения -> отчет) через очередь
+dmkod_workflow_jobs и обработчик app/workflow.py - тот же код, что работает в контейнере
+dmkod-integration-worker. Замеряет время ожидания в очереди и выполнения каждого шага.
+
+Нужны локальные PostgreSQL (схема из init_db.py, параметры DB_* из .env) и, по желанию, Redis.
+Внешняя сеть не нужна. Тестовые заказы удаляются после прогона (если не указан --keep).
+
+Запуск из папки dmkod-integration-app:
+    python -m benchmarks.integration_benchmark --orders 10 --details 4 --qty 5000 --latency-ms 100
+    python -m benchmarks.integration_benchmark --error-rate 0.05 --steps create_order,create_suborder_request,split_runs
+"""
+import argparse
+import datetime
+import os
+import statistics
+import threading
+import time
+from collections import defaultdict
+
+from dotenv import load_dotenv
+
+from benchmarks.psp_stub_server import add_stub_arguments, config_from_args, start_in_thread
+
+PIPELINE = [
+    'create_order', 'create_suborder_request', 'split_runs', 'prepare_json',
+    'download_codes', 'prepare_report_data', 'prepare_report',
+]
+BENCH_CLIENT_NAME = 'BENCHMARK'
+BENCH_GROUP_NAME = 'benchmark'
+GTINS = ['04600000000017', '04600000000024', '04600000000031', '04600000000048',
+         '04600000000055', '04600000000062', '04600000000079', '04600000000086']
+
+
+def _configure_environment(args, api_base_url):
+    """Переменные окружения задаются до импорта модулей приложения: часть настроек читается при импорте."""
+    dotenv_path = os.path.join(os.path.dirname(__file__), '..', '..', '.env')
+    if os.path.exists(dotenv_path):
+        load_dotenv(dotenv_path=dotenv_path)
+    os.environ['API_BASE_URL'] = api_base_url
+    os.environ.setdefault('TABLE_PRODUCTS', 'products')
+    os.environ['DMKOD_TIRAGE_CONCURRENCY'] = str(args.tirage_concurrency)
+    os.environ['WORKFLOW_RETRY_BASE_SECONDS'] = str(args.retry_base)
+    os.environ['WORKFLOW_POLL_INTERVAL_SECONDS'] = '0.2'
+    # Отдельная база Redis, чтобы токен заглушки не попал в кэш рабочего приложения
+    os.environ['DMKOD_REDIS_DB'] = str(args.redis_db)
+
+
+def _create_orders(conn, args, run_label):
+    """Создает тестовые заказы с детализацией. Возвращает список id."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT id FROM dmkod_product_groups WHERE group_name = %s LIMIT 1", (BENCH_GROUP_NAME,))
+        row = cur.fetchone()
+        if row:
+            group_id = row[0]
+        else:
+            cur.execute(
+                "INSERT INTO dmkod_product_groups (group_name, display_name, dm_template) VALUES (%s, %s, %s) RETURNING id",
+                (BENCH_GROUP_NAME, 'Бенчмарк', 'benchmark')
+            )
+            group_id = cur.fetchone()[0]
+
+        order_ids = []
+        production_date = datetime.date.today()
+        expiry_date = production_date + datetime.timedelta(days=730)
+        for i in range(args.orders):
+            cur.execute(
+                """
+                INSERT INTO orders (client_name, status, notes, participant_id, product_group_id)
+                VALUES (%s, 'dmkod', %s, %s, %s) RETURNING id
+                """,
+                (BENCH_CLIENT_NAME, f"{run_label} #{i + 1}", 1, group_id)
+            )
+            order_id = cur.fetchone()[0]
+            order_ids.append(order_id)
+            for j in range(args.details):
+                cur.execute(
+                    """
+                    INSERT INTO dmkod_aggregation_details (order_id, gtin, dm_quantity, aggregation_level, production_date, expiry_date)
+                    VALUES (%s, %s, %s, 0, %s, %s)
+                    """,
+                    (order_id, GTINS[j % len(GTINS)], args.qty, production_date, expiry_date)
+                )
+    conn.commit()
+    return order_ids
+
+
+def _delete_orders(conn, order_ids):
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM dmkod_aggregation_details WHERE order_id = ANY(%s)", (order_ids,))
+        cur.execute("DELETE FROM orders WHERE id = ANY(%s)", (order_ids,))
+    conn.commit()
+
+
+def _drive(conn, order_ids, steps, timeout):
+    """
+    Ведет каждый заказ по цепочке шагов: следующий шаг ставится в очередь, как только завершен предыдущий.
+    Возвращает {order_id: [задания]} и словарь заказов, остановившихся на ошибке.
+    """
+    from app.workflow import enqueue_step, get_job
+
+    position = {order_id: 0 for order_id in order_ids}
+    current_job = {order_id: enqueue_step(conn, order_id, steps[0], {'contact_person': 'benchmark'}, 'benchmark')
+                   for order_id in order_ids}
+    finished_jobs = defaultdict(list)
+    failed = {}
+    deadline = time.monotonic() + timeout
+
+    while current_job and time.monotonic() < deadline:
+        for order_id, job_id in list(current_job.items()):
+            job = get_job(conn, job_id)
+            conn.commit()
+            if job['status'] in ('pending', 'running'):
+                continue
+            finished_jobs[order_id].append(job)
+            if job['status'] == 'failed':
+                failed[order_id] = f"{job['step']}: {job['error']}"
+                del current_job[order_id]
+                continue
+            position[order_id] += 1
+            if position[order_id] >= len(steps):
+                del current_job[order_id]
+                continue
+            current_job[order_id] = enqueue_step(conn, order_id, steps[position[order_id]],
+                                                 {'contact_person': 'benchmark'}, 'benchmark')
+        time.sleep(0.1)
+
+    for order_id in current_job:
+        failed[order_id] = f"превышено время ожидания ({timeout} с)"
+    return finished_jobs, failed
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def _report(finished_jobs, failed, steps, wall_time, total_codes, stub_server):
+    by_step = defaultdict(lambda: {'run': [], 'wait': [], 'attempts': []})
+    for jobs in finished_jobs.values():
+        for job in jobs:
+            if job['status'] != 'done':
+                continue
+            stat = by_step[job['step']]
+            stat['run'].append((job['finished_at'] - job['started_at']).total_seconds())
+            stat['wait'].append((job['started_at'] - job['created_at']).total_seconds())
+            stat['attempts'].append(job['attempts'])
+
+    print(f"\n{'Шаг':<26}{'n':>4}{'p50, с':>10}{'p95, с':>10}{'max, с':>10}{'очередь p50':>13}{'попыток':>9}")
+    for step in steps:
+        stat = by_step.get(step)
+        if not stat:
+            print(f"{step:<26}{0:>4}")
+            continue
+        print(f"{step:<26}{len(stat['run']):>4}"
+              f"{statistics.median(stat['run']):>10.3f}{_percentile(stat['run'], 95):>10.3f}{max(stat['run']):>10.3f}"
+              f"{statistics.median(stat['wait']):>13.3f}{sum(stat['attempts']) / len(stat['attempts']):>9.2f}")
+
+    completed = len(finished_jobs) - len(failed)
+    print(f"\nЗаказов завершено: {completed}, с ошибкой: {len(failed)}; общее время {wall_time:.2f} с")
+    if wall_time and completed:
+        print(f"Пропускная способность: {completed / wall_time * 60:.2f} заказов/мин, {total_codes / wall_time:.0f} кодов/с")
+    for order_id, reason in failed.items():
+        print(f"  Заказ #{order_id}: {reason}")
+
+    if stub_server is not None:
+        print(f"\n{'Эндпоинт заглушки':<42}{'запросов':>10}{'ошибок':>8}{'ср., мс':>10}")
+        for endpoint, stat in sorted(stub_server.state.stats.items()):
+            avg_ms = stat['total_ms'] / stat['requests'] if stat['requests'] else 0
+            print(f"{endpoint:<42}{stat['requests']:>10}{stat['errors']:>8}{avg_ms:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=5, help='Количество тестовых заказов')
+    parser.add_argument('--details', type=int, default=3, help='Строк детализации (тиражей) в заказе')
+    parser.add_argument('--qty', type=int, default=1000, help='Кодов в строке детализации')
+    parser.add_argument('--steps', default=','.join(PIPELINE), help='Шаги через запятую (по умолчанию вся цепочка)')
+    parser.add_argument('--worker-threads', type=int, default=4, help='Потоков обработчика')
+    parser.add_argument('--no-worker', action='store_true',
+                        help='Не запускать обработчик в процессе бенчмарка (задания выполняет внешний dmkod-integration-worker)')
+    parser.add_argument('--api-base-url', help='Не запускать заглушку, а использовать уже работающую по этому адресу')
+    parser.add_argument('--tirage-concurrency', type=int, default=8, help='Одновременных запросов на создание тиражей')
+    parser.add_argument('--retry-base', type=int, default=1, help='Базовая задержка повтора при временной ошибке, с')
+    parser.add_argument('--redis-db', type=int, default=15, help='База Redis для кэша токена заглушки')
+    parser.add_argument('--timeout', type=float, default=600, help='Предельное время прогона, с')
+    parser.add_argument('--keep', action='store_true', help='Не удалять тестовые заказы после прогона')
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    steps = [step.strip() for step in args.steps.split(',') if step.strip()]
+    unknown = set(steps) - set(PIPELINE)
+    if unknown:
+        parser.error(f"Неизвестные шаги: {', '.join(sorted(unknown))}")
+
+    stub_server = None
+    api_base_url = args.api_base_url
+    if not api_base_url:
+        stub_server, api_base_url = start_in_thread(config=config_from_args(args))
+    _configure_environment(args, api_base_url)
+    print(f"API: {api_base_url}")
+
+    # Импорт после настройки окружения
+    from app.api_cache import api_cache
+    from app.db import get_db_connection
+    from app.workflow import run_worker
+
+    api_cache.invalidate_token()
+    api_cache.invalidate_participants()
+
+    stop_event = threading.Event()
+    if not args.no_worker:
+        threading.Thread(target=run_worker, kwargs={'threads': args.worker_threads, 'stop_event': stop_event},
+                         name='workflow-worker', daemon=True).start()
+
+    conn = get_db_connection()
+    order_ids = []
+    try:
+        run_label = f"benchmark {datetime.datetime.now():%Y-%m-%d %H:%M:%S}"
+        order_ids = _create_orders(conn, args, run_label)
+        print(f"Создано заказов: {len(order_ids)} ({args.details} x {args.qty} кодов); шаги: {', '.join(steps)}")
+
+        started = time.perf_counter()
+        finished_jobs, failed = _drive(conn, order_ids, steps, args.timeout)
+        wall_time = time.perf_counter() - started
+        _report(finished_jobs, failed, steps, wall_time, len(order_ids) * args.details * args.qty, stub_server)
+    finally:
+        stop_event.set()
+        if order_ids and not args.keep:
+            conn.rollback()
+            _delete_orders(conn, order_ids)
+        conn.close()
+        if stub_server is not None:
+            stub_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+# dmkod-integration-app/benchmarks/psp_stub_server.py
+"""
+Локальная замена API ДМкод (PSP) для нагрузочных замеров и регрессионных прогонов без доступа к внешнему API.
+
+Эмулирует эндпоинты, которыми пользуется dmkod-integration-app:
+    GET  /user/token                     - пара токенов (access в формате JWT с exp)
+    GET  /psp/participants               - справочник участников
+    POST /psp/order/create               - создание заказа
+    POST /psp/suborders/create           - запрос на получение кодов
+    GET  /psp/orders                     - заказ с продуктами (все продукты ACTIVE, qty_received = qty)
+    POST /psp/printrun/create            - создание тиража (учитывает заголовок Idempotency-Key)
+    POST /psp/printrun/json/create       - заказ JSON с кодами тиража
+    GET  /psp/printrun/json/download     - коды тиража
+    POST /psp/utilisation/upload[/include], /psp/utilisation/report/create
+Служебные:
+    GET  /_stub/stats                    - счетчики запросов и ошибок по эндпоинтам
+    POST /_stub/reset                    - сброс счетчиков и состояния
+
+Задержка, доля ошибок и размер ответов настраиваются параметрами командной строки.
+Зависит только от стандартной библиотеки Python.
+
+Запуск из папки dmkod-integration-app:
+    python -m benchmarks.psp_stub_server --port 8090 --latency-ms 150 --error-rate 0.02
+и в .env приложения: API_BASE_URL=http://localhost:8090
+"""
+import argparse
+import base64
+import itertools
+import json
+import random
+import string
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GS_SEPARATOR = '\x1d'
+CODE_ALPHABET = string.ascii_letters + string.digits
+
+
+class StubConfig:
+    """Параметры поведения заглушки."""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, error_status=503,
+                 codes_per_printrun=None, token_ttl=3600, endpoint_latency=None, participants=50, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        # None - столько кодов, сколько заказано в тираже
+        self.codes_per_printrun = codes_per_printrun
+        self.token_ttl = token_ttl
+        self.endpoint_latency = endpoint_latency or {}
+        self.participants = participants
+        self.random = random.Random(seed)
+
+
+class StubState:
+    """Состояние заглушки в памяти: заказы, тиражи и счетчики."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1000)
+        self.orders = {}
+        self.products = {}
+        self.printruns = {}
+        self.idempotency_keys = {}
+        self.stats = defaultdict(lambda: {'requests': 0, 'errors': 0, 'total_ms': 0.0})
+
+    def next_id(self):
+        with self.lock:
+            return next(self.ids)
+
+    def record(self, endpoint, elapsed_ms, error):
+        with self.lock:
+            stat = self.stats[endpoint]
+            stat['requests'] += 1
+            stat['errors'] += int(error)
+            stat['total_ms'] += elapsed_ms
+
+
+def _make_access_token(ttl):
+    """Токен в формате JWT (без настоящей подписи) - приложение читает из него только exp."""
+    def b64(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+    return f"{b64({'alg': 'none', 'typ': 'JWT'})}.{b64({'exp': int(time.time()) + ttl, 'sub': 'stub'})}.stub"
+
+
+def _make_code(rnd, gtin):
+    serial = ''.join(rnd.choices(CODE_ALPHABET, k=13))
+    crypto = ''.join(rnd.choices(CODE_ALPHABET, k=44))
+    return f"01{gtin}21{serial}{GS_SEPARATOR}91EE10{GS_SEPARATOR}92{crypto}"
+
+
+class PspStubHandler(BaseHTTPRequestHandler):
+    server_version = 'PspStub/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    # --- Инфраструктура ---
+
+    def log_message(self, format, *args):
+        pass  # Логи каждого запроса мешают замерам
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return {}
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _dispatch(self, method):
+        config, state = self.server.config, self.server.state
+        path = self.path.split('?', 1)[0].rstrip('/')
+        handler = ROUTES.get((method, path))
+        started = time.perf_counter()
+        payload = self._read_json()
+
+        if path.startswith('/_stub/'):
+            status, data = handler(self, payload) if handler else (404, {'detail': 'Not found'})
+            self._send_json(status, data)
+            return
+
+        latency = config.endpoint_latency.get(path, config.latency_ms)
+        if latency or config.jitter_ms:
+            time.sleep(max(0.0, latency + config.random.uniform(-config.jitter_ms, config.jitter_ms)) / 1000)
+
+        if handler is None:
+            status, data = 404, {'detail': 'Not found'}
+        elif path != '/user/token' and not self.headers.get('Authorization', '').startswith('Bearer '):
+            status, data = 401, {'detail': 'Authentication credentials were not provided.'}
+        elif path != '/user/token' and config.error_rate and config.random.random() < config.error_rate:
+            status, data = config.error_status, {'detail': 'Stub: injected error'}
+        else:
+            status, data = handler(self, payload)
+
+        state.record(f"{method} {path}", (time.perf_counter() - started) * 1000, status >= 400)
+        self._send_json(status, data)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    # --- Эндпоинты ---
+
+    def token(self, payload):
+        return 200, {'access': _make_access_token(self.server.config.token_ttl), 'refresh': 'stub-refresh'}
+
+    def participants(self, payload):
+        return 200, {'participants': [
+            {'id': i, 'name': f'Участник {i}', 'inn': f'{7700000000 + i}',
+             'poa_validity_start': '2025-01-01', 'poa_validity_end': '2030-01-01'}
+            for i in range(1, self.server.config.participants + 1)
+        ]}
+
+    def order_create(self, payload):
+        state = self.server.state
+        order_id = state.next_id()
+        products = []
+        for product in payload.get('products', []):
+            product_id = state.next_id()
+            products.append({
+                'id': product_id, 'gtin': product.get('gtin'), 'name': f"Товар {product.get('gtin')}",
+                'state': 'ACTIVE', 'qty': product.get('qty', 0), 'qty_received': product.get('qty', 0)
+            })
+            state.products[product_id] = products[-1]
+        state.orders[order_id] = {'id': order_id, 'products': products}
+        return 201, {'order_id': order_id}
+
+    def suborders_create(self, payload):
+        if payload.get('order_id') not in self.server.state.orders:
+            return 404, {'detail': 'Order not found'}
+        return 201, {'suborder_ids': [self.server.state.next_id()]}
+
+    def orders(self, payload):
+        order = self.server.state.orders.get(payload.get('order_id'))
+        return 200, {'orders': [order] if order else []}
+
+    def printrun_create(self, payload):
+        state = self.server.state
+        product = state.products.get(payload.get('order_product_id'))
+        if product is None:
+            return 404, {'detail': 'Product not found'}
+        # Повтор с тем же Idempotency-Key возвращает уже созданный тираж
+        idempotency_key = self.headers.get('Idempotency-Key')
+        with state.lock:
+            if idempotency_key and idempotency_key in state.idempotency_keys:
+                return 200, {'printrun_id': state.idempotency_keys[idempotency_key]}
+            printrun_id = next(state.ids)
+            state.printruns[printrun_id] = {'gtin': product['gtin'], 'qty': payload.get('qty', 0)}
+            if idempotency_key:
+                state.idempotency_keys[idempotency_key] = printrun_id
+        return 201, {'printrun_id': printrun_id}
+
+    def printrun_json_create(self, payload):
+        if payload.get('printrun_id') not in self.server.state.printruns:
+            return 404, {'detail': 'Printrun not found'}
+        return 201, {}
+
+    def printrun_json_download(self, payload):
+        printrun = self.server.state.printruns.get(payload.get('printrun_id'))
+        if printrun is None:
+            return 404, {'detail': 'Printrun not found'}
+        config = self.server.config
+        count = config.codes_per_printrun if config.codes_per_printrun is not None else printrun['qty']
+        rnd = random.Random(payload.get('printrun_id'))
+        return 200, {'codes': [_make_code(rnd, printrun['gtin']) for _ in range(count)]}
+
+    def utilisation_upload(self, payload):
+        return 201, {'upload_id': self.server.state.next_id()}
+
+    def report_create(self, payload):
+        return 201, {'report_id': self.server.state.next_id()}
+
+    def stub_stats(self, payload):
+        with self.server.state.lock:
+            stats = {
+                endpoint: {**stat, 'avg_ms': round(stat['total_ms'] / stat['requests'], 2) if stat['requests'] else 0}
+                for endpoint, stat in self.server.state.stats.items()
+            }
+        return 200, stats
+
+    def stub_reset(self, payload):
+        self.server.state = StubState()
+        return 200, {}
+
+
+ROUTES = {
+    ('GET', '/user/token'): PspStubHandler.token,
+    ('GET', '/psp/participants'): PspStubHandler.participants,
+    ('POST', '/psp/order/create'): PspStubHandler.order_create,
+    ('POST', '/psp/suborders/create'): PspStubHandler.suborders_create,
+    ('GET', '/psp/orders'): PspStubHandler.orders,
+    ('POST', '/psp/printrun/create'): PspStubHandler.printrun_create,
+    ('POST', '/psp/printrun/json/create'): PspStubHandler.printrun_json_create,
+    ('GET', '/psp/printrun/json/download'): PspStubHandler.printrun_json_download,
+    ('POST', '/psp/utilisation/upload'): PspStubHandler.utilisation_upload,
+    ('POST', '/psp/utilisation/upload/include'): PspStubHandler.utilisation_upload,
+    ('POST', '/psp/utilisation/report/create'): PspStubHandler.report_create,
+    ('GET', '/_stub/stats'): PspStubHandler.stub_stats,
+    ('POST', '/_stub/reset'): PspStubHandler.stub_reset,
+}
+
+
+def create_server(host='127.0.0.1', port=8090, config=None):
+    """Создает (но не запускает) сервер-заглушку; удобно для запуска в потоке из бенчмарка."""
+    server = ThreadingHTTPServer((host, port), PspStubHandler)
+    server.daemon_threads = True
+    server.config = config or StubConfig()
+    server.state = StubState()
+    return server
+
+
+def start_in_thread(host='127.0.0.1', port=0, config=None):
+    """Запускает заглушку в фоновом потоке. Возвращает (server, base_url)."""
+    server = create_server(host, port, config)
+    threading.Thread(target=server.serve_forever, name='psp-stub', daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def _parse_endpoint_latency(values):
+    result = {}
+    for value in values or []:
+        path, _, ms = value.partition('=')
+        result[path.rstrip('/')] = float(ms)
+    return result
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    add_stub_arguments(parser)
+    return parser
+
+
+def add_stub_arguments(parser):
+    """Параметры поведения заглушки (используются и бенчмарком)."""
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Задержка ответа, мс')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='Разброс задержки, ±мс')
+    parser.add_argument('--endpoint-latency', action='append', metavar='PATH=MS',
+                        help='Задержка для отдельного эндпоинта, например /psp/printrun/json/download=2000')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов с ошибкой (0..1)')
+    parser.add_argument('--error-status', type=int, default=503, help='HTTP-статус внедряемых ошибок')
+    parser.add_argument('--codes-per-printrun', type=int, default=None,
+                        help='Кодов в ответе на скачивание тиража (по умолчанию - по количеству в тираже)')
+    parser.add_argument('--token-ttl', type=int, default=3600, help='Срок жизни токена, с')
+    parser.add_argument('--seed', type=int, default=None, help='Зерно генератора задержек и ошибок')
+
+
+def config_from_args(args):
+    return StubConfig(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        error_status=args.error_status, codes_per_printrun=args.codes_per_printrun,
+        token_ttl=args.token_ttl, endpoint_latency=_parse_endpoint_latency(args.endpoint_latency), seed=args.seed
+    )
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    server = create_server(args.host, args.port, config_from_args(args))
+    print(f"Заглушка API ДМкод слушает http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
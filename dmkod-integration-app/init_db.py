@@ -12,11 +12,11 @@ def get_db_connection():
     try:
         # --- ИЗМЕНЕНО: Добавляем параметры SSL из .env ---
         conn_params = {
-            dbname=os.getenv("DB_NAME"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD"),
-            host=os.getenv("DB_HOST_LOCAL", "localhost"), # Используем локальный хост для скриптов
-            port=os.getenv("DB_PORT")
+            "dbname": os.getenv("DB_NAME"),
+            "user": os.getenv("DB_USER"),
+            "password": os.getenv("DB_PASSWORD"),
+            "host": os.getenv("DB_HOST_LOCAL", "localhost"), # Используем локальный хост для скриптов
+            "port": os.getenv("DB_PORT")
         }
         
         # Проверяем, задан ли режим SSL в переменных окружения
@@ -47,6 +47,7 @@ def update_schema(conn):
     aggregation_details_table = 'dmkod_aggregation_details'
     order_files_table = 'dmkod_order_files'
     delta_result_table = 'delta_result'
+    workflow_jobs_table = 'dmkod_workflow_jobs'
 
     # Список команд для обновления схемы
     sql_commands = [
@@ -114,6 +115,9 @@ def update_schema(conn):
         sql.SQL("ALTER TABLE {agg_details} ADD COLUMN IF NOT EXISTS utilisation_upload_id INTEGER;").format(agg_details=sql.Identifier(aggregation_details_table)),
         sql.SQL("COMMENT ON COLUMN {agg_details}.utilisation_upload_id IS 'ID загрузки сведений о нанесении из API';").format(agg_details=sql.Identifier(aggregation_details_table)),
         sql.SQL("CREATE INDEX IF NOT EXISTS idx_agg_details_order_id ON {agg_details}(order_id);").format(agg_details=sql.Identifier(aggregation_details_table)),
+        # --- Ключ идемпотентности запроса на создание тиража ---
+        sql.SQL("ALTER TABLE {agg_details} ADD COLUMN IF NOT EXISTS tirage_request_key VARCHAR(64);").format(agg_details=sql.Identifier(aggregation_details_table)),
+        sql.SQL("COMMENT ON COLUMN {agg_details}.tirage_request_key IS 'Ключ идемпотентности (Idempotency-Key) запроса на создание тиража';").format(agg_details=sql.Identifier(aggregation_details_table)),
 
         # 4. Создание таблицы для хранения оригинальных файлов заказа
         sql.SQL("""
@@ -121,7 +125,9 @@ def update_schema(conn):
             id SERIAL PRIMARY KEY,
             order_id INTEGER NOT NULL REFERENCES {orders}(id) ON DELETE CASCADE,
             filename VARCHAR(255) NOT NULL,
-            file_data BYTEA NOT NULL,
+            file_size BIGINT,
+            checksum_sha256 CHAR(64),
+            file_data BYTEA,
             created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
         );
         """).format(
@@ -129,6 +135,13 @@ def update_schema(conn):
             orders=sql.Identifier(orders_table)
         ),
         sql.SQL("COMMENT ON TABLE {order_files} IS 'Оригинальные файлы заказов от клиентов для ДМкод';").format(order_files=sql.Identifier(order_files_table)),
+        # --- Содержимое файлов перенесено в локальное хранилище (app/file_store.py), в таблице - только метаданные ---
+        sql.SQL("ALTER TABLE {order_files} ADD COLUMN IF NOT EXISTS file_size BIGINT;").format(order_files=sql.Identifier(order_files_table)),
+        sql.SQL("ALTER TABLE {order_files} ADD COLUMN IF NOT EXISTS checksum_sha256 CHAR(64);").format(order_files=sql.Identifier(order_files_table)),
+        sql.SQL("ALTER TABLE {order_files} ALTER COLUMN file_data DROP NOT NULL;").format(order_files=sql.Identifier(order_files_table)),
+        sql.SQL("COMMENT ON COLUMN {order_files}.checksum_sha256 IS 'SHA-256 содержимого, имя файла в хранилище';").format(order_files=sql.Identifier(order_files_table)),
+        sql.SQL("COMMENT ON COLUMN {order_files}.file_data IS 'Устарело: содержимое файлов, загруженных до перехода на хранилище (см. migrate_order_files.py)';").format(order_files=sql.Identifier(order_files_table)),
+        sql.SQL("CREATE INDEX IF NOT EXISTS idx_order_files_checksum ON {order_files}(checksum_sha256);").format(order_files=sql.Identifier(order_files_table)),
 
         # 5. Создание таблицы для результатов интеграции с "Дельта"
         sql.SQL("""
@@ -146,7 +159,40 @@ def update_schema(conn):
         ),
         sql.SQL("COMMENT ON TABLE {delta_table} IS 'Результаты обработки для системы Дельта';").format(delta_table=sql.Identifier(delta_result_table)),
 
-        # 6. Сброс счетчика SSCC для перехода на новую логику GCP.
+        # 6. Очередь фоновых шагов интеграции (app/workflow.py)
+        sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {jobs_table} (
+            id SERIAL PRIMARY KEY,
+            order_id INTEGER NOT NULL REFERENCES {orders}(id) ON DELETE CASCADE,
+            step VARCHAR(50) NOT NULL,
+            params JSONB NOT NULL DEFAULT '{{}}',
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 5,
+            run_after TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+            locked_until TIMESTAMP WITH TIME ZONE,
+            worker VARCHAR(255),
+            log TEXT NOT NULL DEFAULT '',
+            result JSONB,
+            error TEXT,
+            created_by VARCHAR(255),
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            started_at TIMESTAMP WITH TIME ZONE,
+            finished_at TIMESTAMP WITH TIME ZONE,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        );
+        """).format(
+            jobs_table=sql.Identifier(workflow_jobs_table),
+            orders=sql.Identifier(orders_table)
+        ),
+        sql.SQL("COMMENT ON TABLE {jobs_table} IS 'Очередь и состояние фоновых шагов интеграции с API ДМкод';").format(jobs_table=sql.Identifier(workflow_jobs_table)),
+        # Не более одного активного шага на заказ
+        sql.SQL("CREATE UNIQUE INDEX IF NOT EXISTS idx_workflow_jobs_active_order ON {jobs_table}(order_id) WHERE status IN ('pending', 'running');").format(jobs_table=sql.Identifier(workflow_jobs_table)),
+        # Выборка готовых к выполнению заданий обработчиком
+        sql.SQL("CREATE INDEX IF NOT EXISTS idx_workflow_jobs_ready ON {jobs_table}(run_after) WHERE status IN ('pending', 'running');").format(jobs_table=sql.Identifier(workflow_jobs_table)),
+        sql.SQL("CREATE INDEX IF NOT EXISTS idx_workflow_jobs_order_id ON {jobs_table}(order_id);").format(jobs_table=sql.Identifier(workflow_jobs_table)),
+
+        # 7. Сброс счетчика SSCC для перехода на новую логику GCP.
         # Устанавливаем начальное значение 1.
     ]
 
@@ -0,0 +1,57 @@
+"""
+Переносит содержимое dmkod_order_files.file_data (BYTEA) в локальное хранилище файлов.
+
+Запускается внутри контейнера dmkod-integration-app (там смонтирован том хранилища):
+    docker compose exec dmkod-integration-app python migrate_order_files.py
+
+Файлы переносятся по одному, каждый в своей транзакции, поэтому скрипт можно прервать и запустить снова.
+"""
+import os
+from io import BytesIO
+
+from dotenv import load_dotenv
+
+# Переменные окружения нужны до импорта app.file_store (каталог хранилища читается при импорте)
+load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
+
+from app.db import get_db_connection
+from app.file_store import FILE_STORE_DIR, store_stream
+
+
+def migrate():
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM dmkod_order_files WHERE checksum_sha256 IS NULL AND file_data IS NOT NULL ORDER BY id")
+            file_ids = [row[0] for row in cur.fetchall()]
+        conn.commit()
+
+        print(f"Файлов для переноса в {FILE_STORE_DIR}: {len(file_ids)}")
+        for file_id in file_ids:
+            with conn.cursor() as cur:
+                cur.execute("SELECT file_data FROM dmkod_order_files WHERE id = %s FOR UPDATE", (file_id,))
+                row = cur.fetchone()
+                if row is None or row[0] is None:
+                    conn.rollback()
+                    continue
+                checksum, file_size = store_stream(cur, BytesIO(row[0]))
+                cur.execute(
+                    """
+                    UPDATE dmkod_order_files
+                    SET checksum_sha256 = %s, file_size = %s, file_data = NULL
+                    WHERE id = %s
+                    """,
+                    (checksum, file_size, file_id)
+                )
+            conn.commit()
+            print(f"  Файл #{file_id}: {file_size} байт -> {checksum}")
+        print("Перенос завершен. Для освобождения места выполните VACUUM FULL dmkod_order_files.")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    migrate()
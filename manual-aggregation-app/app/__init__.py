@@ -25,7 +25,9 @@ def create_app():
         SECRET_KEY=os.getenv('MANUAL_AGGREGATION_SECRET_KEY', 'a-very-secret-dev-key-that-should-be-changed'),
         # Добавляем пути к Redis для будущего использования в state_service
         REDIS_HOST=os.getenv('REDIS_HOST', 'redis'),
-        REDIS_PORT=int(os.getenv('REDIS_PORT', 6379))
+        REDIS_PORT=int(os.getenv('REDIS_PORT', 6379)),
+        # Пинг по каналу сканирования (WebSocket), чтобы прокси не закрывали простаивающие соединения
+        SOCK_SERVER_OPTIONS={'ping_interval': 25}
     )
 
     # --- 2. Регистрация кастомных фильтров для шаблонов ---
@@ -45,14 +47,18 @@ def create_app():
     # Связываем расширения с нашим приложением.
     login_manager.init_app(app)
     csrf.init_app(app) # Включаем CSRF защиту для всего приложения
+    # Пул соединений с БД: одно соединение на запрос, возврат в пул по завершении запроса
+    from . import db
+    db.init_app(app)
 
     # --- 4. Регистрация Blueprints ---
     # Импортируем и регистрируем Blueprints внутри фабрики,
     # чтобы избежать циклических зависимостей, которые могут вызывать
     # ошибки при запуске приложения.
     from .routes import manual_aggregation_bp
-    from .api import api_bp
+    from .api import api_bp, sock
 
+    sock.init_app(app)
     app.register_blueprint(manual_aggregation_bp, url_prefix='/manual-aggregation')
     app.register_blueprint(api_bp, url_prefix='/manual-aggregation')
     
@@ -1,43 +1,82 @@
-from flask import Blueprint, request, jsonify, session
+import json
+import os
+import threading
+from urllib.parse import urlparse
+
+from flask import Blueprint, request, jsonify, session, abort
 from flask_login import current_user, login_required
+from flask_sock import Sock
 
-from .services.scan_service import process_scan
-from .services.order_service import get_order_by_id
+from .db import release_request_connection
+from .services import metrics_service
+from .services.scan_service import process_scan, process_scan_batch
+from .services.order_service import get_order_metadata, get_employee_identity
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
+# Канал сканирования по WebSocket (инициализируется в create_app)
+sock = Sock()
+
+# Максимальное количество сканов в одном пакетном запросе
+MAX_BATCH_SCANS = 500
+# Сколько каналов сканирования держит один воркер: каждый занимает поток gunicorn (--threads) на всю смену,
+# остальные потоки нужны обычным HTTP-запросам. Рабочие места сверх лимита сканируют через POST /scan.
+MAX_SCAN_CHANNELS = int(os.getenv('MA_MAX_SCAN_CHANNELS', '24'))
+_scan_channel_slots = threading.BoundedSemaphore(MAX_SCAN_CHANNELS)
+
+
+def _get_scan_context():
+    """
+    Определяет сотрудника и заказ для обработки скана.
+    Возвращает (identity, order_info, None) или (None, None, ответ с ошибкой).
+    """
+    if getattr(current_user, 'role', None) != 'employee':
+        return None, None, (jsonify({"status": "error", "message": "Доступ запрещен"}), 403)
+
+    # Получаем ID рабочей сессии, сохраненный при входе
+    work_session_id = session.get('work_session_id')
+    if not work_session_id:
+        # Если ID сессии нет, пользователь должен перелогиниться
+        return None, None, (jsonify({"status": "error", "message": "Ошибка сессии: не найдена рабочая сессия. Пожалуйста, перезайдите в систему."}), 401)
+
+    # Пропуск сотрудника определяется при входе; запрос к БД - только для сессий, начатых до появления этого кэша
+    identity = session.get('employee_identity')
+    if not identity or identity.get('work_session_id') != work_session_id:
+        identity = get_employee_identity(work_session_id)
+        if not identity:
+            return None, None, (jsonify({"status": "error", "message": "Ошибка сессии: рабочая сессия не найдена. Пожалуйста, перезайдите в систему."}), 401)
+        session['employee_identity'] = identity
+
+    order_id = current_user.data.get('order_id')
+
+    # Получаем актуальные данные заказа, т.к. они могли измениться с момента входа.
+    # Метаданные берутся из кэша, который сбрасывается при редактировании заказа.
+    with metrics_service.stage('order_lookup'):
+        order_info = get_order_metadata(order_id)
+    if not order_info:
+        return None, None, (jsonify({"status": "error", "message": f"Заказ {order_id} не найден."}), 404)
+    return identity, order_info, None
+
 
 @api_bp.route('/scan', methods=['POST'])
-@login_required 
+@login_required
 def handle_scan():
     """Обрабатывает AJAX-запросы от сканера сотрудника."""
     try:
-        if getattr(current_user, 'role', None) != 'employee':
-            return jsonify({"status": "error", "message": "Доступ запрещен"}), 403
+        identity, order_info, error_response = _get_scan_context()
+        if error_response:
+            return error_response
 
         data = request.get_json()
         if not data:
             return jsonify({"status": "error", "message": "Пустой запрос или неверный Content-Type"}), 400
-        
+
         scanned_code = data.get('scanned_code')
         if not scanned_code:
             return jsonify({"status": "error", "message": "Пустой код"}), 400
 
-        # Получаем ID рабочей сессии, сохраненный при входе
-        work_session_id = session.get('work_session_id')
-        if not work_session_id:
-            # Если ID сессии нет, пользователь должен перелогиниться
-            return jsonify({"status": "error", "message": "Ошибка сессии: не найдена рабочая сессия. Пожалуйста, перезайдите в систему."}), 401
-
-        order_id = current_user.data.get('order_id')
-        
-        # Получаем актуальные данные заказа, т.к. они могли измениться с момента входа
-        order_info = get_order_by_id(order_id)
-        if not order_info:
-            return jsonify({"status": "error", "message": f"Заказ {order_id} не найден."}), 404
-        
         # Вызываем основную бизнес-логику
         result = process_scan(
-            work_session_id=work_session_id,
+            identity=identity,
             order_info=order_info,
             scanned_code=scanned_code
         )
@@ -53,4 +92,143 @@ def handle_scan():
             "status": "error",
             "message": f"Критическая ошибка на сервере: {type(e).__name__}. Обратитесь к администратору.",
             "session": None
-        }), 500
\ No newline at end of file
+        }), 500
+
+
+@api_bp.route('/metrics/scan', methods=['GET'])
+def scan_metrics():
+    """
+    Время этапов обработки скана (p50/p95/p99) в текущем воркере; ?reset=1 - начать новый период.
+    Доступно только локально (изнутри контейнера): curl http://localhost:8001/manual-aggregation/metrics/scan
+    Замеры включаются переменной окружения MA_SCAN_METRICS=1.
+    """
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(404)
+    return jsonify(metrics_service.snapshot(reset=request.args.get('reset') == '1'))
+
+
+@api_bp.route('/scan/batch', methods=['POST'])
+@login_required
+def handle_scan_batch():
+    """
+    Принимает серию сканов, накопленных терминалом (например, пока не было связи), в порядке сканирования:
+    {"scanned_codes": ["...", "..."]}. Сканы обрабатываются по очереди до первого неуспешного;
+    в ответе - результат по каждому обработанному скану и итоговое состояние сессии.
+    """
+    try:
+        identity, order_info, error_response = _get_scan_context()
+        if error_response:
+            return error_response
+
+        data = request.get_json()
+        if not data:
+            return jsonify({"status": "error", "message": "Пустой запрос или неверный Content-Type"}), 400
+
+        scanned_codes = data.get('scanned_codes')
+        if not isinstance(scanned_codes, list) or not scanned_codes:
+            return jsonify({"status": "error", "message": "Не передан список кодов"}), 400
+        if len(scanned_codes) > MAX_BATCH_SCANS:
+            return jsonify({"status": "error", "message": f"Слишком много кодов в одном запросе (максимум {MAX_BATCH_SCANS})."}), 400
+        if not all(isinstance(code, str) and code for code in scanned_codes):
+            return jsonify({"status": "error", "message": "Пустой код в списке"}), 400
+
+        result = process_scan_batch(
+            identity=identity,
+            order_info=order_info,
+            scanned_codes=scanned_codes
+        )
+
+        return jsonify(result)
+
+    except Exception as e:
+        import traceback
+        print(f"!!! КРИТИЧЕСКАЯ ОШИБКА в API-эндпоинте handle_scan_batch: {e}\n{traceback.format_exc()}", flush=True)
+        return jsonify({
+            "status": "error",
+            "message": f"Критическая ошибка на сервере: {type(e).__name__}. Обратитесь к администратору.",
+            "session": None
+        }), 500
+
+
+@sock.route('/scan/ws', bp=api_bp)
+def scan_channel(ws):
+    """
+    Постоянный канал сканирования для рабочего места сотрудника.
+    Вход и сессия проверяются один раз, при установке соединения; дальше каждое сообщение - это скан
+    {"scanned_code": "..."} или серия сканов {"scanned_codes": [...]} (необязательный "id" возвращается в ответе).
+    Ответы - те же JSON, что у /scan и /scan/batch, в порядке поступления сканов.
+    Если свободных каналов нет (MAX_SCAN_CHANNELS), соединение закрывается с кодом 1013.
+    """
+    if not _scan_channel_slots.acquire(blocking=False):
+        ws.close(reason=1013, message="Нет свободных каналов сканирования")
+        return
+    try:
+        _serve_scan_channel(ws)
+    finally:
+        _scan_channel_slots.release()
+
+
+def _serve_scan_channel(ws):
+    # Защита от подключения со сторонних сайтов: cookie сессии браузер отправит с любого Origin
+    # Сравниваются только имена хостов: прокси может передать Host без порта
+    origin = request.headers.get('Origin')
+    if origin and urlparse(origin).hostname != urlparse(f"//{request.host}").hostname:
+        ws.close(reason=1008, message="Недопустимый источник запроса")
+        return
+    if not current_user.is_authenticated:
+        ws.send(json.dumps({"status": "command", "command": "logout", "message": "Требуется вход в систему.", "session": None}))
+        ws.close(reason=1008)
+        return
+
+    identity, order_info, error_response = _get_scan_context()
+    release_request_connection()
+    if error_response:
+        response, _ = error_response
+        ws.send(json.dumps(response.get_json()))
+        ws.close(reason=1008)
+        return
+    order_id = order_info['id']
+
+    while True:
+        message = ws.receive()
+        try:
+            data = json.loads(message)
+        except (TypeError, ValueError):
+            data = None
+        if not isinstance(data, dict):
+            ws.send(json.dumps({"status": "error", "message": "Неверный формат сообщения", "session": None}))
+            continue
+
+        try:
+            # Метаданные заказа могли измениться с момента подключения (берутся из кэша)
+            with metrics_service.stage('order_lookup'):
+                order_info = get_order_metadata(order_id)
+            if not order_info:
+                result = {"status": "error", "message": f"Заказ {order_id} не найден.", "session": None}
+            elif data.get('scanned_codes'):
+                scanned_codes = data['scanned_codes']
+                if not isinstance(scanned_codes, list) or not all(isinstance(code, str) and code for code in scanned_codes):
+                    result = {"status": "error", "message": "Неверный список кодов", "session": None}
+                elif len(scanned_codes) > MAX_BATCH_SCANS:
+                    result = {"status": "error", "message": f"Слишком много кодов в одном сообщении (максимум {MAX_BATCH_SCANS}).", "session": None}
+                else:
+                    result = process_scan_batch(identity=identity, order_info=order_info, scanned_codes=scanned_codes)
+            elif isinstance(data.get('scanned_code'), str) and data['scanned_code']:
+                result = process_scan(identity=identity, order_info=order_info, scanned_code=data['scanned_code'])
+            else:
+                result = {"status": "error", "message": "Пустой код", "session": None}
+        except Exception as e:
+            import traceback
+            print(f"!!! КРИТИЧЕСКАЯ ОШИБКА в канале сканирования: {e}\n{traceback.format_exc()}", flush=True)
+            result = {
+                "status": "error",
+                "message": f"Критическая ошибка на сервере: {type(e).__name__}. Обратитесь к администратору.",
+                "session": None
+            }
+        finally:
+            # Соединение с БД не держим между сканами
+            release_request_connection()
+
+        if 'id' in data:
+            result['id'] = data['id']
+        ws.send(json.dumps(result, default=str))
@@ -1,19 +1,25 @@
 # manual-aggregation-app/app/auth.py
 import os
-import psycopg2
+import time
+import redis
 from psycopg2.extras import RealDictCursor
 from flask_login import LoginManager, UserMixin
 from bcrypt import checkpw
 
-# --- База данных ---
-def get_db_connection():
-    return psycopg2.connect(os.getenv('DATABASE_URL'))
+from .db import get_db_connection
+from .services.state_service import state_manager
 
 # --- Настройка Flask-Login ---
 login_manager = LoginManager()
 login_manager.login_view = 'manual_aggregation_app.login_choice' # Страница выбора типа входа
 login_manager.login_message = "Пожалуйста, войдите для доступа."
 
+# Кэш пользователей в памяти воркера: {user_id: (поколение кэша, срок годности, роль, данные)}.
+# load_user вызывается на каждый запрос; запись действует USER_CACHE_TTL секунд и сбрасывается
+# раньше срока во всех воркерах через invalidate_user_cache() (новое поколение в Redis).
+USER_CACHE_TTL = int(os.getenv('MA_USER_CACHE_TTL', '60'))
+_user_cache = {}
+
 class User(UserMixin):
     """Универсальная модель пользователя (Админ или Сотрудник)."""
     def __init__(self, user_id, role, data):
@@ -21,44 +27,69 @@ class User(UserMixin):
         self.role = role  # 'admin' or 'employee'
         self.data = data # Словарь с доп. данными
 
+def _get_user_cache_generation():
+    try:
+        return state_manager.get_user_cache_generation()
+    except redis.exceptions.RedisError:
+        # Без Redis кэш ограничен только сроком годности
+        return None
+
+def invalidate_user_cache():
+    """Сбрасывает кэш пользователей во всех воркерах (после изменения пропусков или удаления заказа)."""
+    _user_cache.clear()
+    try:
+        state_manager.invalidate_user_cache()
+    except redis.exceptions.RedisError as e:
+        print(f"ПРЕДУПРЕЖДЕНИЕ: не удалось сбросить кэш пользователей в Redis: {e}")
+
+def _fetch_user_data(role, u_id):
+    # Только чтение: транзакцию соединения запроса не фиксируем, ее завершает владелец
+    conn = get_db_connection()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            if role == 'admin':
+                cur.execute("SELECT * FROM users WHERE id = %s AND is_admin = true", (u_id,))
+            else:
+                # Ищем в нашей новой таблице токенов
+                cur.execute("SELECT * FROM ma_employee_tokens WHERE id = %s AND is_active = true", (u_id,))
+            row = cur.fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
 @login_manager.user_loader
 def load_user(user_id):
-    # --- НАЧАЛО БЛОКА ОТЛАДКИ ---
-    print(f"--- load_user вызван с user_id: '{user_id}' ---")
-    
     try:
         role, u_id = user_id.split(':', 1)
-        print(f"Распарсили: role='{role}', u_id='{u_id}'")
-    except Exception as e:
-        print(f"ОШИБКА: не удалось распарить user_id. Ошибка: {e}")
+    except ValueError:
+        return None
+    if role not in ('admin', 'employee'):
         return None
 
-    conn = get_db_connection()
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        if role == 'admin':
-            print(f"Ищу админа с id={u_id}")
-            cur.execute("SELECT * FROM users WHERE id = %s AND is_admin = true", (u_id,))
-            user_data = cur.fetchone()
-            print(f"Результат из БД: {user_data}")
-            if user_data:
-                print("Админ найден, возвращаю объект User")
-                return User(user_id, 'admin', user_data)
-        
-        elif role == 'employee':
-            # Ищем в нашей новой таблице токенов
-            cur.execute("SELECT * FROM ma_employee_tokens WHERE id = %s AND is_active = true", (u_id,))
-            token_data = cur.fetchone()
-            if token_data:
-                return User(user_id, 'employee', token_data)
-    return None
+    generation = _get_user_cache_generation()
+    cached = _user_cache.get(user_id)
+    if cached and cached[0] == generation and cached[1] > time.monotonic():
+        data = cached[3]
+    else:
+        data = _fetch_user_data(role, u_id)
+        _user_cache[user_id] = (generation, time.monotonic() + USER_CACHE_TTL, role, data)
+
+    if data is None:
+        return None
+    # Копия данных: объект пользователя живет один запрос, кэш - общий для потоков воркера
+    return User(user_id, role, dict(data))
 
 # Функции для проверки учетных данных
 def verify_admin_credentials(username, password):
     """Проверяет логин/пароль админа по таблице `users`."""
     conn = get_db_connection()
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT * FROM users WHERE username = %s AND is_admin = true", (username,))
-        user_data = cur.fetchone()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SELECT * FROM users WHERE username = %s AND is_admin = true", (username,))
+            user_data = cur.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
     if user_data and checkpw(password.encode('utf-8'), user_data['password_hash'].encode('utf-8')):
         return User(f"admin:{user_data['id']}", 'admin', user_data)
     return None
@@ -67,21 +98,24 @@ def verify_employee_token(access_token):
     """Проверяет токен сотрудника и обновляет время последнего входа."""
     conn = get_db_connection()
     user_to_return = None
-    with conn: # Используем with conn для автоматической транзакции
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # Ищем активный токен
-            cur.execute(
-                "SELECT * FROM ma_employee_tokens WHERE access_token = %s AND is_active = true",
-                (access_token,)
-            )
-            token_data = cur.fetchone()
-            
-            if token_data:
-                # Если токен найден, ОБНОВЛЯЕМ время входа
+    try:
+        with conn: # Используем with conn для автоматической транзакции
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                # Ищем активный токен
                 cur.execute(
-                    "UPDATE ma_employee_tokens SET last_login = NOW() WHERE id = %s",
-                    (token_data['id'],)
+                    "SELECT * FROM ma_employee_tokens WHERE access_token = %s AND is_active = true",
+                    (access_token,)
                 )
-                user_to_return = User(f"employee:{token_data['id']}", 'employee', token_data)
-                
+                token_data = cur.fetchone()
+            
+                if token_data:
+                    # Если токен найден, ОБНОВЛЯЕМ время входа
+                    cur.execute(
+                        "UPDATE ma_employee_tokens SET last_login = NOW() WHERE id = %s",
+                        (token_data['id'],)
+                    )
+                    user_to_return = User(f"employee:{token_data['id']}", 'employee', token_data)
+    finally:
+        conn.close()
+
     return user_to_return
\ No newline at end of file
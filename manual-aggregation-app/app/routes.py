@@ -18,7 +18,8 @@ from .services.order_service import (
     delete_aggregations_by_ids,
     create_work_session,
     get_token_ids_for_order,
-    end_work_session
+    end_work_session,
+    get_employee_identity
 )
 from .services.pdf_service import generate_tokens_pdf, generate_control_codes_pdf
 from .services.report_service import get_aggregation_report_for_order, generate_aggregation_excel_report
@@ -117,6 +118,8 @@ def login_employee():
             # Сохраняем ID рабочей сессии и имя в сессию Flask
             session['work_session_id'] = work_session_id
             session['employee_name'] = last_name
+            # Кто работает в сессии (пропуск, заказ, старший смены) - чтобы не определять это при каждом скане
+            session['employee_identity'] = get_employee_identity(work_session_id)
             
             login_user(user)
             return redirect(url_for('.employee_task_page'))
@@ -146,6 +149,7 @@ def _perform_logout():
 
     session.pop('work_session_id', None)
     session.pop('employee_name', None)
+    session.pop('employee_identity', None)
     logout_user()
 
 @manual_aggregation_bp.route('/logout')
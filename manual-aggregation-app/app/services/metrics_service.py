@@ -0,0 +1,135 @@
+import os
+import math
+import time
+import threading
+import functools
+from contextlib import contextmanager, nullcontext
+
+# Замеры времени этапов обработки скана (чтение состояния из Redis, данные заказа, проверка дублей,
+# валидация, запись в БД) и всего скана по исходу. Включаются переменной окружения MA_SCAN_METRICS=1;
+# выключенные замеры ничего не делают: декоратор возвращает функцию без изменений.
+ENABLED = os.getenv('MA_SCAN_METRICS', '0').lower() in ('1', 'true', 'yes')
+
+# Границы корзин гистограммы, мс: логарифмическая шкала от 0.05 мс до ~60 с с шагом 10%
+_BUCKET_BOUNDS = [0.05 * 1.1 ** i for i in range(int(math.log(60000 / 0.05, 1.1)) + 2)]
+
+
+class _Histogram:
+    """Гистограмма длительностей с фиксированными корзинами: запись - O(log n), память не растет."""
+
+    def __init__(self):
+        self.counts = [0] * (len(_BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, value_ms: float):
+        low, high = 0, len(_BUCKET_BOUNDS)
+        while low < high:
+            middle = (low + high) // 2
+            if _BUCKET_BOUNDS[middle] < value_ms:
+                low = middle + 1
+            else:
+                high = middle
+        self.counts[low] += 1
+        self.count += 1
+        self.total_ms += value_ms
+        self.max_ms = max(self.max_ms, value_ms)
+
+    def percentile(self, percent: float) -> float:
+        """Верхняя граница корзины, в которую попадает перцентиль (погрешность - не более шага корзины)."""
+        if not self.count:
+            return 0.0
+        rank = math.ceil(percent / 100 * self.count)
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(_BUCKET_BOUNDS[index], self.max_ms) if index < len(_BUCKET_BOUNDS) else self.max_ms
+        return self.max_ms
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50), 3),
+            "p95_ms": round(self.percentile(95), 3),
+            "p99_ms": round(self.percentile(99), 3),
+            "max_ms": round(self.max_ms, 3),
+        }
+
+
+_histograms = {}
+_lock = threading.Lock()
+_started_at = time.time()
+
+
+def record(name: str, duration_ms: float):
+    """Добавляет замер в гистограмму name."""
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = _Histogram()
+        histogram.add(duration_ms)
+
+
+@contextmanager
+def _measure(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, (time.perf_counter() - started) * 1000)
+
+
+_NOOP = nullcontext()
+
+
+def stage(name: str):
+    """Контекстный менеджер замера этапа: with stage('redis_begin'): ..."""
+    return _measure(name) if ENABLED else _NOOP
+
+
+def timed_stage(name: str):
+    """Декоратор замера этапа; при выключенных замерах функция остается как есть."""
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _measure(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_outcome(name: str):
+    """
+    Декоратор замера всей операции: длительность попадает в гистограмму name:<status>,
+    где status - поле 'status' результата (success, error, command).
+    """
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            result = func(*args, **kwargs)
+            record(f"{name}:{result.get('status', 'unknown')}", (time.perf_counter() - started) * 1000)
+            return result
+        return wrapper
+    return decorator
+
+
+def snapshot(reset: bool = False) -> dict:
+    """Сводка по всем этапам (p50/p95/p99) с момента запуска воркера или последнего сброса."""
+    global _started_at
+    with _lock:
+        stages = {name: histogram.summary() for name, histogram in sorted(_histograms.items())}
+        period_seconds = round(time.time() - _started_at, 1)
+        if reset:
+            _histograms.clear()
+            _started_at = time.time()
+    return {"enabled": ENABLED, "pid": os.getpid(), "period_seconds": period_seconds, "stages": stages}
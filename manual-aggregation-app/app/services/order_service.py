@@ -4,8 +4,11 @@ import json
 import psycopg2
 import re
 import math
+import threading
 from typing import Optional
+import redis
 from app.db import get_db_connection
+from app.auth import invalidate_user_cache
 from .state_service import state_manager
 
 def create_new_order(client_name: str, aggregation_levels: list, employee_count: int, set_capacity: Optional[int]) -> dict:
@@ -66,6 +69,89 @@ def get_order_by_id(order_id: int):
     finally:
         if conn: conn.close()
 
+# --- Кэш метаданных заказа для сканирования ---
+# Настройки заказа и пропуск старшего смены меняются только при редактировании заказа администратором.
+# Общая копия хранится в Redis, у каждого воркера - своя копия в памяти; актуальность обеих
+# проверяется по номеру версии в Redis, который увеличивает invalidate_order_metadata().
+_order_meta_local = {}
+_order_meta_lock = threading.Lock()
+ORDER_META_LOCAL_MAX_SIZE = 1000
+
+def _load_order_metadata(order_id: int) -> Optional[dict]:
+    """Загружает из БД настройки заказа и пропуск старшего смены (первый созданный для заказа)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT o.id, o.client_name, o.status, o.aggregation_levels, o.set_capacity, o.employee_count,
+                       st.id AS senior_token_id, st.access_token AS senior_access_token
+                FROM ma_orders o
+                LEFT JOIN LATERAL (
+                    SELECT id, access_token FROM ma_employee_tokens
+                    WHERE order_id = o.id ORDER BY id ASC LIMIT 1
+                ) st ON true
+                WHERE o.id = %s;
+                """,
+                (order_id,)
+            )
+            row = cur.fetchone()
+    except Exception as e:
+        print(f"КРИТИЧЕСКАЯ ОШИБКА в _load_order_metadata для заказа ID {order_id}: {e}")
+        return None
+    finally:
+        if conn: conn.close()
+
+    if not row:
+        return None
+    meta = dict(row)
+    senior_token_id = meta.pop('senior_token_id')
+    senior_access_token = meta.pop('senior_access_token')
+    meta['senior_token'] = {'id': senior_token_id, 'access_token': str(senior_access_token)} if senior_token_id else None
+    return meta
+
+def get_order_metadata(order_id: int) -> Optional[dict]:
+    """
+    Метаданные заказа для обработки сканов: id, client_name, status, aggregation_levels, set_capacity,
+    employee_count и senior_token ({'id', 'access_token'} или None).
+    В обычном режиме стоит одного запроса к Redis (номер версии); БД читается только после изменения заказа.
+    """
+    try:
+        version = state_manager.get_order_meta_version(order_id)
+    except redis.exceptions.RedisError as e:
+        print(f"ПРЕДУПРЕЖДЕНИЕ: Кэш метаданных заказа недоступен ({e}), читаю заказ {order_id} из БД.")
+        return _load_order_metadata(order_id)
+
+    meta = _order_meta_local.get(order_id)
+    if meta is not None and meta.get('version') == version:
+        return meta
+
+    meta = state_manager.get_order_meta(order_id)
+    if not meta or meta.get('version') != version:
+        # Версия зафиксирована до чтения БД: если заказ изменят во время загрузки,
+        # сохраненная копия окажется устаревшей по версии и будет перечитана.
+        meta = _load_order_metadata(order_id)
+        if meta is None:
+            return None
+        meta['version'] = version
+        state_manager.save_order_meta(order_id, meta)
+
+    with _order_meta_lock:
+        if len(_order_meta_local) >= ORDER_META_LOCAL_MAX_SIZE:
+            _order_meta_local.clear()
+        _order_meta_local[order_id] = meta
+    return meta
+
+def invalidate_order_metadata(order_id: int):
+    """Сбрасывает кэш метаданных заказа в Redis и (через новую версию) во всех воркерах."""
+    try:
+        state_manager.invalidate_order_meta(order_id)
+    except redis.exceptions.RedisError as e:
+        print(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось сбросить кэш метаданных заказа {order_id}: {e}")
+    with _order_meta_lock:
+        _order_meta_local.pop(order_id, None)
+
 def update_order(order_id: int, client_name: str, aggregation_levels: list, new_employee_count: int, set_capacity: Optional[int], status: str) -> dict:
     if not client_name.strip():
         return {"success": False, "message": "Название клиента не может быть пустым."}
@@ -98,6 +184,7 @@ def update_order(order_id: int, client_name: str, aggregation_levels: list, new_
                 message = f"Заказ №{order_id} успешно обновлен."
             
             conn.commit()
+            invalidate_order_metadata(order_id)
             return {"success": True, "message": message}
     except Exception as e:
         if conn: conn.rollback()
@@ -164,8 +251,12 @@ def create_work_session(access_token: str, employee_name: str, order_id: int, wo
 
             # 4. Опционально: если у токена еще нет имени, запишем его в первый раз как "основное".
             cur.execute("UPDATE ma_employee_tokens SET employee_name = %s WHERE id = %s AND (employee_name IS NULL OR employee_name = '');", (employee_name, employee_token_id))
+            name_updated = cur.rowcount > 0
 
         conn.commit()
+        if name_updated:
+            # Данные пропуска изменились - воркеры не должны отдавать его из кэша со старым именем
+            invalidate_user_cache()
         return session_id
     except Exception as e:
         if conn: conn.rollback()
@@ -174,6 +265,35 @@ def create_work_session(access_token: str, employee_name: str, order_id: int, wo
     finally:
         if conn: conn.close()
 
+def get_employee_identity(work_session_id: int) -> Optional[dict]:
+    """
+    Определяет, кто работает в рабочей сессии: ID пропуска, ID заказа и является ли пропуск старшим смены
+    (старший - первый пропуск, созданный для заказа). Эти данные не меняются до конца сессии,
+    поэтому вызывается один раз при входе, а результат хранится в сессии Flask.
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT ws.id AS work_session_id, ws.employee_token_id, ws.order_id,
+                       ws.employee_token_id = (
+                           SELECT MIN(t.id) FROM ma_employee_tokens t WHERE t.order_id = ws.order_id
+                       ) AS is_senior
+                FROM ma_work_sessions ws
+                WHERE ws.id = %s;
+                """,
+                (work_session_id,)
+            )
+            identity = cur.fetchone()
+            return dict(identity) if identity else None
+    except Exception as e:
+        print(f"КРИТИЧЕСКАЯ ОШИБКА в get_employee_identity для сессии ID {work_session_id}: {e}")
+        return None
+    finally:
+        if conn: conn.close()
+
 def end_work_session(work_session_id: int) -> dict:
     """Завершает рабочую сессию, устанавливая время окончания и освобождая блокировку."""
     from .state_service import state_manager
@@ -235,6 +355,10 @@ def delete_order_completely(order_id: int) -> dict:
             if cur.rowcount == 0:
                 return {"success": False, "message": f"Заказ №{order_id} не найден."}
         conn.commit()
+        invalidate_order_metadata(order_id)
+        state_manager.drop_used_codes_index(order_id)
+        # Пропуска заказа удалены каскадно - вошедшие по ним сотрудники не должны оставаться в кэше
+        invalidate_user_cache()
         return {"success": True, "message": f"Заказ №{order_id} и все связанные данные были успешно удалены."}
     except Exception as e:
         if conn: conn.rollback()
@@ -336,13 +460,14 @@ def build_and_save_model_and_samples(order_id: int, employee_token_id: int, work
     pseudo_id = 1
     for sample in samples:
         parent_code = sample['parent_code']
-        for child_code in sample['items']:
+        for position, child_code in enumerate(sample['items']):
             pseudo_aggregations.append({
                 'id': pseudo_id,
                 'parent_code': parent_code,
                 'parent_type': 'set',
                 'child_code': child_code,
-                'child_type': 'product' # Предполагаем, что в наборе - товары
+                'child_type': 'product', # Предполагаем, что в наборе - товары
+                'unit_position': position
             })
             pseudo_id += 1
     
@@ -366,14 +491,20 @@ def build_and_save_model_and_samples(order_id: int, employee_token_id: int, work
             from psycopg2.extras import execute_values
             args_list = []
             for agg in pseudo_aggregations:
-                args_list.append((order_id, employee_token_id, work_session_id, agg['child_code'], agg['child_type'], agg['parent_code'], agg['parent_type']))
+                args_list.append((order_id, employee_token_id, work_session_id, agg['child_code'], agg['child_type'], agg['parent_code'], agg['parent_type'], agg['unit_position']))
             
+            # Повторно использованные коды отклоняются уникальными индексами ma_aggregations (см. init_ma_db.py)
             execute_values(
                 cur,
-                "INSERT INTO ma_aggregations (order_id, employee_token_id, work_session_id, child_code, child_type, parent_code, parent_type) VALUES %s",
+                "INSERT INTO ma_aggregations (order_id, employee_token_id, work_session_id, child_code, child_type, parent_code, parent_type, unit_position) VALUES %s",
                 args_list
             )
         conn.commit()
+        state_manager.add_used_codes(
+            order_id,
+            [agg['child_code'] for agg in pseudo_aggregations],
+            list({agg['parent_code'] for agg in pseudo_aggregations})
+        )
     except Exception as e:
         if conn: conn.rollback()
         print(f"КРИТИЧЕСКАЯ ОШИБКА при сохранении образцов в БД: {e}")
@@ -554,7 +685,11 @@ def get_aggregations_for_order(order_id: int, page: int = 1, per_page: int = 100
         if conn: conn.close()
 
 def delete_aggregations_by_ids(aggregation_ids: list) -> dict:
-    """Удаляет записи об агрегации по списку их ID."""
+    """
+    Удаляет записи об агрегации по списку их ID.
+    Оставшиеся вложения затронутых упаковок нумеруются заново: у упаковки всегда есть запись с unit_position = 0,
+    на которой держится уникальность кода упаковки в заказе (ma_aggregations_order_parent_uidx).
+    """
     if not aggregation_ids:
         return {"success": False, "message": "Не выбрано ни одной записи для удаления."}
     
@@ -563,9 +698,28 @@ def delete_aggregations_by_ids(aggregation_ids: list) -> dict:
         conn = get_db_connection()
         with conn.cursor() as cur:
             int_ids = [int(i) for i in aggregation_ids]
-            cur.execute("DELETE FROM ma_aggregations WHERE id = ANY(%s);", (int_ids,))
+            cur.execute("DELETE FROM ma_aggregations WHERE id = ANY(%s) RETURNING order_id, parent_code;", (int_ids,))
+            affected_units = set(cur.fetchall())
             deleted_count = cur.rowcount
+            if affected_units:
+                order_ids, parent_codes = zip(*affected_units)
+                cur.execute(
+                    """
+                    UPDATE ma_aggregations a SET unit_position = r.pos
+                    FROM (
+                        SELECT id, ROW_NUMBER() OVER (PARTITION BY order_id, parent_code ORDER BY unit_position, id) - 1 AS pos
+                        FROM ma_aggregations
+                        WHERE (order_id, parent_code) IN (SELECT * FROM unnest(%s::int[], %s::text[]))
+                    ) r
+                    WHERE a.id = r.id AND a.unit_position IS DISTINCT FROM r.pos;
+                    """,
+                    (list(order_ids), list(parent_codes))
+                )
+            affected_order_ids = {order_id for order_id, _ in affected_units}
         conn.commit()
+        # Упаковка могла потерять лишь часть вложений, поэтому индекс использованных кодов строится заново
+        for affected_order_id in affected_order_ids:
+            state_manager.drop_used_codes_index(affected_order_id)
         return {"success": True, "message": f"Успешно удалено {deleted_count} записей."}
     except (Exception, ValueError) as e:
         if conn: conn.rollback()
@@ -1,4 +1,6 @@
 import json
+import time
+import uuid
 from datetime import datetime
 from app.db import get_db_connection
 from typing import Optional
@@ -8,7 +10,8 @@ from psycopg2.extras import RealDictCursor, execute_values
 import re
 
 from .state_service import state_manager
-from .order_service import get_trained_code_model, get_erroneous_sets, build_and_save_model_and_samples
+from .metrics_service import stage, timed_stage, timed_outcome
+from .order_service import get_erroneous_sets, build_and_save_model_and_samples
 
 # --- Управляющие команды ---
 CMD_COMPLETE_UNIT = "CMD_COMPLETE_UNIT"  # Завершить текущую единицу (набор/короб)
@@ -21,19 +24,32 @@ CMD_EXIT_CORRECTION_MODE = "CMD_EXIT_CORRECTION_MODE"
 # Символ-разделитель групп в коде DataMatrix, непечатаемый (ASCII 29)
 GS_SEPARATOR = '\x1d'
 
+# Статусы ответа, на которых обработка серии сканов (process_batch) останавливается
+BATCH_STOP_STATUSES = ('error', 'command')
+
+# Сколько ждать завершения предыдущего скана того же сотрудника, прежде чем вернуть ошибку (с)
+SCAN_LOCK_WAIT_SECONDS = 1.5
+SCAN_LOCK_POLL_SECONDS = 0.05
+
 class SessionTimeoutError(Exception):
     """Исключение для обозначения истечения сессии по таймауту."""
     pass
 
+class ScanInProgressError(Exception):
+    """Предыдущий скан этого сотрудника еще обрабатывается."""
+    pass
+
+class ScanLockLostError(Exception):
+    """Блокировка скана истекла до записи состояния: состояние сессии в Redis не обновлено."""
+    pass
+
 def _is_sscc(code: str) -> bool:
     """Проверяет, является ли код кодом SSCC (18 цифр)."""
     return code.isdigit() and len(code) == 18
 
-def _get_senior_token_record(order_id: int) -> Optional[RealDictCursor]:
+def _get_senior_token_record(conn, order_id: int) -> Optional[RealDictCursor]:
     """Получает запись о токене старшего смены (первый созданный для заказа)."""
-    conn = None
     try:
-        conn = get_db_connection()
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(
                 "SELECT id, access_token FROM ma_employee_tokens WHERE order_id = %s ORDER BY id ASC LIMIT 1",
@@ -41,18 +57,12 @@ def _get_senior_token_record(order_id: int) -> Optional[RealDictCursor]:
             )
             return cur.fetchone()
     except Exception as e:
+        conn.rollback()
         print(f"ОШИБКА в _get_senior_token_record: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
-def process_scan(work_session_id: int, order_info: dict, scanned_code: str) -> dict:
-    """
-    Основная точка входа для обработки сканирования.
-    Создает экземпляр ScanProcessor, обрабатывает код и возвращает результат.
-    """
-    # --- Предварительная обработка кода ---
+def _normalize_scanned_code(scanned_code: str) -> str:
+    """Предварительная обработка кода."""
     # Определяем, является ли отсканированный код командой.
     is_command = scanned_code in [CMD_COMPLETE_UNIT, CMD_CANCEL_UNIT, CMD_LOGOUT, CMD_ENTER_CORRECTION_MODE, CMD_EXIT_CORRECTION_MODE]
 
@@ -64,12 +74,17 @@ def process_scan(work_session_id: int, order_info: dict, scanned_code: str) -> d
     # .strip() убирает случайные пробелы/переводы строк по краям, которые может добавить сканер.
     if not is_command:
         scanned_code = scanned_code.strip()
+    return scanned_code
 
-    try:
-        processor = ScanProcessor(work_session_id, order_info)
-        result = processor.process(scanned_code)
-        return result
-    except SessionTimeoutError as e:
+def _exception_response(e: Exception) -> dict:
+    """Ответ на исключение при обработке скана."""
+    if isinstance(e, (ScanInProgressError, ScanLockLostError)):
+        return {
+            "status": "error",
+            "message": str(e),
+            "session": None
+        }
+    if isinstance(e, SessionTimeoutError):
         # Сессия истекла, отправляем команду на выход
         return {
             "status": "command",
@@ -77,7 +92,7 @@ def process_scan(work_session_id: int, order_info: dict, scanned_code: str) -> d
             "message": str(e),
             "session": None
         }
-    except redis.exceptions.ConnectionError as e:
+    if isinstance(e, redis.exceptions.ConnectionError):
         print(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось подключиться к Redis. {e}")
         # Возвращаем стандартизированный ответ об ошибке, который будет корректно обработан на фронтенде
         return {
@@ -85,51 +100,134 @@ def process_scan(work_session_id: int, order_info: dict, scanned_code: str) -> d
             "message": "Критическая ошибка: Сервис состояний недоступен. Обратитесь к администратору.",
             "session": None # Сессии нет, т.к. Redis не работает
         }
+    # Любая другая непредвиденная ошибка - чтобы избежать падения сервера (ошибка 500)
+    import traceback
+    print(f"НЕПРЕДВИДЕННАЯ ОШИБКА в process_scan: {e}\n{traceback.format_exc()}")
+    # Возвращаем пользователю общее, но информативное сообщение об ошибке
+    return {
+        "status": "error",
+        "message": f"Произошла внутренняя ошибка сервера. Пожалуйста, сообщите администратору. (Тип ошибки: {type(e).__name__})",
+        "session": None # Не можем доверять состоянию сессии в случае ошибки
+    }
+
+def _release_processor(conn, processor):
+    # Если транзакция не была зафиксирована (ошибка или исключение), откатываем ее
+    conn.rollback()
+    conn.close()
+    if processor is not None:
+        # При ошибке состояние не сохраняется, только снимается блокировка скана
+        try:
+            processor.finish(save=False)
+        except redis.exceptions.RedisError as e:
+            print(f"ОШИБКА при снятии блокировки скана: {e}")
+
+@timed_outcome('scan')
+def process_scan(identity: dict, order_info: dict, scanned_code: str) -> dict:
+    """
+    Основная точка входа для обработки сканирования.
+    Создает экземпляр ScanProcessor, обрабатывает код и возвращает результат.
+    `identity` - данные сотрудника, определенные при входе (см. order_service.get_employee_identity).
+    """
+    scanned_code = _normalize_scanned_code(scanned_code)
+
+    # Все запросы к БД при обработке скана идут через одно соединение (в HTTP-запросе - соединение запроса из пула):
+    # проверки и запись выполняются в одной транзакции, которая фиксируется при сохранении.
+    conn = get_db_connection()
+    processor = None
+    try:
+        processor = ScanProcessor(identity, order_info, conn, scanned_code)
+        result = processor.process(scanned_code)
+        with stage('db_commit'):
+            conn.commit()
+        processor.finish()
+        return result
     except Exception as e:
-        # Перехватываем ЛЮБУЮ другую непредвиденную ошибку, чтобы избежать падения сервера (ошибка 500)
-        import traceback
-        print(f"НЕПРЕДВИДЕННАЯ ОШИБКА в process_scan: {e}\n{traceback.format_exc()}")
-        # Возвращаем пользователю общее, но информативное сообщение об ошибке
+        return _exception_response(e)
+    finally:
+        _release_processor(conn, processor)
+
+@timed_outcome('scan_batch')
+def process_scan_batch(identity: dict, order_info: dict, scanned_codes: list) -> dict:
+    """
+    Обрабатывает серию сканов, накопленных терминалом (например, во время обрыва Wi-Fi), за один запрос:
+    одно соединение с БД и одно чтение состояния из Redis; состояние записывается после каждого
+    зафиксированного в БД скана, поэтому при ошибке посреди серии оно соответствует последнему из них.
+    Возвращает результаты по каждому обработанному скану и итоговое состояние сессии.
+    """
+    scanned_codes = [_normalize_scanned_code(code) for code in scanned_codes]
+
+    conn = get_db_connection()
+    processor = None
+    try:
+        processor = ScanProcessor(identity, order_info, conn, scanned_codes[0])
+        results = processor.process_batch(scanned_codes)
+        processor.finish()
+        last_status = results[-1].get('status')
         return {
-            "status": "error",
-            "message": f"Произошла внутренняя ошибка сервера. Пожалуйста, сообщите администратору. (Тип ошибки: {type(e).__name__})",
-            "session": None # Не можем доверять состоянию сессии в случае ошибки
+            "status": last_status,
+            "processed": len(results),
+            "total": len(scanned_codes),
+            # Состояние сессии - одно, итоговое; в результатах по сканам оно не повторяется
+            "results": [{key: value for key, value in result.items() if key != 'session'} for result in results],
+            "session": processor.session
         }
+    except Exception as e:
+        # Сканы, обработанные до ошибки, уже записаны в БД - сообщаем, сколько их было
+        processed = len(getattr(processor, 'batch_results', None) or [])
+        response = _exception_response(e)
+        response.update({"processed": processed, "total": len(scanned_codes), "results": []})
+        return response
+    finally:
+        _release_processor(conn, processor)
 
 class ScanProcessor:
-    def __init__(self, work_session_id, order_info):
-        self.work_session_id = work_session_id
+    def __init__(self, identity, order_info, conn, scanned_code):
+        self.work_session_id = identity.get('work_session_id')
         self.order = order_info
-        self.senior_token_record = None # Ленивая загрузка записи о токене старшего
-        
-        self.employee_token_id = self._get_token_id_from_session()
+        self.conn = conn
+        # Запись о пропуске старшего приходит из кэша метаданных заказа (get_order_metadata), иначе читается из БД лениво
+        self.senior_token_record = order_info.get('senior_token')
+
+        # Пропуск и признак старшего смены определены при входе и не меняются до конца рабочей сессии
+        self.employee_token_id = identity.get('employee_token_id')
+        self.is_senior_employee = identity.get('is_senior')
         if not self.employee_token_id:
             raise ValueError("Критическая ошибка: не удалось определить пропуск по текущей рабочей сессии.")
 
-        # Получаем сессию из Redis по ID пропуска (состояние привязано к пропуску)
-        self.session = state_manager.get_state(self.employee_token_id)
+        # Все данные Redis, нужные для обработки скана, читаются одним вызовом скрипта под блокировкой скана:
+        # параллельные сканы одного пропуска не смешивают свои изменения состояния (см. state_manager.begin_scan)
+        # Если блокировка занята, недолго ждем: предыдущий скан обычно обрабатывается за доли секунды
+        self._scan_lock_token = uuid.uuid4().hex
+        deadline = time.monotonic() + SCAN_LOCK_WAIT_SECONDS
+        with stage('redis_begin'):
+            snapshot = state_manager.begin_scan(self.employee_token_id, self.order['id'], scanned_code, self._scan_lock_token)
+            while snapshot is None and time.monotonic() < deadline:
+                time.sleep(SCAN_LOCK_POLL_SECONDS)
+                snapshot = state_manager.begin_scan(self.employee_token_id, self.order['id'], scanned_code, self._scan_lock_token)
+        if snapshot is None:
+            raise ScanInProgressError("Предыдущий скан еще обрабатывается. Повторите сканирование.")
+        self._finished = False
+        self._state_changed = False
+
+        # Сессия из Redis по ID пропуска (состояние привязано к пропуску)
+        self.session = snapshot['state']
         # Если состояния нет, значит сессия истекла по таймауту, т.к.
         # начальное состояние создается при логине.
         if not self.session:
+            self.finish(save=False)
             raise SessionTimeoutError("Сессия завершена из-за отсутствия активности. Пожалуйста, войдите снова.")
+        # Коды упаковки, уже записанные в Redis: при сохранении дописываются только новые
+        self._saved_items = None if snapshot['legacy_state'] else list(self.session['payload']['current_unit'].get('items', []))
 
-    def _get_token_id_from_session(self) -> Optional[int]:
-        """Получает ID физического пропуска (employee_token_id) из рабочей сессии."""
-        conn = None
-        try:
-            conn = get_db_connection()
-            with conn.cursor() as cur:
-                cur.execute("SELECT employee_token_id FROM ma_work_sessions WHERE id = %s;", (self.work_session_id,))
-                result = cur.fetchone()
-                return result[0] if result else None
-        except Exception as e:
-            print(f"ОШИБКА в _get_token_id_from_session: {e}")
-            return None
-        finally:
-            if conn:
-                conn.close()
+        self.model = snapshot['model']
+        self.order_mode = snapshot['order_mode']
+        self.correction_stats = snapshot['correction_stats']
+        self._scanned_code = scanned_code
+        self._scanned_code_in_sets_to_check = snapshot['code_in_sets_to_check']
+        self._scanned_code_used_as_child = snapshot['code_used_as_child']
 
 
+    @timed_stage('validation')
     def _validate_data_code(self, code: str) -> tuple[bool, str]:
         """
         Проверяет код на валидность (отсутствие кириллицы, мусорных символов).
@@ -168,50 +266,97 @@ class ScanProcessor:
         }
 
     def _save_state(self):
-        """Сохраняет текущее состояние сессии в Redis."""
-        state_manager.set_state(
-            self.employee_token_id, 
-            self.session['status'], 
-            self.session['payload']
+        """Отмечает, что состояние сессии изменилось; в Redis оно записывается в checkpoint() или finish()."""
+        self._state_changed = True
+
+    def checkpoint(self):
+        """
+        Записывает измененное состояние в Redis и продлевает блокировку скана, не снимая ее.
+        Вызывается в серии сканов после фиксации каждого кода в БД.
+        """
+        state = self.session if self._state_changed else None
+        with stage('redis_checkpoint'):
+            saved = state_manager.save_scan_state(self.employee_token_id, self._scan_lock_token, state, self._saved_items)
+        if not saved:
+            raise ScanLockLostError("Обработка заняла слишком много времени, состояние не сохранено. Повторите последнее сканирование.")
+        if state is not None:
+            # Теперь в Redis записаны все коды упаковки
+            self._saved_items = list(self.session['payload']['current_unit'].get('items', []))
+            self._state_changed = False
+
+    def finish(self, save: bool = True):
+        """
+        Записывает измененное состояние в Redis и снимает блокировку скана (одним вызовом скрипта).
+        Если блокировка уже истекла и состояние не записано, выбрасывает ScanLockLostError (при save=True).
+        """
+        if self._finished:
+            return
+        self._finished = True
+        state = self.session if save and self._state_changed else None
+        with stage('redis_finish'):
+            saved = state_manager.finish_scan(self.employee_token_id, self._scan_lock_token, state, self._saved_items)
+        if not saved:
+            print(f"ПРЕДУПРЕЖДЕНИЕ: блокировка скана пропуска {self.employee_token_id} истекла до завершения обработки, состояние не сохранено.")
+            if save:
+                raise ScanLockLostError("Обработка заняла слишком много времени, состояние не сохранено. Повторите последнее сканирование.")
+
+    def _ensure_used_codes_index(self) -> bool:
+        """
+        Проверяет, готов ли в Redis индекс использованных кодов заказа. При первом обращении
+        заполняет его из БД (одним запросом); пока индекс заполняет другой воркер, возвращает False.
+        """
+        order_id = self.order['id']
+        if state_manager.is_used_codes_index_ready(order_id):
+            return True
+        if not state_manager.acquire_used_codes_build_lock(order_id):
+            return False
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute("SELECT child_code, parent_code FROM ma_aggregations WHERE order_id = %s;", (order_id,))
+                rows = cur.fetchall()
+        except Exception as e:
+            self.conn.rollback()
+            print(f"ОШИБКА при построении индекса использованных кодов заказа {order_id}: {e}")
+            return False
+        state_manager.build_used_codes_index(
+            order_id,
+            list({row[0] for row in rows}),
+            list({row[1] for row in rows})
         )
+        return True
 
-    def _is_code_already_used_as_child(self, code: str) -> bool:
-        """Проверяет, был ли код использован как вложение (child) в этом заказе."""
-        conn = None
+    @timed_stage('duplicate_check')
+    def _is_code_already_used(self, code: str, kind: str) -> bool:
+        """
+        Проверяет, был ли код использован в этом заказе как вложение (kind='child') или упаковка (kind='parent').
+        Отрицательный ответ дает индекс в Redis (без обращения к БД); положительный ответ индекса
+        и проверка при неготовом индексе перепроверяются в БД.
+        """
+        if kind == 'child' and code == self._scanned_code and self._scanned_code_used_as_child is not None:
+            # Проверка по индексу уже выполнена при чтении данных скана (begin_scan)
+            if not self._scanned_code_used_as_child:
+                return False
+        elif self._ensure_used_codes_index() and not state_manager.is_code_in_used_index(self.order['id'], kind, code):
+            return False
+
+        column = 'child_code' if kind == 'child' else 'parent_code'
         try:
-            conn = get_db_connection()
-            with conn.cursor() as cur:
+            with self.conn.cursor() as cur:
                 cur.execute(
-                    "SELECT 1 FROM ma_aggregations WHERE child_code = %s AND order_id = %s LIMIT 1;",
+                    f"SELECT 1 FROM ma_aggregations WHERE {column} = %s AND order_id = %s LIMIT 1;",
                     (code, self.order['id'])
                 )
                 return cur.fetchone() is not None
         except Exception as e:
-            print(f"ОШИБКА в _is_code_already_used_as_child: {e}")
+            self.conn.rollback()
+            print(f"ОШИБКА в _is_code_already_used ({kind}): {e}")
             # В случае ошибки БД безопаснее считать, что код уже используется,
             # чтобы предотвратить запись некорректных данных.
             return True
-        finally:
-            if conn:
-                conn.close()
 
-    def _is_code_already_used_as_parent(self, code: str) -> bool:
-        """Проверяет, был ли код использован как упаковка (parent) в этом заказе."""
-        conn = None
-        try:
-            conn = get_db_connection()
-            with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT 1 FROM ma_aggregations WHERE parent_code = %s AND order_id = %s LIMIT 1;",
-                    (code, self.order['id'])
-                )
-                return cur.fetchone() is not None
-        except Exception as e:
-            print(f"ОШИБКА в _is_code_already_used_as_parent: {e}")
-            return True
-        finally:
-            if conn:
-                conn.close()
+    def _is_code_already_used_as_child(self, code: str) -> bool:
+        """Проверяет, был ли код использован как вложение (child) в этом заказе."""
+        return self._is_code_already_used(code, 'child')
 
     def process(self, scanned_code):
         """Главный метод обработки сканирования."""
@@ -231,8 +376,7 @@ class ScanProcessor:
         
         if scanned_code == CMD_EXIT_CORRECTION_MODE:
             # Проверяем, активен ли режим, чтобы не показывать это сообщение без надобности
-            order_mode, _ = state_manager.get_correction_mode_status(self.order['id'])
-            if order_mode == 'CORRECTION':
+            if self.order_mode == 'CORRECTION':
                 self.session['status'] = 'AWAITING_SENIOR_FOR_EXIT_CORRECTION'
                 self._save_state()
                 return self._build_success_response("Выход из режима коррекции: ожидание сканирования пропуска старшего смены.")
@@ -249,8 +393,7 @@ class ScanProcessor:
 
         # --- Проверка глобального режима коррекции для заказа ---
         # Если мы уже в режиме коррекции, обучение не требуется.
-        order_mode, correction_stats = state_manager.get_correction_mode_status(self.order['id'], self.employee_token_id)
-        if order_mode == 'CORRECTION':
+        if self.order_mode == 'CORRECTION':
             result = self._handle_correction_scan(scanned_code)
             # Добавляем актуальную статистику к ответу для UI
             _, result['correction_stats'] = state_manager.get_correction_mode_status(self.order['id'], self.employee_token_id)
@@ -258,7 +401,7 @@ class ScanProcessor:
 
         # --- НОВЫЙ БЛОК: ПРОВЕРКА И ПРОВЕДЕНИЕ ОБУЧЕНИЯ ---
         # Все операции ниже (кроме выхода) требуют, чтобы система была обучена.
-        is_trained = state_manager.is_order_trained(self.order['id'])
+        is_trained = bool(self.model and self.model.get('learning_successful', False))
         if not is_trained:
             if not self._is_senior_by_token_id():
                 return {
@@ -314,10 +457,32 @@ class ScanProcessor:
         self._save_state()
         return result
 
+    def process_batch(self, scanned_codes: list) -> list:
+        """
+        Обрабатывает серию сканов по очереди, как если бы они пришли отдельными запросами.
+        Останавливается на первой ошибке (она блокирует систему) или команде (выход из смены
+        выполняет терминал); остальные статусы, например 'confirmation' в режиме коррекции, - успешные.
+        После фиксации каждого кода состояние записывается в Redis и блокировка скана продлевается.
+        Возвращает результаты обработанных сканов.
+        """
+        self.batch_results = []
+        for scanned_code in scanned_codes:
+            result = self.process(scanned_code)
+            self.conn.commit()
+            # Данные, прочитанные в begin_scan для первого кода, к следующим кодам не относятся
+            self._scanned_code = None
+            self.batch_results.append(result)
+            self.checkpoint()
+            if result.get('status') in BATCH_STOP_STATUSES:
+                break
+        return self.batch_results
+
     def _is_senior_by_token_id(self) -> bool:
         """Проверяет, является ли текущий сотрудник старшим смены."""
+        if self.is_senior_employee is not None:
+            return self.is_senior_employee
         if self.senior_token_record is None:
-            self.senior_token_record = _get_senior_token_record(self.order['id'])
+            self.senior_token_record = _get_senior_token_record(self.conn, self.order['id'])
         
         if not self.senior_token_record:
             return False # Не удалось определить старшего
@@ -327,7 +492,7 @@ class ScanProcessor:
     def _is_senior(self, scanned_badge: str) -> bool:
         """Проверяет, является ли отсканированный пропуск пропуском старшего."""
         if self.senior_token_record is None:
-            self.senior_token_record = _get_senior_token_record(self.order['id'])
+            self.senior_token_record = _get_senior_token_record(self.conn, self.order['id'])
         
         if not self.senior_token_record:
             return False
@@ -344,6 +509,7 @@ class ScanProcessor:
 
         erroneous_sets = get_erroneous_sets(self.order['id'])
         state_manager.start_correction_mode(self.order['id'], erroneous_sets)
+        self.order_mode = 'CORRECTION'
         
         # Сбрасываем состояние текущего пользователя в IDLE
         self.session = self._get_initial_state()
@@ -362,6 +528,7 @@ class ScanProcessor:
             return self._build_error_response("Ошибка: Только старший смены может деактивировать режим коррекции.")
 
         state_manager.stop_correction_mode(self.order['id'])
+        self.order_mode = None
         self.session = self._get_initial_state()
         self._save_state()
         return self._build_success_response("Режим коррекции деактивирован. Система возвращена в штатный режим работы.")
@@ -388,6 +555,8 @@ class ScanProcessor:
                 self.session = self._get_initial_state() # Сброс состояния после обучения
                 self._save_state()
                 model = result['model']
+                # Следующие сканы той же серии (process_batch) работают уже с обученной моделью
+                self.model = model
                 product_prefixes_str = ", ".join(model['product_prefixes'])
                 set_prefixes_str = ", ".join(model['set_prefixes'])
                 response = self._build_success_response(
@@ -462,17 +631,24 @@ class ScanProcessor:
         2. При повторном сканировании ошибочного набора он подтверждается и удаляется.
         """
         redis = state_manager.redis_client
-        order_id = self.order['id']
         pending_removal_key = f"correction:pending_removal:{self.employee_token_id}"
-        sets_to_check_key = f"correction:sets_to_check:{order_id}"
+
+        # Для кода, с которого начат скан, принадлежность множествам коррекции прочитана в begin_scan
+        prefetched = scanned_code == self._scanned_code and self.correction_stats is not None
 
         # 1. Проверяем, не является ли этот скан подтверждением для ранее найденной ошибки
-        is_pending_confirmation = redis.sismember(pending_removal_key, scanned_code)
+        if prefetched:
+            is_pending_confirmation = scanned_code in self.correction_stats['pending_removal']
+        else:
+            is_pending_confirmation = redis.sismember(pending_removal_key, scanned_code)
         if is_pending_confirmation:
             return self._confirm_and_remove_erroneous_set(scanned_code)
 
         # 2. Если это не подтверждение, проверяем, есть ли код в общем списке ошибок
-        is_in_error_list = redis.sismember(sets_to_check_key, scanned_code)
+        if prefetched:
+            is_in_error_list = self._scanned_code_in_sets_to_check
+        else:
+            is_in_error_list = redis.sismember(f"correction:sets_to_check:{self.order['id']}", scanned_code)
         if is_in_error_list:
             # Добавляем в список "ожидающих подтверждения" для этого оператора
             redis.sadd(pending_removal_key, scanned_code)
@@ -512,27 +688,25 @@ class ScanProcessor:
         order_id = self.order['id']
         
         # 1. Удаление из базы данных
-        conn = None
         deleted_db_count = 0
         try:
-            conn = get_db_connection()
-            with conn.cursor() as cur:
+            with self.conn.cursor() as cur:
                 # Удаляем все записи, где этот код является родителем
                 cur.execute(
-                    "DELETE FROM ma_aggregations WHERE parent_code = %s AND order_id = %s;",
+                    "DELETE FROM ma_aggregations WHERE parent_code = %s AND order_id = %s RETURNING child_code;",
                     (code_to_remove, order_id)
                 )
-                deleted_db_count = cur.rowcount
-            conn.commit()
+                removed_children = [row[0] for row in cur.fetchall()]
+                deleted_db_count = len(removed_children)
+            self.conn.commit()
         except Exception as e:
-            if conn: conn.rollback()
+            self.conn.rollback()
             print(f"КРИТИЧЕСКАЯ ОШИБКА при удалении ошибочного набора из БД: {e}")
             # Если БД упала, не меняем состояние в Redis, чтобы избежать рассинхрона
             return self._build_error_response(f"Ошибка БД при удалении набора '{code_to_remove}'. Операция отменена.")
-        finally:
-            if conn: conn.close()
 
         # 2. Обновление состояния в Redis
+        state_manager.remove_used_codes(order_id, removed_children, [code_to_remove])
         redis = state_manager.redis_client
         pending_removal_key = f"correction:pending_removal:{self.employee_token_id}"
         
@@ -601,7 +775,7 @@ class ScanProcessor:
         # Теперь, когда мы знаем, что это не завершающий код, а вложение,
         # проверяем его на логическую корректность.
         if unit_type == 'set':
-            model = get_trained_code_model(self.order['id'])
+            model = self.model
             if model.get('set_prefixes') and scanned_code and len(scanned_code) >= 16:
                 if scanned_code[:16] in model['set_prefixes']:
                     return self._build_error_response("Логическая ошибка: Попытка вложить код набора в другой набор.")
@@ -653,20 +827,17 @@ class ScanProcessor:
         # --- НОВАЯ ЛОГИЧЕСКАЯ ПРОВЕРКА: Набор нельзя закрывать кодом товара ---
         unit_type = unit.get('type')
         if unit_type == 'set':
-            model = get_trained_code_model(self.order['id'])
+            model = self.model
             if model.get('product_prefixes') and parent_code and len(parent_code) >= 16:
                 if parent_code[:16] in model['product_prefixes']:
                     return self._build_error_response("Логическая ошибка: Попытка закрыть набор кодом, определенным как товар.")
 
-        # ПРОВЕРКА: не была ли эта упаковка уже зарегистрирована
-        if self._is_code_already_used_as_parent(parent_code):
-            # Состояние не меняем, чтобы пользователь мог отменить операцию или попробовать другой код
-            return self._build_error_response(f"Ошибка: Упаковка с кодом {parent_code} уже зарегистрирована в системе.")
-        
-        # Сохранение в БД
-        if not self._save_aggregation(parent_code, child_items):
-            # Состояние не меняем, чтобы не потерять данные сканирования
-            return self._build_error_response("Ошибка сохранения в базу данных. Попробуйте снова.")
+        # Сохранение в БД. Повторная регистрация упаковки и вложений отсекается ограничениями БД в том же запросе.
+        error_message = self._save_aggregation(parent_code, child_items)
+        if error_message:
+            # Состояние не меняем, чтобы не потерять данные сканирования: пользователь может
+            # отменить операцию или попробовать другой код
+            return self._build_error_response(error_message)
 
         # Сброс состояния для следующей операции
         message = f"Успешно сохранено: {unit['type']} с кодом {parent_code} ({len(child_items)} вложений)."
@@ -684,10 +855,8 @@ class ScanProcessor:
 
     def _handle_undo_last_save(self):
         """Находит и удаляет последнюю сохраненную этим сотрудником упаковку."""
-        conn = None
         try:
-            conn = get_db_connection()
-            with conn.cursor() as cur:
+            with self.conn.cursor() as cur:
                 # 1. Найти parent_code последней операции этого сотрудника в этом заказе
                 cur.execute(
                     """
@@ -706,57 +875,108 @@ class ScanProcessor:
 
                 # 2. Удалить все записи, связанные с этим parent_code
                 cur.execute(
-                    "DELETE FROM ma_aggregations WHERE parent_code = %s AND order_id = %s;",
+                    "DELETE FROM ma_aggregations WHERE parent_code = %s AND order_id = %s RETURNING child_code;",
                     (last_parent_code, self.order['id'])
                 )
-                deleted_count = cur.rowcount
-            conn.commit()
-            return self._build_success_response(f"Последняя сохраненная упаковка ({last_parent_code}) и ее {deleted_count} вложений были удалены. Можете сканировать заново.")
+                removed_children = [row[0] for row in cur.fetchall()]
+                deleted_count = len(removed_children)
+            self.conn.commit()
         except Exception as e:
-            if conn: conn.rollback()
+            self.conn.rollback()
             print(f"ОШИБКА в _handle_undo_last_save: {e}")
             return self._build_error_response("Ошибка базы данных при отмене последней операции.")
-        finally:
-            if conn: conn.close()
 
-    def _save_aggregation(self, parent_code, child_items):
-        """Сохраняет пачку записей в ma_aggregations."""
-        conn = None
+        state_manager.remove_used_codes(self.order['id'], removed_children, [last_parent_code])
+        return self._build_success_response(f"Последняя сохраненная упаковка ({last_parent_code}) и ее {deleted_count} вложений были удалены. Можете сканировать заново.")
+
+    @timed_stage('insert')
+    def _save_aggregation(self, parent_code, child_items) -> Optional[str]:
+        """
+        Сохраняет пачку записей в ma_aggregations одним запросом.
+        Уникальность кодов в заказе обеспечивают индексы ma_aggregations_order_child_uidx и
+        ma_aggregations_order_parent_uidx (см. init_ma_db.py): конфликтующие строки не вставляются,
+        и тогда вся упаковка откатывается. Если индекс не создан из-за повторов в старых данных,
+        повторную регистрацию отсекают проверки parent_taken/used_children того же запроса.
+        Возвращает текст ошибки или None при успехе.
+        """
+        parent_type = self.session['payload']['current_unit']['type']
+
+        # --- Улучшенная логика определения типа вложения ---
+        hierarchy = ['product', 'set', 'box', 'pallet']
+        child_type = 'unknown' # Значение по умолчанию
         try:
-            conn = get_db_connection()
-            with conn.cursor() as cur:
-                parent_type = self.session['payload']['current_unit']['type']
-                
-                # --- Улучшенная логика определения типа вложения ---
-                hierarchy = ['product', 'set', 'box', 'pallet']
-                child_type = 'unknown' # Значение по умолчанию
-                try:
-                    parent_index = hierarchy.index(parent_type)
-                    if parent_index > 0:
-                        # Тип вложения - это предыдущий уровень в иерархии
-                        child_type = hierarchy[parent_index - 1]
-                except ValueError:
-                    # parent_type не найден в иерархии, оставляем 'unknown'
-                    print(f"ПРЕДУПРЕЖДЕНИЕ: Неизвестный тип родителя '{parent_type}' в иерархии.")
-                
-                args_list = []
-                for child_code in child_items:
-                    args_list.append((self.order['id'], self.employee_token_id, self.work_session_id, child_code, child_type, parent_code, parent_type))
-                
-                # Используем execute_values для быстрой вставки
-                execute_values(
+            parent_index = hierarchy.index(parent_type)
+            if parent_index > 0:
+                # Тип вложения - это предыдущий уровень в иерархии
+                child_type = hierarchy[parent_index - 1]
+        except ValueError:
+            # parent_type не найден в иерархии, оставляем 'unknown'
+            print(f"ПРЕДУПРЕЖДЕНИЕ: Неизвестный тип родителя '{parent_type}' в иерархии.")
+
+        args_list = [
+            (self.order['id'], self.employee_token_id, self.work_session_id,
+             child_code, child_type, parent_code, parent_type, position)
+            for position, child_code in enumerate(child_items)
+        ]
+
+        try:
+            with self.conn.cursor() as cur:
+                # Проверки в SELECT видят данные на момент начала запроса, т.е. без строк, вставленных в inserted
+                result = execute_values(
                     cur,
-                    "INSERT INTO ma_aggregations (order_id, employee_token_id, work_session_id, child_code, child_type, parent_code, parent_type) VALUES %s",
-                    args_list
+                    """
+                    WITH new_rows (order_id, employee_token_id, work_session_id, child_code, child_type,
+                                   parent_code, parent_type, unit_position) AS (
+                        VALUES %s
+                    ),
+                    inserted AS (
+                        INSERT INTO ma_aggregations (order_id, employee_token_id, work_session_id, child_code, child_type,
+                                                     parent_code, parent_type, unit_position)
+                        SELECT * FROM new_rows
+                        ON CONFLICT DO NOTHING
+                        RETURNING child_code
+                    )
+                    SELECT
+                        (SELECT COUNT(*) FROM inserted) AS inserted_count,
+                        EXISTS (
+                            SELECT 1 FROM ma_aggregations a
+                            JOIN new_rows n ON n.unit_position = 0
+                                AND a.order_id = n.order_id AND a.parent_code = n.parent_code
+                        ) AS parent_taken,
+                        ARRAY(
+                            SELECT n.child_code FROM new_rows n
+                            WHERE EXISTS (
+                                SELECT 1 FROM ma_aggregations a
+                                WHERE a.order_id = n.order_id AND a.child_code = n.child_code
+                            )
+                        ) AS used_children
+                    """,
+                    args_list,
+                    template="(%s::integer, %s::integer, %s::integer, %s, %s, %s, %s, %s::smallint)",
+                    page_size=len(args_list),
+                    fetch=True
                 )
-            conn.commit()
-            return True
+                inserted_count, parent_taken, used_children = result[0]
+
+            # parent_taken/used_children проверяются и без конфликта вставки: уникальный индекс может отсутствовать
+            if inserted_count < len(args_list) or parent_taken or used_children:
+                # Часть кодов уже зарегистрирована - упаковка не сохраняется целиком
+                self.conn.rollback()
+                if parent_taken:
+                    return f"Ошибка: Упаковка с кодом {parent_code} уже зарегистрирована в системе."
+                if used_children:
+                    return f"Ошибка: Коды уже вложены в другие упаковки: {', '.join(used_children)}"
+                # Конфликт с упаковкой, которую одновременно сохранил другой сотрудник
+                return "Ошибка: Коды этой упаковки только что зарегистрированы другим сотрудником."
+            self.conn.commit()
         except Exception as e:
-            if conn: conn.rollback()
+            self.conn.rollback()
             print(f"ОШИБКА в _save_aggregation: {e}")
-            return False
-        finally:
-            if conn: conn.close()
+            return "Ошибка сохранения в базу данных. Попробуйте снова."
+
+        # Записи уже в БД - добавляем коды в индекс использованных кодов заказа
+        state_manager.add_used_codes(self.order['id'], child_items, [parent_code])
+        return None
 
     def _build_success_response(self, message):
         return {"status": "success", "message": message, "session": self.session}
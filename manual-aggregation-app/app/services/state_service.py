@@ -15,6 +15,75 @@ STATUS_ASSIGNED_TO_PALLET = 'ASSIGNED_TO_PALLET'
 # Сотрудник приписан к контейнеру и сканирует паллеты для него.
 STATUS_ASSIGNED_TO_CONTAINER = 'ASSIGNED_TO_CONTAINER'
 
+# --- Скрипты обработки скана (выполняются в Redis атомарно) ---
+
+# Начало скана: блокировка скана для пропуска и чтение всего, что нужно для обработки кода.
+# KEYS: 1 состояние, 2 коды упаковки, 3 блокировка скана, 4 модель заказа, 5 режим заказа,
+#       6-8 множества режима коррекции, 9 наборы сотрудника к удалению, 10 признак готовности индекса кодов,
+#       11 индекс вложений, 12 версия модели заказа
+# ARGV: 1 метка блокировки, 2 время жизни блокировки (мс), 3 отсканированный код,
+#       4 версия модели в кэше воркера (модель передается, только если версия в Redis другая)
+_BEGIN_SCAN_SCRIPT = """
+if not redis.call('SET', KEYS[3], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return cjson.encode({busy = true})
+end
+local result = {}
+if redis.call('TYPE', KEYS[1]).ok == 'string' then
+    result.legacy_state = redis.call('GET', KEYS[1])
+else
+    result.state = redis.call('HGETALL', KEYS[1])
+    result.items = redis.call('LRANGE', KEYS[2], 0, -1)
+end
+result.model_version = redis.call('GET', KEYS[12]) or '0'
+if result.model_version ~= ARGV[4] then
+    result.model = redis.call('GET', KEYS[4])
+end
+result.order_mode = redis.call('GET', KEYS[5])
+if result.order_mode == 'CORRECTION' then
+    result.correction_stats = {
+        to_check = redis.call('SCARD', KEYS[6]),
+        scanned_ok = redis.call('SCARD', KEYS[7]),
+        scanned_error = redis.call('SCARD', KEYS[8]),
+        pending_removal = redis.call('SMEMBERS', KEYS[9])
+    }
+    result.code_in_sets_to_check = redis.call('SISMEMBER', KEYS[6], ARGV[3]) == 1
+end
+if redis.call('EXISTS', KEYS[10]) == 1 then
+    result.code_used_as_child = redis.call('SISMEMBER', KEYS[11], ARGV[3]) == 1
+end
+return cjson.encode(result)
+"""
+
+# Завершение скана: запись нового состояния (если оно менялось) и снятие блокировки
+# (или ее продление - при сохранении промежуточного состояния серии сканов).
+# Если блокировка уже истекла и занята другим сканом, состояние не пишется.
+# KEYS: 1 состояние, 2 коды упаковки, 3 блокировка скана
+# ARGV: 1 метка блокировки, 2 новое время жизни блокировки (мс, '0' - снять блокировку),
+#       3 записывать состояние ('1'/'0'), 4 статус, 5 payload без кодов (JSON),
+#       6 число кодов, 7 перезаписать список кодов ('1'/'0'), 8 время жизни состояния (с), 9... новые коды
+_FINISH_SCAN_SCRIPT = """
+if redis.call('GET', KEYS[3]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[3] == '1' then
+    if ARGV[7] == '1' then
+        redis.call('DEL', KEYS[1], KEYS[2])
+    end
+    redis.call('HSET', KEYS[1], 'status', ARGV[4], 'payload', ARGV[5], 'items_count', ARGV[6])
+    for i = 9, #ARGV, 1000 do
+        redis.call('RPUSH', KEYS[2], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[8])
+    redis.call('EXPIRE', KEYS[2], ARGV[8])
+end
+if ARGV[2] == '0' then
+    redis.call('DEL', KEYS[3])
+else
+    redis.call('PEXPIRE', KEYS[3], ARGV[2])
+end
+return 1
+"""
+
 
 class EmployeeStateManager:
     """
@@ -28,47 +97,220 @@ class EmployeeStateManager:
             db=0,
             decode_responses=True # <-- Важно для работы со строками
         )
+        self._begin_scan_script = self.redis_client.register_script(_BEGIN_SCAN_SCRIPT)
+        self._finish_scan_script = self.redis_client.register_script(_FINISH_SCAN_SCRIPT)
+        # Кэш обученных моделей в памяти воркера: {order_id: (версия, модель)}.
+        # Модель меняется только при обучении и сбросе заказа, каждый раз с новой версией в Redis.
+        self._model_cache = {}
+
+    # --- Состояние сотрудника ---
+    # Хэш employee_state:<id> хранит статус, payload без списка отсканированных кодов (JSON) и счетчик кодов;
+    # сами коды текущей упаковки лежат в списке employee_state:<id>:items. При скане в список
+    # дописывается только новый код, поэтому запись не растет с размером упаковки.
+
+    STATE_TTL = 1800
 
     def _get_key(self, token_id: int) -> str:
         """Генерирует ключ для Redis."""
         return f"employee_state:{token_id}"
 
+    def _get_items_key(self, token_id: int) -> str:
+        """Ключ списка кодов, отсканированных в текущую упаковку."""
+        return f"employee_state:{token_id}:items"
+
     def _get_lock_key(self, token_id: int) -> str:
         """Генерирует ключ для блокировки сессии."""
         return f"session_lock:{token_id}"
 
+    def _get_scan_lock_key(self, token_id: int) -> str:
+        """Ключ блокировки, под которой обрабатывается скан сотрудника."""
+        return f"scan_lock:{token_id}"
+
+    @staticmethod
+    def _split_payload(payload: Dict) -> tuple[Dict, list]:
+        """Отделяет список кодов текущей упаковки от остального payload."""
+        payload = dict(payload or {})
+        unit = dict(payload.get('current_unit') or {})
+        items = unit.pop('items', None) or []
+        payload['current_unit'] = unit
+        return payload, items
+
     def get_state(self, token_id: int) -> Optional[Dict[str, Any]]:
-        """Получает текущее состояние сотрудника из Redis."""
+        """Получает текущее состояние сотрудника из Redis (хэш и список кодов - за одно обращение)."""
         key = self._get_key(token_id)
-        state_json = self.redis_client.get(key)
-        if state_json:
-            return json.loads(state_json)
-        return None
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hgetall(key)
+        pipe.lrange(self._get_items_key(token_id), 0, -1)
+        try:
+            fields, items = pipe.execute()
+        except redis.exceptions.ResponseError:
+            # Состояние в старом формате (одна JSON-строка), созданное до обновления
+            state_json = self.redis_client.get(key)
+            if not state_json:
+                return None
+            state = json.loads(state_json)
+            self.set_state(token_id, state['status'], state['payload'])
+            return state
+        return self._state_from_fields(fields, items)
+
+    @staticmethod
+    def _state_from_fields(fields: Dict, items: list) -> Optional[Dict[str, Any]]:
+        """Собирает состояние из полей хэша и списка кодов."""
+        if not fields:
+            return None
+        payload = json.loads(fields.get('payload') or '{}')
+        payload.setdefault('current_unit', {})['items'] = items
+        return {'status': fields.get('status'), 'payload': payload}
 
-    def set_state(self, token_id: int, status: str, payload: Dict = None, ex_seconds: int = 1800):
+    def set_state(self, token_id: int, status: str, payload: Dict = None, ex_seconds: int = STATE_TTL):
         """
-        Устанавливает новое состояние для сотрудника.
+        Устанавливает новое состояние для сотрудника (полностью перезаписывает старое).
         ex_seconds: время жизни ключа (30 минут), чтобы не хранить старые сессии вечно.
         """
+        self.save_state(token_id, status, payload, previous_items=None, ex_seconds=ex_seconds)
+
+    def save_state(self, token_id: int, status: str, payload: Dict, previous_items: Optional[list],
+                   ex_seconds: int = STATE_TTL):
+        """
+        Сохраняет состояние одной транзакцией MULTI.
+        previous_items - коды упаковки в том виде, в каком они были прочитаны из Redis: если текущий список
+        их продолжает, в Redis дописываются только новые коды, иначе список перезаписывается целиком.
+        """
         key = self._get_key(token_id)
-        state = {
+        items_key = self._get_items_key(token_id)
+        payload_rest, items = self._split_payload(payload)
+        appended, replace = self._diff_items(items, previous_items)
+
+        pipe = self.redis_client.pipeline(transaction=True)
+        if replace:
+            pipe.delete(key, items_key)
+        pipe.hset(key, mapping={
             'status': status,
-            'payload': payload or {}
+            'payload': json.dumps(payload_rest),
+            'items_count': len(items),
+        })
+        if appended:
+            pipe.rpush(items_key, *appended)
+        pipe.expire(key, ex_seconds)
+        pipe.expire(items_key, ex_seconds)
+        pipe.execute()
+
+    @staticmethod
+    def _diff_items(items: list, previous_items: Optional[list]) -> tuple[list, bool]:
+        """Какие коды дописать в список Redis и нужно ли перед этим очистить список."""
+        if previous_items is not None and items[:len(previous_items)] == previous_items:
+            return items[len(previous_items):], False
+        return items, True
+
+    SCAN_LOCK_TTL_MS = 30000
+
+    def begin_scan(self, token_id: int, order_id: int, scanned_code: str, lock_token: str) -> Optional[Dict[str, Any]]:
+        """
+        Начинает обработку скана одним вызовом скрипта в Redis: ставит блокировку скана сотрудника и читает
+        его состояние, модель заказа, режим коррекции со статистикой и наличие кода в индексе вложений.
+        Возвращает None, если сотрудник уже обрабатывает другой скан. Блокировку снимает finish_scan().
+        """
+        keys = [
+            self._get_key(token_id),
+            self._get_items_key(token_id),
+            self._get_scan_lock_key(token_id),
+            f"order_model:{order_id}",
+            f"order_mode:{order_id}",
+            f"correction:sets_to_check:{order_id}",
+            f"correction:scanned_ok:{order_id}",
+            f"correction:scanned_error:{order_id}",
+            f"correction:pending_removal:{token_id}",
+            self._get_used_codes_ready_key(order_id),
+            self._get_used_codes_key(order_id, 'child'),
+            self._get_model_version_key(order_id),
+        ]
+        cached_model = self._model_cache.get(order_id)
+        cached_version = cached_model[0] if cached_model else ''
+        result = json.loads(self._begin_scan_script(
+            keys=keys, args=[lock_token, self.SCAN_LOCK_TTL_MS, scanned_code, cached_version]
+        ))
+        if result.get('busy'):
+            return None
+
+        # Пустые массивы cjson кодирует как {}, отсутствующие значения - как false
+        if result.get('legacy_state'):
+            # Состояние в старом формате (одна JSON-строка): при сохранении список кодов будет перезаписан
+            state = json.loads(result['legacy_state'])
+            legacy = True
+        else:
+            flat = result.get('state') or []
+            state = self._state_from_fields(dict(zip(flat[::2], flat[1::2])), result.get('items') or [])
+            legacy = False
+
+        if cached_model and result['model_version'] == cached_version:
+            model = cached_model[1]
+        else:
+            model = self._store_model(order_id, result['model_version'], result.get('model'))
+
+        correction_stats = None
+        if result.get('correction_stats'):
+            stats = result['correction_stats']
+            correction_stats = {
+                "to_check": stats['to_check'],
+                "scanned_ok": stats['scanned_ok'],
+                "scanned_error": stats['scanned_error'],
+                "pending_removal": sorted(stats.get('pending_removal') or []),
+            }
+
+        return {
+            'state': state,
+            'legacy_state': legacy,
+            'model': model,
+            'order_mode': result.get('order_mode') or None,
+            'correction_stats': correction_stats,
+            # Для режима коррекции: числится ли код в списке ошибочных наборов заказа
+            'code_in_sets_to_check': bool(result.get('code_in_sets_to_check')),
+            # None - индекс использованных кодов еще не построен
+            'code_used_as_child': result.get('code_used_as_child'),
         }
-        self.redis_client.set(key, json.dumps(state), ex=ex_seconds)
+
+    def finish_scan(self, token_id: int, lock_token: str, state: Optional[Dict] = None,
+                    previous_items: Optional[list] = None, ex_seconds: int = STATE_TTL) -> bool:
+        """
+        Завершает обработку скана: записывает state (если передано) и снимает блокировку - одним вызовом скрипта.
+        Возвращает False, если блокировка уже была потеряна (истекла) и состояние не записано.
+        """
+        return self._run_finish_scan(token_id, lock_token, 0, state, previous_items, ex_seconds)
+
+    def save_scan_state(self, token_id: int, lock_token: str, state: Optional[Dict] = None,
+                        previous_items: Optional[list] = None, ex_seconds: int = STATE_TTL) -> bool:
+        """
+        Записывает промежуточное состояние (если передано) и продлевает блокировку скана на SCAN_LOCK_TTL_MS,
+        не снимая ее. Используется при обработке серии сканов после каждого зафиксированного кода.
+        Возвращает False, если блокировка уже была потеряна (истекла) и состояние не записано.
+        """
+        return self._run_finish_scan(token_id, lock_token, self.SCAN_LOCK_TTL_MS, state, previous_items, ex_seconds)
+
+    def _run_finish_scan(self, token_id: int, lock_token: str, lock_ttl_ms: int, state: Optional[Dict],
+                         previous_items: Optional[list], ex_seconds: int) -> bool:
+        keys = [self._get_key(token_id), self._get_items_key(token_id), self._get_scan_lock_key(token_id)]
+        if state is None:
+            args = [lock_token, lock_ttl_ms, '0']
+        else:
+            payload_rest, items = self._split_payload(state['payload'])
+            appended, replace = self._diff_items(items, previous_items)
+            args = [lock_token, lock_ttl_ms, '1', state['status'], json.dumps(payload_rest), len(items),
+                    '1' if replace else '0', ex_seconds, *appended]
+        return bool(self._finish_scan_script(keys=keys, args=args))
 
     def update_payload(self, token_id: int, new_data: Dict):
         """Обновляет payload в существующем состоянии."""
         state = self.get_state(token_id)
         if state:
+            previous_items = list(state['payload']['current_unit'].get('items', []))
             state['payload'].update(new_data)
-            self.set_state(token_id, state['status'], state['payload'])
+            self.save_state(token_id, state['status'], state['payload'], previous_items)
 
     def clear_state(self, token_id: int):
         """Полностью удаляет состояние сотрудника и снимает блокировку сессии."""
         state_key = self._get_key(token_id)
         lock_key = self._get_lock_key(token_id)
-        self.redis_client.delete(state_key, lock_key)
+        self.redis_client.delete(state_key, self._get_items_key(token_id), lock_key)
 
     def acquire_session_lock(self, token_id: int, ex_seconds: int = 1800) -> bool:
         """
@@ -98,49 +340,207 @@ class EmployeeStateManager:
         keys_to_delete = [model_key]
         for token_id in token_ids:
             keys_to_delete.append(self._get_key(token_id)) # employee_state:<id>
+            keys_to_delete.append(self._get_items_key(token_id)) # employee_state:<id>:items
             keys_to_delete.append(self._get_lock_key(token_id)) # session_lock:<id>
         
-        # 3. Удаляем все ключи одной командой, если они есть
-        if keys_to_delete:
-            self.redis_client.delete(*keys_to_delete)
+        # 3. Удаляем все ключи одной командой; новая версия модели сбрасывает ее копии в воркерах
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.delete(*keys_to_delete)
+        pipe.incr(self._get_model_version_key(order_id))
+        pipe.execute()
+
+    def drop_order_model(self, order_id: int):
+        """Удаляет модель удаленного заказа вместе с ее версией и копией в кэше этого воркера."""
+        self.redis_client.delete(f"order_model:{order_id}", self._get_model_version_key(order_id))
+        self._model_cache.pop(order_id, None)
+
+    def _get_model_version_key(self, order_id: int) -> str:
+        return f"order_model_version:{order_id}"
 
     def is_order_trained(self, order_id: int) -> bool:
         """Проверяет, существует ли обученная модель для заказа."""
-        model_key = f"order_model:{order_id}"
-        cached_data = self.redis_client.get(model_key)
-        if not cached_data:
-            return False
-        try:
-            model = json.loads(cached_data)
-            # Модель считается обученной, если она существует и флаг успешности установлен
-            return model.get('learning_successful', False)
-        except json.JSONDecodeError:
-            return False
+        model = self.get_trained_model(order_id)
+        # Модель считается обученной, если она существует и флаг успешности установлен
+        return bool(model and model.get('learning_successful', False))
 
     def get_trained_model(self, order_id: int) -> Optional[Dict[str, Any]]:
-        """Получает обученную модель для заказа из Redis."""
-        model_key = f"order_model:{order_id}"
-        cached_data = self.redis_client.get(model_key)
+        """
+        Получает обученную модель для заказа: из кэша воркера, если версия модели в Redis не изменилась.
+        Возвращаемая модель общая для всех потоков воркера - изменять ее нельзя.
+        """
+        version = self.redis_client.get(self._get_model_version_key(order_id)) or '0'
+        cached_model = self._model_cache.get(order_id)
+        if cached_model and cached_model[0] == version:
+            return cached_model[1]
+
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.get(self._get_model_version_key(order_id))
+        pipe.get(f"order_model:{order_id}")
+        version, cached_data = pipe.execute()
+        return self._store_model(order_id, version or '0', cached_data)
+
+    def _store_model(self, order_id: int, version: str, cached_data: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Разбирает JSON модели, прочитанный вместе с ее версией, и кладет модель в кэш воркера."""
+        model = self._parse_model(cached_data)
+        self._model_cache[order_id] = (version, model)
+        return model
+
+    @staticmethod
+    def _parse_model(cached_data: Optional[str]) -> Optional[Dict[str, Any]]:
         if cached_data:
             try:
                 model = json.loads(cached_data)
-                # Преобразуем списки обратно в множества для быстрой проверки
-                model['product_prefixes'] = set(model.get('product_prefixes', []))
-                model['set_prefixes'] = set(model.get('set_prefixes', []))
+                # Префиксы - строки фиксированной длины (16 символов), проверка кода - поиск в неизменяемом множестве
+                model['product_prefixes'] = frozenset(model.get('product_prefixes', []))
+                model['set_prefixes'] = frozenset(model.get('set_prefixes', []))
                 return model
             except (json.JSONDecodeError, TypeError):
                 return None
         return None
 
     def save_trained_model(self, order_id: int, model: dict):
-        """Сохраняет обученную модель в Redis без ограничения по времени."""
+        """Сохраняет обученную модель в Redis без ограничения по времени (с новой версией для кэшей воркеров)."""
         model_key = f"order_model:{order_id}"
         # Преобразуем множества в списки для JSON-сериализации
         model_to_cache = model.copy()
         model_to_cache['product_prefixes'] = list(model.get('product_prefixes', set()))
         model_to_cache['set_prefixes'] = list(model.get('set_prefixes', set()))
-        
-        self.redis_client.set(model_key, json.dumps(model_to_cache))
+
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.set(model_key, json.dumps(model_to_cache))
+        pipe.incr(self._get_model_version_key(order_id))
+        pipe.execute()
+
+    def _get_order_meta_key(self, order_id: int) -> str:
+        return f"order_meta:{order_id}"
+
+    def _get_order_meta_version_key(self, order_id: int) -> str:
+        return f"order_meta_version:{order_id}"
+
+    def get_order_meta_version(self, order_id: int) -> int:
+        """Текущая версия метаданных заказа. Увеличивается при каждом изменении заказа."""
+        version = self.redis_client.get(self._get_order_meta_version_key(order_id))
+        return int(version) if version else 0
+
+    def get_order_meta(self, order_id: int) -> Optional[Dict[str, Any]]:
+        """Метаданные заказа из Redis (с полем 'version', для которой они были загружены)."""
+        meta_json = self.redis_client.get(self._get_order_meta_key(order_id))
+        if meta_json:
+            try:
+                return json.loads(meta_json)
+            except json.JSONDecodeError:
+                return None
+        return None
+
+    def save_order_meta(self, order_id: int, meta: dict, ex_seconds: int = 3600):
+        """Сохраняет метаданные заказа в Redis."""
+        self.redis_client.set(self._get_order_meta_key(order_id), json.dumps(meta, default=str), ex=ex_seconds)
+
+    def invalidate_order_meta(self, order_id: int):
+        """Сбрасывает кэш метаданных заказа: новая версия делает устаревшими копии во всех воркерах."""
+        pipe = self.redis_client.pipeline()
+        pipe.incr(self._get_order_meta_version_key(order_id))
+        pipe.delete(self._get_order_meta_key(order_id))
+        pipe.execute()
+
+    # --- Поколение кэша пользователей (см. auth.load_user) ---
+
+    def get_user_cache_generation(self) -> int:
+        generation = self.redis_client.get("user_cache_generation")
+        return int(generation) if generation else 0
+
+    def invalidate_user_cache(self):
+        """Новое поколение делает устаревшими кэши пользователей во всех воркерах."""
+        self.redis_client.incr("user_cache_generation")
+
+    # --- Индекс использованных кодов заказа ---
+    # Множества кодов, уже записанных в ma_aggregations как вложения (child) и упаковки (parent).
+    # Ключ ready означает, что множества заполнены из БД; все три ключа живут и продлеваются вместе.
+
+    USED_CODES_TTL = 30 * 24 * 3600
+    USED_CODES_BUILD_BATCH = 10000
+
+    def _get_used_codes_key(self, order_id: int, kind: str) -> str:
+        return f"used_codes:{kind}:{order_id}"
+
+    def _get_used_codes_ready_key(self, order_id: int) -> str:
+        return f"used_codes:ready:{order_id}"
+
+    def _used_codes_keys(self, order_id: int) -> list:
+        return [self._get_used_codes_key(order_id, 'child'), self._get_used_codes_key(order_id, 'parent'),
+                self._get_used_codes_ready_key(order_id)]
+
+    def is_used_codes_index_ready(self, order_id: int) -> bool:
+        return bool(self.redis_client.exists(self._get_used_codes_ready_key(order_id)))
+
+    def acquire_used_codes_build_lock(self, order_id: int, ex_seconds: int = 120) -> bool:
+        """Только один воркер заполняет индекс заказа из БД; остальные в это время проверяют коды по БД."""
+        return bool(self.redis_client.set(f"used_codes:build_lock:{order_id}", "1", ex=ex_seconds, nx=True))
+
+    def build_used_codes_index(self, order_id: int, child_codes: list, parent_codes: list):
+        """Заполняет индекс кодами из БД и помечает его готовым."""
+        child_key = self._get_used_codes_key(order_id, 'child')
+        parent_key = self._get_used_codes_key(order_id, 'parent')
+        pipe = self.redis_client.pipeline()
+        for key, codes in ((child_key, child_codes), (parent_key, parent_codes)):
+            for start in range(0, len(codes), self.USED_CODES_BUILD_BATCH):
+                pipe.sadd(key, *codes[start:start + self.USED_CODES_BUILD_BATCH])
+        pipe.set(self._get_used_codes_ready_key(order_id), "1")
+        for key in self._used_codes_keys(order_id):
+            pipe.expire(key, self.USED_CODES_TTL)
+        pipe.execute()
+        self.redis_client.delete(f"used_codes:build_lock:{order_id}")
+
+    def is_code_in_used_index(self, order_id: int, kind: str, code: str) -> bool:
+        """kind: 'child' или 'parent'."""
+        return bool(self.redis_client.sismember(self._get_used_codes_key(order_id, kind), code))
+
+    def add_used_codes(self, order_id: int, child_codes: list, parent_codes: list):
+        """
+        Добавляет сохраненные коды в индекс (одной транзакцией MULTI).
+        Пишет и в еще не построенный индекс: если его как раз заполняют из БД, коды не потеряются.
+        Вызывается после записи в БД, поэтому ошибка Redis не пробрасывается (см. _discard_used_codes_index).
+        """
+        try:
+            pipe = self.redis_client.pipeline(transaction=True)
+            if child_codes:
+                pipe.sadd(self._get_used_codes_key(order_id, 'child'), *child_codes)
+            if parent_codes:
+                pipe.sadd(self._get_used_codes_key(order_id, 'parent'), *parent_codes)
+            for key in self._used_codes_keys(order_id):
+                pipe.expire(key, self.USED_CODES_TTL)
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            self._discard_used_codes_index(order_id, e)
+
+    def remove_used_codes(self, order_id: int, child_codes: list, parent_codes: list):
+        """Убирает из индекса коды удаленных агрегаций (одной транзакцией MULTI). Ошибка Redis не пробрасывается."""
+        try:
+            pipe = self.redis_client.pipeline(transaction=True)
+            if child_codes:
+                pipe.srem(self._get_used_codes_key(order_id, 'child'), *child_codes)
+            if parent_codes:
+                pipe.srem(self._get_used_codes_key(order_id, 'parent'), *parent_codes)
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            self._discard_used_codes_index(order_id, e)
+
+    def _discard_used_codes_index(self, order_id: int, error: Exception):
+        """
+        Индекс, не совпадающий с БД, пропустил бы дубликаты или отклонил свободные коды - удаляем его,
+        при следующей проверке он будет заново заполнен из БД. Источник истины - БД: изменения в ней
+        уже зафиксированы, поэтому ошибка только записывается в лог.
+        """
+        print(f"ОШИБКА обновления индекса использованных кодов заказа {order_id}: {error}. Индекс будет перестроен из БД.")
+        try:
+            self.drop_used_codes_index(order_id)
+        except redis.exceptions.RedisError as e:
+            # Устаревший индекс не пропустит повтор кода в БД: его отсекают уникальные индексы ma_aggregations
+            print(f"ОШИБКА удаления индекса использованных кодов заказа {order_id}: {e}")
+
+    def drop_used_codes_index(self, order_id: int):
+        """Удаляет индекс заказа; при следующей проверке он будет заново заполнен из БД."""
+        self.redis_client.delete(*self._used_codes_keys(order_id))
 
     def get_correction_mode_status(self, order_id: int, employee_token_id: Optional[int] = None) -> tuple[Optional[str], Optional[dict]]:
         """
@@ -0,0 +1,323 @@
+# manual-aggregation-app/benchmarks/scan_load_test.py
+"""
+Нагрузочный тест обработки сканов: смена виртуальных сканеров, одновременно собирающих наборы или короба.
+
+Создает в БД тестовый заказ с пропусками, обученную модель кодов и рабочие сессии (как при входе сотрудника),
+после чего каждый виртуальный сканер в своем потоке проходит циклы сборки: N кодов товаров (DataMatrix),
+затем код набора (DataMatrix с другим GTIN) или SSCC короба. Скан обрабатывается тем же кодом,
+что и POST /api/scan: метаданные заказа (get_order_metadata) и process_scan в контексте запроса Flask,
+с соединением из пула. Коды генерируются детерминированно (--seed), прогон воспроизводим.
+
+В отчете - устойчивая пропускная способность (сканов/с и упаковок/с после разогрева), перцентили задержки
+по видам сканов и, при включенных замерах (MA_SCAN_METRICS), время этапов обработки.
+
+Нужны локальные PostgreSQL (схема из init_ma_db.py, DATABASE_URL из .env) и Redis.
+Тестовый заказ удаляется после прогона (если не указан --keep).
+
+Запуск из папки manual-aggregation-app:
+    python -m benchmarks.scan_load_test --scanners 20 --duration 60 --warmup 10
+    python -m benchmarks.scan_load_test --mode box --unit-size 24 --think-ms 800 --scanners 40
+    python -m benchmarks.scan_load_test --batch --scanners 10 --units 50
+"""
+import argparse
+import datetime
+import os
+import random
+import statistics
+import threading
+import time
+from collections import Counter, defaultdict
+
+from dotenv import load_dotenv
+
+BENCH_CLIENT_NAME = 'BENCHMARK'
+PRODUCT_GTIN = '04600000000017'
+SET_GTIN = '04600000000024'
+# Префикс предприятия GS1 для SSCC тестовых коробов
+SSCC_COMPANY_PREFIX = '4600000'
+GS_SEPARATOR = '\x1d'
+CRYPTO_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+
+
+def _configure_environment(args):
+    """Переменные окружения задаются до импорта модулей приложения: часть настроек читается при импорте."""
+    dotenv_path = os.path.join(os.path.dirname(__file__), '..', '..', '.env')
+    if os.path.exists(dotenv_path):
+        load_dotenv(dotenv_path=dotenv_path)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    os.environ['REDIS_HOST'] = args.redis_host
+    os.environ['REDIS_PORT'] = str(args.redis_port)
+    # Пул соединений - как у воркера gunicorn (см. Dockerfile): не меньше потоков-сканеров, minconn = maxconn,
+    # чтобы замер не включал открытие соединений, которые пул с малым minconn закрывает при возврате
+    pool_size = str(max(args.scanners, int(os.getenv('DB_POOL_MAX', '32'))))
+    os.environ['DB_POOL_MIN'] = pool_size
+    os.environ['DB_POOL_MAX'] = pool_size
+    if not args.no_stage_metrics:
+        os.environ['MA_SCAN_METRICS'] = '1'
+
+
+def _sscc(serial: int) -> str:
+    """SSCC (18 цифр) с контрольной цифрой GS1."""
+    body = f"1{SSCC_COMPANY_PREFIX}{serial:09d}"
+    total = sum(int(digit) * (3 if index % 2 == 0 else 1) for index, digit in enumerate(reversed(body)))
+    return body + str((10 - total % 10) % 10)
+
+
+class CodeGenerator:
+    """Коды одного виртуального сканера: уникальны в заказе, одинаковы при одном и том же --seed."""
+
+    def __init__(self, scanner_index: int, seed: int):
+        self.scanner_index = scanner_index
+        self.random = random.Random(seed * 100003 + scanner_index)
+        self.counter = 0
+
+    def _next_serial(self) -> str:
+        self.counter += 1
+        return f"{self.scanner_index:05d}{self.counter:08d}"
+
+    def datamatrix(self, gtin: str) -> str:
+        crypto = ''.join(self.random.choice(CRYPTO_ALPHABET) for _ in range(4))
+        return f"01{gtin}21{self._next_serial()}{GS_SEPARATOR}93{crypto}"
+
+    def box_code(self) -> str:
+        self.counter += 1
+        return _sscc(self.scanner_index * 10 ** 6 + self.counter)
+
+    def unit_cycle(self, mode: str, unit_size: int) -> list[tuple[str, str]]:
+        """Сканы одной упаковки: [(вид скана, код)], последний - код упаковки, завершающий сборку."""
+        cycle = [('item', self.datamatrix(PRODUCT_GTIN)) for _ in range(unit_size)]
+        parent_code = self.datamatrix(SET_GTIN) if mode == 'set' else self.box_code()
+        cycle.append(('complete', parent_code))
+        return cycle
+
+
+def _create_order(args, run_label):
+    """Создает тестовый заказ с пропусками и обученную модель кодов. Возвращает (order_id, [пропуск])."""
+    from app.services.order_service import create_new_order
+    from app.services.state_service import state_manager
+
+    # Для набора вместимость задана - код набора завершает сборку сам, как на линии; короб завершает SSCC
+    set_capacity = args.unit_size if args.mode == 'set' else None
+    result = create_new_order(f"{BENCH_CLIENT_NAME} {run_label}", [args.mode], args.scanners, set_capacity)
+    if not result['success']:
+        raise RuntimeError(result['message'])
+    order_id = result['order_id']
+
+    # Обучение по образцам здесь не проверяется - модель сохраняется готовой
+    state_manager.save_trained_model(order_id, {
+        'product_prefixes': {f"01{PRODUCT_GTIN}"},
+        'set_prefixes': {f"01{SET_GTIN}"},
+        'learning_successful': True,
+    })
+    return order_id, result['tokens']
+
+
+def _start_sessions(args, order_id, access_tokens, identities):
+    """Входит по каждому пропуску, как сотрудник: рабочая сессия и начальное состояние. Заполняет identities."""
+    from app.services.order_service import create_work_session, get_employee_identity
+    from app.services.state_service import state_manager
+
+    for index, access_token in enumerate(access_tokens):
+        work_session_id = create_work_session(access_token, f"Сканер {index + 1}", order_id, f"benchmark-{index + 1}")
+        if not work_session_id:
+            raise RuntimeError(f"Не удалось создать рабочую сессию для пропуска {access_token}")
+        identity = get_employee_identity(work_session_id)
+        identities.append(identity)
+        # Начальное состояние - как при входе сотрудника (routes.login_employee)
+        state_manager.set_state(identity['employee_token_id'], 'IDLE',
+                                {"current_unit": {"type": None, "items": []}, "next_step": args.mode})
+
+
+def _delete_order(order_id, identities):
+    from app.services.order_service import delete_order_completely, end_work_session
+    from app.services.state_service import state_manager
+
+    for identity in identities:
+        end_work_session(identity['work_session_id'])
+    token_ids = [identity['employee_token_id'] for identity in identities]
+    state_manager.reset_order_state(order_id, token_ids)
+    state_manager.drop_order_model(order_id)
+    result = delete_order_completely(order_id)
+    if not result['success']:
+        print(f"ВНИМАНИЕ: {result['message']}")
+
+
+class ScannerStats:
+    """Результаты одного виртуального сканера: (время завершения, вид скана, статус, задержка в мс)."""
+
+    def __init__(self):
+        self.scans = []
+        self.units = []
+        self.errors = Counter()
+
+
+def _run_scanner(app, args, order_id, identity, scanner_index, deadline, stats):
+    """Цикл виртуального сканера: сборка упаковок до окончания прогона или заданного числа упаковок."""
+    from app.services.order_service import get_order_metadata
+    from app.services.scan_service import process_scan, process_scan_batch
+    from app.services.state_service import state_manager
+
+    codes = CodeGenerator(scanner_index, args.seed)
+    pause = random.Random(args.seed * 7 + scanner_index)
+    initial_payload = {"current_unit": {"type": None, "items": []}, "next_step": args.mode}
+
+    def scan(kind, payload):
+        # Контекст запроса - как в API: соединение с БД из пула возвращается при выходе из контекста
+        started = time.perf_counter()
+        with app.test_request_context('/api/scan', method='POST'):
+            order_info = get_order_metadata(order_id)
+            if isinstance(payload, list):
+                result = process_scan_batch(identity=identity, order_info=order_info, scanned_codes=payload)
+            else:
+                result = process_scan(identity=identity, order_info=order_info, scanned_code=payload)
+        finished = time.perf_counter()
+        stats.scans.append((finished, kind, result.get('status'), (finished - started) * 1000))
+        return result
+
+    units_done = 0
+    while time.perf_counter() < deadline and (not args.units or units_done < args.units):
+        cycle = codes.unit_cycle(args.mode, args.unit_size)
+        if args.batch:
+            results = [scan('batch', [code for _, code in cycle])]
+        else:
+            results = []
+            for kind, code in cycle:
+                if args.think_ms:
+                    # Оператор берет следующий товар: пауза со случайным разбросом +-50%
+                    time.sleep(args.think_ms * pause.uniform(0.5, 1.5) / 1000)
+                results.append(scan(kind, code))
+                if results[-1].get('status') != 'success':
+                    break
+
+        failed = next((result for result in results if result.get('status') != 'success'), None)
+        if failed:
+            stats.errors[failed.get('message', '').split('\n')[0][:120]] += 1
+            # Ошибка блокирует терминал до скана пропуска старшего - начинаем упаковку заново с чистого состояния
+            state_manager.set_state(identity['employee_token_id'], 'IDLE', initial_payload)
+            continue
+        units_done += 1
+        stats.units.append(time.perf_counter())
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def _report(all_stats, measure_from, measure_to, args):
+    window = measure_to - measure_from
+    scans = [scan for stats in all_stats for scan in stats.scans if measure_from <= scan[0] <= measure_to]
+    units = [moment for stats in all_stats for moment in stats.units if measure_from <= moment <= measure_to]
+    codes_per_scan = args.unit_size + 1 if args.batch else 1
+    scanned_codes = len(scans) * codes_per_scan
+
+    by_kind = defaultdict(list)
+    statuses = Counter()
+    for _, kind, status, latency_ms in scans:
+        statuses[status] += 1
+        if status == 'success':
+            by_kind[kind].append(latency_ms)
+
+    print(f"\n{'Вид скана':<12}{'n':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}{'ср., мс':>10}")
+    for kind in ('item', 'complete', 'batch'):
+        latencies = by_kind.get(kind)
+        if not latencies:
+            continue
+        print(f"{kind:<12}{len(latencies):>8}"
+              f"{statistics.median(latencies):>10.2f}{_percentile(latencies, 95):>10.2f}"
+              f"{_percentile(latencies, 99):>10.2f}{max(latencies):>10.2f}{statistics.mean(latencies):>10.2f}")
+
+    print(f"\nОкно замера: {window:.1f} с (без разогрева); ответы: "
+          + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items(), key=lambda item: str(item[0]))))
+    if window > 0:
+        print(f"Пропускная способность: {scanned_codes / window:.1f} сканов/с, {len(units) / window:.2f} упаковок/с "
+              f"({args.scanners} сканеров, {args.mode} по {args.unit_size} шт.)")
+
+    errors = Counter()
+    for stats in all_stats:
+        errors.update(stats.errors)
+    if errors:
+        print("\nОшибки (за весь прогон):")
+        for message, count in errors.most_common(10):
+            print(f"  {count:>6}  {message}")
+
+
+def _report_stages():
+    from app.services import metrics_service
+
+    snapshot = metrics_service.snapshot()
+    if not snapshot['enabled'] or not snapshot['stages']:
+        return
+    print(f"\n{'Этап (весь прогон)':<24}{'n':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, stage in snapshot['stages'].items():
+        print(f"{name:<24}{stage['count']:>8}{stage['p50_ms']:>10.2f}{stage['p95_ms']:>10.2f}"
+              f"{stage['p99_ms']:>10.2f}{stage['max_ms']:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scanners', type=int, default=10, help='Количество виртуальных сканеров (пропусков)')
+    parser.add_argument('--mode', choices=['set', 'box'], default='set', help='Уровень агрегации: наборы или короба')
+    parser.add_argument('--unit-size', type=int, default=6, help='Товаров в упаковке')
+    parser.add_argument('--duration', type=float, default=30, help='Длительность прогона, с')
+    parser.add_argument('--warmup', type=float, default=5, help='Начальный период, не входящий в замер, с')
+    parser.add_argument('--units', type=int, default=0, help='Упаковок на сканер (0 - без ограничения, до конца прогона)')
+    parser.add_argument('--think-ms', type=float, default=0, help='Средняя пауза оператора между сканами, мс (0 - без пауз)')
+    parser.add_argument('--batch', action='store_true', help='Отправлять упаковку одним пакетом (как /api/scan/batch)')
+    parser.add_argument('--seed', type=int, default=1, help='Начальное значение генератора кодов и пауз')
+    parser.add_argument('--database-url', help='Строка подключения к БД (по умолчанию DATABASE_URL из .env)')
+    parser.add_argument('--redis-host', default='localhost', help='Хост Redis')
+    parser.add_argument('--redis-port', type=int, default=6379, help='Порт Redis')
+    parser.add_argument('--no-stage-metrics', action='store_true', help='Не замерять этапы обработки (MA_SCAN_METRICS)')
+    parser.add_argument('--keep', action='store_true', help='Не удалять тестовый заказ после прогона')
+    args = parser.parse_args()
+
+    if args.scanners < 1 or args.unit_size < 1:
+        parser.error("--scanners и --unit-size должны быть больше нуля")
+    if args.warmup >= args.duration:
+        parser.error("--warmup должен быть меньше --duration")
+
+    _configure_environment(args)
+
+    # Импорт после настройки окружения
+    from app import create_app
+
+    app = create_app()
+    run_label = f"load test {datetime.datetime.now():%Y-%m-%d %H:%M:%S}"
+    order_id, identities = None, []
+    try:
+        order_id, access_tokens = _create_order(args, run_label)
+        _start_sessions(args, order_id, access_tokens, identities)
+        print(f"Заказ #{order_id}: {args.scanners} сканеров, {args.mode} по {args.unit_size} шт., "
+              f"{'пакетами' if args.batch else 'по одному скану'}, пауза оператора {args.think_ms:g} мс")
+
+        started = time.perf_counter()
+        deadline = started + args.duration
+        all_stats = [ScannerStats() for _ in identities]
+        threads = [
+            threading.Thread(target=_run_scanner, name=f"scanner-{index + 1}",
+                             args=(app, args, order_id, identity, index + 1, deadline, all_stats[index]), daemon=True)
+            for index, identity in enumerate(identities)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        finished = time.perf_counter()
+
+        # При --units сканеры могут закончить раньше срока - окно замера заканчивается с последним сканом
+        _report(all_stats, started + args.warmup, min(finished, deadline), args)
+        _report_stages()
+    finally:
+        if order_id and not args.keep:
+            _delete_order(order_id, identities)
+        elif order_id:
+            print(f"\nТестовый заказ #{order_id} сохранен.")
+
+
+if __name__ == '__main__':
+    main()
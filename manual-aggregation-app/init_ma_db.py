@@ -91,6 +91,34 @@ def initialize_database():
         # Добавляем колонку и удаляем старое ограничение
         cur.execute("ALTER TABLE ma_aggregations ADD COLUMN IF NOT EXISTS work_session_id INTEGER REFERENCES ma_work_sessions(id) ON DELETE SET NULL;")
         cur.execute("ALTER TABLE ma_aggregations DROP CONSTRAINT IF EXISTS ma_aggregations_child_code_parent_code_key;")
+        # Порядковый номер вложения внутри упаковки (0 - первое вложение)
+        cur.execute("ALTER TABLE ma_aggregations ADD COLUMN IF NOT EXISTS unit_position SMALLINT;")
+        # Нумеруем вложения в записях, созданных до появления колонки
+        cur.execute("""
+            UPDATE ma_aggregations a SET unit_position = r.pos
+            FROM (
+                SELECT id, ROW_NUMBER() OVER (PARTITION BY order_id, parent_code ORDER BY id) - 1 AS pos
+                FROM ma_aggregations WHERE unit_position IS NULL
+            ) r
+            WHERE a.id = r.id;
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS ma_aggregations_order_parent_idx ON ma_aggregations (order_id, parent_code);")
+        # Уникальность кодов в заказе: код вкладывается только один раз, упаковка регистрируется только один раз
+        # (у каждой упаковки ровно одна запись с unit_position = 0).
+        # Если в старых данных уже есть повторы, индекс не создается - их нужно разобрать вручную.
+        # До этого повторы отсекает проверка в ScanProcessor._save_aggregation (без защиты от одновременных сохранений).
+        for index_name, index_sql in (
+            ('ma_aggregations_order_child_uidx',
+             "CREATE UNIQUE INDEX IF NOT EXISTS ma_aggregations_order_child_uidx ON ma_aggregations (order_id, child_code);"),
+            ('ma_aggregations_order_parent_uidx',
+             "CREATE UNIQUE INDEX IF NOT EXISTS ma_aggregations_order_parent_uidx ON ma_aggregations (order_id, parent_code) WHERE unit_position = 0;"),
+        ):
+            cur.execute("SAVEPOINT create_unique_index;")
+            try:
+                cur.execute(index_sql)
+            except psycopg2.IntegrityError as e:
+                cur.execute("ROLLBACK TO SAVEPOINT create_unique_index;")
+                print(f"   ВНИМАНИЕ: индекс '{index_name}' не создан, в ma_aggregations есть повторяющиеся коды: {e}")
         print("4. Таблица 'ma_aggregations' проверена/создана.")
 
         cur.execute("""
@@ -99,6 +127,7 @@ def initialize_database():
             COMMENT ON COLUMN ma_orders.set_capacity IS 'Максимальное количество товаров в наборе (если задано).';
             COMMENT ON COLUMN ma_aggregations.parent_code IS 'Код родительского контейнера (DM набора, SSCC короба, SSCC паллета).';
             COMMENT ON COLUMN ma_aggregations.work_session_id IS 'ID рабочей сессии, в рамках которой была создана запись.';
+            COMMENT ON COLUMN ma_aggregations.unit_position IS 'Порядковый номер вложения в упаковке (0 - первое); по нему контролируется однократная регистрация упаковки.';
             COMMENT ON COLUMN ma_employee_tokens.employee_name IS 'Имя сотрудника, привязанное к пропуску.';
             COMMENT ON COLUMN ma_work_sessions.employee_name IS 'Имя сотрудника на момент начала сессии.';
         """)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Тесты запускаются из папки manual-aggregation-app: python -m pytest tests
+# Корень приложения добавляется в путь, чтобы пакет app импортировался и при запуске из другой папки.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
@@ -0,0 +1,95 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from app.services import scan_service
+from app.services.scan_service import ScanLockLostError, ScanProcessor
+
+ORDER_ID = 7
+EMPLOYEE_TOKEN_ID = 11
+ERRONEOUS_SET = '0104600000000024215ERRSET'
+OK_SET = '0104600000000024215OKSET01'
+
+
+@pytest.fixture
+def redis_state(monkeypatch):
+    """
+    Подменяет state_manager: набор ERRONEOUS_SET отложен этим оператором для подтверждения удаления,
+    остальные наборы не в списке ошибок.
+    """
+    pending_removal = {ERRONEOUS_SET}
+    state_manager = MagicMock()
+    state_manager.redis_client.sismember.side_effect = (
+        lambda key, code: key.startswith('correction:pending_removal:') and code in pending_removal
+    )
+    state_manager.get_correction_mode_status.return_value = ('CORRECTION', {'pending_removal': []})
+    monkeypatch.setattr(scan_service, 'state_manager', state_manager)
+    return state_manager
+
+
+@pytest.fixture
+def processor():
+    """ScanProcessor в режиме коррекции без чтения состояния из Redis (begin_scan)."""
+    conn = MagicMock()
+    conn.cursor.return_value.__enter__.return_value.fetchall.return_value = [('child-1',), ('child-2',)]
+    processor = ScanProcessor.__new__(ScanProcessor)
+    processor.order = {'id': ORDER_ID, 'aggregation_levels': ['set']}
+    processor.conn = conn
+    processor.employee_token_id = EMPLOYEE_TOKEN_ID
+    processor.session = {'status': 'IDLE', 'payload': {'current_unit': {'type': None, 'items': []}, 'next_step': 'set'}}
+    processor.order_mode = 'CORRECTION'
+    processor.correction_stats = None
+    processor._scanned_code = None
+    processor._scan_lock_token = 'lock'
+    processor._state_changed = False
+    processor._saved_items = []
+    processor._finished = False
+    return processor
+
+
+def test_correction_batch_continues_after_confirmation(redis_state, processor):
+    """Подтверждение удаления ошибочного набора ('confirmation') не прерывает серию сканов."""
+    results = processor.process_batch([ERRONEOUS_SET, OK_SET])
+
+    assert [result['status'] for result in results] == ['confirmation', 'success']
+    redis_state.remove_used_codes.assert_called_once_with(ORDER_ID, ['child-1', 'child-2'], [ERRONEOUS_SET])
+    redis_state.redis_client.sadd.assert_called_with(f"correction:scanned_ok:{ORDER_ID}", OK_SET)
+
+
+def test_batch_stops_on_error(redis_state, processor):
+    """Ошибка останавливает серию: следующие сканы не обрабатываются."""
+    processor.process = MagicMock(side_effect=[
+        {'status': 'confirmation', 'message': '', 'session': processor.session},
+        {'status': 'error', 'message': '', 'session': processor.session},
+        {'status': 'success', 'message': '', 'session': processor.session},
+    ])
+
+    results = processor.process_batch(['a', 'b', 'c'])
+
+    assert [result['status'] for result in results] == ['confirmation', 'error']
+
+
+def test_batch_saves_state_after_each_committed_code(redis_state, processor):
+    """Состояние пишется в Redis после каждого кода: исключение на следующем коде не теряет уже сохраненное."""
+    def scan_into_unit(code):
+        processor.session['payload']['current_unit']['items'].append(code)
+        processor._save_state()
+        return {'status': 'success', 'message': '', 'session': processor.session}
+
+    processor.process = MagicMock(side_effect=[scan_into_unit('a'), RuntimeError('сбой')])
+
+    with pytest.raises(RuntimeError):
+        processor.process_batch(['a', 'b'])
+
+    redis_state.save_scan_state.assert_called_once_with(EMPLOYEE_TOKEN_ID, 'lock', processor.session, [])
+    assert processor._saved_items == ['a']
+    assert len(processor.batch_results) == 1
+
+
+def test_lost_scan_lock_is_reported(redis_state, processor):
+    """Если блокировка скана истекла и состояние не записано, обработка завершается ошибкой."""
+    redis_state.finish_scan.return_value = False
+    processor._save_state()
+
+    with pytest.raises(ScanLockLostError):
+        processor.finish()